@@ -0,0 +1,411 @@
+"""
+this file contains the backends that keep the lock state when the in memory lock table is not installed.
+every backend has the methods of the lock table that the Lock class uses, so a Lock works the same way
+against any of them and against the lock table:
+
+    check_status, get_client_address, holds: look up the state of a resource
+    acquire, acquire_shared, acquire_many: lock resources if they are available, and return their fencing tokens
+    release, release_many, release_session, release_by_client_address: release resources held by a client
+    get_resource_id, iter_operations: read the operations every change appended, for the history command
+    last_operation_type: the last operation of a client on a resource, to reconcile the locks found held
+    load, count, held_locks: load the resources when the server starts and list the locks found held
+
+the backends are
+    sqlite: the rows of the database, every change is a transaction
+    memory: the lock state in memory only, it is lost when the server stops
+
+the backend is chosen by the lock_backend environment variable, see BACKEND in settings.py. the other
+values of lock_backend, table and log, install the in memory lock table of lock_table.py instead
+"""
+import itertools
+import threading
+from collections import deque
+from database_functions import *
+from lock_table import LockTable, same_session, select_operations
+from settings import BACKEND, MEMORY_OPERATIONS, HISTORY_PAGE
+
+class SqliteBackend(object):
+    """
+    the lock state kept in the rows of the database. the rows only know the client address of a lock,
+    so the session of every lock is kept in memory like the lock table does.
+    the resource ids are kept in memory by resource name once they are loaded
+    """
+    def __init__(self):
+        """
+        the constructor of the class SqliteBackend
+        """
+        # resource name -> resource id
+        self.catalog = {}
+        # (resource name, client address) -> the session of every lock of the client on the resource, they are not persisted
+        self.sessions = {}
+        self.mutex = threading.Lock()
+
+    def load(self):
+        """
+        load the ids of all the resources from the database in a single query, the locks found held
+        belong to every session of their client address
+
+        :rtype: None
+        """
+        self.catalog = dict((resource_name, resource_id) for resource_id, resource_name, state, client_address, token in get_resources())
+        sessions = {}
+        for resource_id, resource_name, client_address in get_held_locks():
+            sessions.setdefault((resource_name, client_address), []).append(None)
+        with self.mutex:
+            self.sessions = sessions
+
+    def count(self):
+        """
+        get the number of loaded resources
+
+        :rtype: int
+        """
+        return len(self.catalog)
+
+    def held_locks(self):
+        """
+        list the holder of every busy resource and every reader of every shared resource
+
+        :rtype: list of (resource_id, resource_name, client_address)
+        """
+        return get_held_locks()
+
+    def last_operation_type(self, resource_id, client_address):
+        """
+        get the type of the last operation of a client on a resource
+
+        :param int resource_id: the id of the resource
+        :param str client_address: the ip address of the client
+
+        :rtype: str or None if the client never operated on the resource
+        """
+        return get_last_operation_type(resource_id, client_address)
+
+    def check_status(self, resource_name):
+        """
+        get the status of a resource. free, busy, shared or None if it is not listed
+
+        :param str resource_name: a unique identifier for a resource
+
+        :rtype: str
+        """
+        status = get_resource_status(resource_name)
+        if status is not None:
+            return status[0]
+        return None
+
+    def get_client_address(self, resource_name):
+        """
+        get the client address that has locked a resource, or the client addresses sharing it
+
+        :param str resource_name: a unique identifier for a resource
+
+        :rtype: tuple
+        """
+        if self.check_status(resource_name) == "shared":
+            return get_readers_by_resourceName(resource_name)
+        return get_client_address_by_resourceName(resource_name)
+
+    def owns(self, resource_name, client_address, session=None):
+        """
+        check if one of the locks of a client on a resource belongs to the given session, must be called holding the mutex.
+        a lock whose session is not known belongs to every session of its client address, see same_session of lock_table.py
+
+        :param str resource_name: a unique identifier for a resource
+        :param str client_address: the ip address of the client
+        :param int session: the session of the client or None for every session of its client address
+
+        :rtype: bool
+        """
+        owners = self.sessions.get((resource_name, client_address), [None])
+        return any(same_session(owner, session) for owner in owners)
+
+    def grant(self, resource_name, client_address, session=None):
+        """
+        remember the session of a lock taken by a client, must be called holding the mutex
+
+        :param str resource_name: a unique identifier for a resource
+        :param str client_address: the ip address of the client
+        :param int session: the session of the client
+
+        :rtype: None
+        """
+        self.sessions.setdefault((resource_name, client_address), []).append(session)
+
+    def forget(self, resource_name, client_address, session=None):
+        """
+        forget the session of a lock released by a client, must be called holding the mutex
+
+        :param str resource_name: a unique identifier for a resource
+        :param str client_address: the ip address of the client
+        :param int session: the session of the client or None for every session of its client address
+
+        :rtype: None
+        """
+        owners = self.sessions.get((resource_name, client_address))
+        if owners is None:
+            return
+        for index, owner in enumerate(owners):
+            if same_session(owner, session):
+                del owners[index]
+                break
+        if not owners:
+            del self.sessions[(resource_name, client_address)]
+
+    def holds(self, resource_name, client_address, session=None):
+        """
+        check if a resource is locked or shared by the given client
+
+        :param str resource_name: a unique identifier for a resource
+        :param str client_address: the ip address of the client
+        :param int session: the session of the client or None for every session of its client address
+
+        :rtype: bool
+        """
+        with self.mutex:
+            return (self.check_status(resource_name) in ("busy", "shared") and client_address in self.get_client_address(resource_name)
+                    and self.owns(resource_name, client_address, session))
+
+    def acquire(self, resource_name, client_address, operation_time, session=None):
+        """
+        lock a resource if it is free
+
+        :param str resource_name: a unique identifier for a resource
+        :param str client_address: the ip address of the client
+        :param str operation_time: time that this operation happened
+        :param int session: the session of the client
+
+        :rtype: int, the fencing token of the lock or 0 if the resource is not locked by this call
+        """
+        with self.mutex:
+            token = acquire_resource(resource_name, client_address, operation_time)
+            if token:
+                self.grant(resource_name, client_address, session)
+            return token
+
+    def acquire_shared(self, resource_name, client_address, operation_time, session=None):
+        """
+        share a resource with its other readers if it is free or shared
+
+        :param str resource_name: a unique identifier for a resource
+        :param str client_address: the ip address of the client
+        :param str operation_time: time that this operation happened
+        :param int session: the session of the client
+
+        :rtype: int, the fencing token of the shared lock or 0 if the resource is not shared with the client by this call
+        """
+        with self.mutex:
+            token = acquire_shared_resource(resource_name, client_address, operation_time)
+            if token:
+                self.grant(resource_name, client_address, session)
+            return token
+
+    def release(self, resource_name, client_address, operation_time, session=None):
+        """
+        release a resource if it is locked or shared by the given client
+
+        :param str resource_name: a unique identifier for a resource
+        :param str client_address: the ip address of the client
+        :param str operation_time: time that this operation happened
+        :param int session: the session of the client or None for every session of its client address
+
+        :rtype: bool, True if the resource is released by this call
+        """
+        with self.mutex:
+            if not self.owns(resource_name, client_address, session):
+                return False
+            released = release_resource(resource_name, client_address, operation_time)
+            if released:
+                self.forget(resource_name, client_address, session)
+            return released
+
+    def acquire_many(self, resource_names, client_address, operation_time, session=None):
+        """
+        lock all the given resources if all of them are free, otherwise none of them
+
+        :param list resource_names: the unique identifiers of the targeted resources
+        :param str client_address: the ip address of the client
+        :param str operation_time: time that this operation happened
+        :param int session: the session of the client
+
+        :rtype: list, the fencing tokens of the locks in the same order, or False if the resources are not locked by this call
+        """
+        with self.mutex:
+            tokens = acquire_resources(resource_names, client_address, operation_time)
+            if tokens:
+                for resource_name in resource_names:
+                    self.grant(resource_name, client_address, session)
+            return tokens
+
+    def release_many(self, resource_names, client_address, operation_time, session=None):
+        """
+        release all the given resources if all of them are locked or shared by the given client, otherwise none of them
+
+        :param list resource_names: the unique identifiers of the targeted resources
+        :param str client_address: the ip address of the client
+        :param str operation_time: time that this operation happened
+        :param int session: the session of the client or None for every session of its client address
+
+        :rtype: bool, True if all the resources are released by this call
+        """
+        with self.mutex:
+            for resource_name in resource_names:
+                if not self.owns(resource_name, client_address, session):
+                    return False
+            released = release_resources(resource_names, client_address, operation_time)
+            if released:
+                for resource_name in resource_names:
+                    self.forget(resource_name, client_address, session)
+            return released
+
+    def release_session(self, held, client_address, session, operation_time):
+        """
+        release the resources a session still holds after its client disconnected, in a single transaction
+
+        :param dict held: resource name -> number of times the session holds the resource
+        :param str client_address: the ip address of the client
+        :param int session: the session of the client
+        :param str operation_time: time that this operation happened
+
+        :rtype: list, names of the released resources
+        """
+        with self.mutex:
+            # only the locks of the session are released, not the ones of the other sessions of its client address
+            owned = {}
+            for resource_name, count in held.items():
+                owners = self.sessions.get((resource_name, client_address), [None])
+                count = min(count, len([owner for owner in owners if same_session(owner, session)]))
+                if count:
+                    owned[resource_name] = count
+            resource_names = release_held_resources(owned, client_address, operation_time)
+            for resource_name in resource_names:
+                for i in range(owned[resource_name]):
+                    self.forget(resource_name, client_address, session)
+            return resource_names
+
+    def release_by_client_address(self, client_address, operation_time):
+        """
+        release all the resources locked or shared by the given client
+
+        :param str client_address: the ip address of the client
+        :param str operation_time: time that this operation happened
+
+        :rtype: list, names of the released resources
+        """
+        #use a single connection for all the statements
+        with self.mutex, checkout():
+            #select the resources before releasing them, the release clears their client address
+            resources = get_resources_by_client_address(client_address)
+            release_resource_by_client_address(client_address)
+            #insert rows
+            for resource_id, resource_name in resources:
+                insert_operation(resource_id, operation_time, "release", client_address)
+            for key in [key for key in self.sessions if key[1] == client_address]:
+                del self.sessions[key]
+        return [resource_name for resource_id, resource_name in resources]
+
+    def get_resource_id(self, resource_name):
+        """
+        get the resource id of a given resource name
+
+        :param str resource_name: a unique identifier for a resource
+
+        :rtype: int or None if the resource is not listed
+        """
+        resource_id = self.catalog.get(resource_name)
+        if resource_id is None:
+            # a resource listed after the catalog was loaded
+            data = get_resource_id_by_name(resource_name)
+            if data is None:
+                return None
+            resource_id = self.catalog[resource_name] = data[0]
+        return resource_id
+
+    def iter_operations(self, resource_id, since=None, after=None, client_address=None, operation_type=None, page=HISTORY_PAGE):
+        """
+        generate the operations of a resource in time order, see iter_operations of database_functions.py
+
+        :rtype: generator of tuples (operation_id, operation_time, operation_type, client_ip_address)
+        """
+        return iter_operations(resource_id, since, after, client_address, operation_type, page)
+
+class MemoryBackend(LockTable):
+    """
+    the lock state kept in memory only, the resources are read from the database when it is loaded.
+    the last MEMORY_OPERATIONS operations are kept for the history command
+    """
+    def __init__(self):
+        """
+        the constructor of the class MemoryBackend
+        """
+        LockTable.__init__(self)
+        self.operations = deque(maxlen=MEMORY_OPERATIONS)
+        self.operation_ids = itertools.count(1)
+
+    def queue_change(self, change):
+        """
+        keep the operation of a change instead of writing it, must be called holding the mutex
+
+        :param tuple change: (resource_id, state, client_address, readers, operation, token)
+
+        :rtype: None
+        """
+        client_address, operation_time, operation_type, resource_id = change[4]
+        self.operations.append((resource_id, next(self.operation_ids), operation_time, operation_type, client_address))
+
+    def last_operation_type(self, resource_id, client_address):
+        """
+        get the type of the last operation of a client on a resource, from the kept operations or else from the database
+
+        :param int resource_id: the id of the resource
+        :param str client_address: the ip address of the client
+
+        :rtype: str or None if the client never operated on the resource
+        """
+        with self.mutex:
+            for operation_resource_id, operation_id, operation_time, operation_type, client in reversed(self.operations):
+                if operation_resource_id == resource_id and client == client_address:
+                    return operation_type
+        return get_last_operation_type(resource_id, client_address)
+
+    def get_resource_id(self, resource_name):
+        """
+        get the resource id of a given resource name
+
+        :param str resource_name: a unique identifier for a resource
+
+        :rtype: int or None if the resource is not listed
+        """
+        entry = self.entries.get(resource_name)
+        if entry is not None:
+            return entry.resource_id
+        return None
+
+    def iter_operations(self, resource_id, since=None, after=None, client_address=None, operation_type=None, page=None):
+        """
+        generate the kept operations of a resource in time order, see iter_operations of database_functions.py
+
+        :rtype: generator of tuples (operation_id, operation_time, operation_type, client_ip_address)
+        """
+        with self.mutex:
+            rows = [(operation_id, operation_time, kind, client)
+                    for operation_resource_id, operation_id, operation_time, kind, client in self.operations
+                    if operation_resource_id == resource_id]
+        return select_operations(rows, since, after, client_address, operation_type)
+
+def make_backend(name=BACKEND):
+    """
+    create and load a backend
+
+    :param str name: sqlite or memory
+
+    :rtype: the backend
+    """
+    if name == "sqlite":
+        backend = SqliteBackend()
+    elif name == "memory":
+        backend = MemoryBackend()
+    else:
+        raise ValueError("unknown backend " + name)
+    backend.load()
+    return backend
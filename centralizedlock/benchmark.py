@@ -0,0 +1,332 @@
+"""
+this file contains a load generator for the lock server.
+it starts socket_server.py on a new database with its own resources, drives it with
+many clients and reports the throughput and the latency percentiles of every scenario as json,
+so the results of two commits can be compared, for example
+
+    python benchmark.py --clients 16 --resources 64 --contention 0.2 --output result.json
+
+the scenarios are
+    uncontended: every client locks and releases its own resource
+    contended: every lock goes to one of the hot resources with the probability --contention
+    disconnect: a client waits for a resource then its holder disconnects, the latency is
+        the time between the disconnect and the grant of the waiting client
+"""
+import argparse
+import json
+import os
+import random
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from client import Connection
+from protocol import GRANTED, RELEASED
+from schema import migrate, add_resources
+from settings import TIMEOUT
+
+# the database file used by the benchmark server
+BENCHMARK_DATABASE_NAME = "resources_benchmark.sqlite"
+
+# the files of the benchmark server, the -wal and -shm files are written by sqlite in the WAL journal mode,
+# the log and the snapshot by the log storage
+BENCHMARK_FILES = (BENCHMARK_DATABASE_NAME, BENCHMARK_DATABASE_NAME + "-wal", BENCHMARK_DATABASE_NAME + "-shm",
+                   BENCHMARK_DATABASE_NAME.replace(".sqlite", ".log"), BENCHMARK_DATABASE_NAME.replace(".sqlite", ".snapshot"))
+
+def percentile(latencies, fraction):
+    """
+    get a percentile of sorted latencies using the nearest rank
+
+    :param list latencies: the sorted latencies
+    :param float fraction: the percentile between 0 and 1, for example 0.99
+
+    :rtype: float
+    """
+    if not latencies:
+        return None
+    rank = max(int(fraction * len(latencies) + 0.5), 1)
+    return latencies[min(rank, len(latencies)) - 1]
+
+def summarize(latencies, seconds, errors):
+    """
+    build the result of a scenario
+
+    :param list latencies: the latency of every operation in seconds
+    :param float seconds: the duration of the scenario
+    :param int errors: number of operations that got an unexpected reply
+
+    :rtype: dict
+    """
+    latencies = sorted(latencies)
+    result = {
+        "operations": len(latencies),
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "throughput": round(len(latencies) / seconds, 1) if seconds else None,
+        "latency_ms": {},
+    }
+    for name, fraction in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999), ("max", 1.0)):
+        value = percentile(latencies, fraction)
+        result["latency_ms"][name] = round(value * 1000, 3) if value is not None else None
+    return result
+
+def run_clients(clients, func):
+    """
+    run func(client_index) in a thread per client, all of them start together
+
+    :param int clients: number of clients
+    :param function func: the body of a client, it returns (latencies, errors)
+
+    :rtype: tuple (latencies, seconds, errors)
+    """
+    results = [None] * clients
+    start = threading.Event()
+    def client(i):
+        start.wait()
+        results[i] = func(i)
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    began = time.time()
+    start.set()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - began
+
+    latencies = []
+    errors = 0
+    for client_latencies, client_errors in results:
+        latencies.extend(client_latencies)
+        errors += client_errors
+    return latencies, seconds, errors
+
+def timed_call(conn, command, expected, latencies):
+    """
+    run a command and store its latency
+
+    :param Connection conn: the connection of the client
+    :param str command: the command to be run
+    :param str expected: the beginning of the expected reply
+    :param list latencies: the latencies of the client
+
+    :rtype: bool, True if the reply is the expected one
+    """
+    began = time.time()
+    reply = conn.call([command])[0]
+    latencies.append(time.time() - began)
+    return reply.startswith(expected)
+
+def uncontended(host, port, resource_names, clients, operations):
+    """
+    every client locks then releases its own resource
+
+    :param str host: the ip address of the server
+    :param int port: the port number of the server
+    :param list resource_names: the resources, one per client
+    :param int clients: number of clients
+    :param int operations: number of lock and release pairs of every client
+
+    :rtype: dict
+    """
+    def client(i):
+        conn = Connection(host, port, TIMEOUT + 5)
+        latencies = []
+        errors = 0
+        for n in range(operations):
+            errors += not timed_call(conn, "lock " + resource_names[i], GRANTED, latencies)
+            errors += not timed_call(conn, "release " + resource_names[i], RELEASED, latencies)
+        conn.close()
+        return latencies, errors
+    return summarize(*run_clients(clients, client))
+
+def contended(host, port, resource_names, clients, operations, contention, hot):
+    """
+    every lock goes to one of the hot resources with the probability contention, otherwise
+    to the own resource of the client. only the locks are timed, they include the waits
+
+    :param str host: the ip address of the server
+    :param int port: the port number of the server
+    :param list resource_names: the hot resources followed by a resource per client
+    :param int clients: number of clients
+    :param int operations: number of lock and release pairs of every client
+    :param float contention: the probability that a lock goes to a hot resource
+    :param int hot: number of hot resources
+
+    :rtype: dict
+    """
+    def client(i):
+        conn = Connection(host, port, TIMEOUT + 5)
+        rand = random.Random(i)
+        latencies = []
+        errors = 0
+        for n in range(operations):
+            if rand.random() < contention:
+                resource_name = resource_names[rand.randrange(hot)]
+            else:
+                resource_name = resource_names[hot + i]
+            if timed_call(conn, "lock " + resource_name, GRANTED, latencies):
+                errors += not conn.call(["release " + resource_name])[0].startswith(RELEASED)
+            else:
+                errors += 1
+        conn.close()
+        return latencies, errors
+    return summarize(*run_clients(clients, client))
+
+def disconnect_cleanup(host, port, resource_names, clients, operations):
+    """
+    a client waits for a resource locked by another client, then the holder disconnects.
+    the latency is the time between the disconnect and the grant of the waiting client
+
+    :param str host: the ip address of the server
+    :param int port: the port number of the server
+    :param list resource_names: the resources, one per client
+    :param int clients: number of clients
+    :param int operations: number of disconnects of every client
+
+    :rtype: dict
+    """
+    def client(i):
+        latencies = []
+        errors = 0
+        for n in range(operations):
+            holder = Connection(host, port, TIMEOUT + 5)
+            waiter = Connection(host, port, TIMEOUT + 5)
+            if not holder.call(["lock " + resource_names[i]])[0].startswith(GRANTED):
+                errors += 1
+            request_ids = waiter.send(["lock " + resource_names[i]])
+            # give the server the time to queue the waiter
+            time.sleep(0.005)
+            began = time.time()
+            holder.close()
+            reply = waiter.receive(request_ids)[0]
+            latencies.append(time.time() - began)
+            if reply.startswith(GRANTED):
+                waiter.call(["release " + resource_names[i]])
+            else:
+                errors += 1
+            waiter.close()
+        return latencies, errors
+    return summarize(*run_clients(clients, client))
+
+def prepare_database(resource_names):
+    """
+    create the database of the benchmark from scratch with its resources
+
+    :param list resource_names: the resources of the benchmark
+
+    :rtype: None
+    """
+    remove_files()
+    con = sqlite3.connect(BENCHMARK_DATABASE_NAME)
+    migrate(con)
+    add_resources(con, resource_names)
+    con.close()
+
+def remove_files():
+    """
+    remove the files of the benchmark server
+
+    :rtype: None
+    """
+    for name in BENCHMARK_FILES:
+        if os.path.exists(name):
+            os.remove(name)
+
+def start_server(port, env):
+    """
+    start socket_server.py on the benchmark database and wait until it is listening
+
+    :param int port: the port number of the server
+    :param dict env: more environment variables of the server, like lock_server_mode
+
+    :rtype: the server process
+    """
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'socket_server.py')
+    server_env = dict(os.environ, lock_database_name=BENCHMARK_DATABASE_NAME, lock_server_port=str(port))
+    server_env.update(env)
+    with open(os.devnull, 'w') as devnull:
+        server = subprocess.Popen([sys.executable, server_path], env=server_env, stdout=devnull)
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return server
+        except socket.error:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("the server did not start")
+
+def git_commit():
+    """
+    get the current git commit, so the results can be compared across commits
+
+    :rtype: str or None
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="load generator for the lock server")
+    parser.add_argument("--clients", type=int, default=8, help="number of concurrent clients")
+    parser.add_argument("--resources", type=int, default=0,
+                        help="number of resources, at least clients + hot (the default)")
+    parser.add_argument("--hot", type=int, default=1, help="number of hot resources of the contended scenario")
+    parser.add_argument("--contention", type=float, default=0.5,
+                        help="probability that a lock of the contended scenario goes to a hot resource")
+    parser.add_argument("--operations", type=int, default=500, help="number of operations of every client")
+    parser.add_argument("--disconnects", type=int, default=20, help="number of disconnects of every client")
+    parser.add_argument("--scenarios", default="uncontended,contended,disconnect")
+    parser.add_argument("--port", type=int, default=8890, help="the port of the benchmark server")
+    parser.add_argument("--external", action="store_true",
+                        help="use a server already running on --port, it must list the benchmark resources")
+    parser.add_argument("--env", action="append", default=[],
+                        help="KEY=VALUE environment variable of the server, for example lock_server_mode=threaded")
+    parser.add_argument("--output", help="write the json result to this file too")
+    args = parser.parse_args()
+
+    resources = max(args.resources, args.clients + args.hot)
+    resource_names = ["benchmark%d" % i for i in range(resources)]
+    client_names = resource_names[args.hot:]
+
+    server = None
+    if not args.external:
+        prepare_database(resource_names)
+        server = start_server(args.port, dict(item.split("=", 1) for item in args.env))
+    try:
+        results = {}
+        for scenario in args.scenarios.split(","):
+            if scenario == "uncontended":
+                results[scenario] = uncontended('127.0.0.1', args.port, client_names, args.clients, args.operations)
+            elif scenario == "contended":
+                results[scenario] = contended('127.0.0.1', args.port, resource_names, args.clients,
+                                              args.operations, args.contention, args.hot)
+            elif scenario == "disconnect":
+                results[scenario] = disconnect_cleanup('127.0.0.1', args.port, client_names, args.clients,
+                                                       args.disconnects)
+            else:
+                parser.error("unknown scenario " + scenario)
+            print >> sys.stderr, scenario, json.dumps(results[scenario], sort_keys=True)
+    finally:
+        if server is not None:
+            server.send_signal(signal.SIGINT)
+            server.wait()
+            remove_files()
+
+    report = json.dumps({
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": dict(vars(args), resources=resources),
+        "results": results,
+    }, indent=2, sort_keys=True)
+    print report
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(report + "\n")
+
+if __name__ == '__main__':
+    main()
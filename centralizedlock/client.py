@@ -0,0 +1,601 @@
+"""
+this file contains a client library for the lock server.
+it keeps a pool of persistent connections using the framed protocol, so a lock costs
+a round trip instead of a new TCP connection, for example
+
+    client = LockClient('127.0.0.1', 8888)
+    with client.lock('resourceY') as token:
+        # exclusive access to resourceY, the token is sent along with the writes it protects
+        ...
+
+client.status('resourceY') returns the lock state of resourceY, like ('busy', ('127.0.0.1',)). the states of the
+recently asked resources are cached, a cached resource is watched so the server pushes every change of it to the
+cache and the cached state is never older than the events received so far
+"""
+import json
+import socket
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from protocol import FRAMED, FRAMED_ON, GRANTED, GRANTED_SHARED, RELEASED, RENEWED, BUSY, WATCHING, EVENT_ID
+from protocol import ALREADY_FREE, NOT_ALLOWED
+from settings import TIMEOUT, STATUS_CACHE_SIZE
+from watchers import parse_event
+
+class LockError(Exception):
+    """
+    raised when the server refuses a command
+    """
+
+class LockTimeout(LockError):
+    """
+    raised when a resource is still busy after the server waited TIMEOUT secs
+    """
+
+class Connection(object):
+    """
+    a single persistent connection to the server using the framed protocol
+    """
+    def __init__(self, host, port, timeout):
+        """
+        the constructor of the class Connection, it connects and switches to the framed protocol
+
+        :param str host: the ip address of the server
+        :param int port: the port number that the server is listening to
+        :param float timeout: number of seconds to wait for the server before giving up
+        """
+        self.sock = socket.create_connection((host, port), timeout)
+        self.buffer = ''
+        self.next_id = 0
+        # taken by call, so the threads sharing a pinned connection wait for each other's replies
+        self.mutex = threading.Lock()
+        self.sock.sendall(FRAMED + "\n")
+        if self.readline() != FRAMED_ON:
+            self.close()
+            raise LockError("the server does not support the framed protocol")
+
+    def readline(self):
+        """
+        read a single line sent by the server
+
+        :rtype: str
+        """
+        while "\n" not in self.buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise socket.error("connection closed by the server")
+            self.buffer += data
+        line, self.buffer = self.buffer.split("\n", 1)
+        return line
+
+    def call(self, commands):
+        """
+        send many commands at once and wait for all their replies
+
+        :param list commands: the commands, for example "lock resourceX"
+
+        :rtype: list of str, the replies in the same order
+        """
+        with self.mutex:
+            return self.receive(self.send(commands))
+
+    def send(self, commands):
+        """
+        send many commands at once without waiting for their replies
+
+        :param list commands: the commands, for example "lock resourceX"
+
+        :rtype: list of str, the request ids of the commands
+        """
+        frames = []
+        request_ids = []
+        for command in commands:
+            self.next_id += 1
+            request_ids.append(str(self.next_id))
+            frames.append(request_ids[-1] + " " + command + "\n")
+        self.sock.sendall("".join(frames))
+        return request_ids
+
+    def receive(self, request_ids):
+        """
+        wait for the replies of the sent commands
+
+        :param list request_ids: the request ids returned by send
+
+        :rtype: list of str, the replies in the same order
+        """
+        replies = []
+        for request_id in request_ids:
+            reply_id, _, reply = self.readline().partition(" ")
+            if reply_id != request_id:
+                raise socket.error("unexpected reply " + reply_id)
+            replies.append(reply)
+        return replies
+
+    def close(self):
+        """
+        close the connection, the server releases the locks it holds
+
+        :rtype: None
+        """
+        self.sock.close()
+
+class StatusCache(object):
+    """
+    a bounded LRU cache of the lock state of resources. every cached resource is watched over a dedicated
+    connection and a thread applies the events pushed by the server, so a cached state is answered without
+    asking the server. if the connection fails the cache is emptied and the states are asked again
+    """
+    def __init__(self, host, port, size, timeout):
+        """
+        the constructor of the class StatusCache, it opens the watching connection
+
+        :param str host: the ip address of the server
+        :param int port: the port number that the server is listening to
+        :param int size: maximum number of cached resources
+        :param float timeout: number of seconds to wait for the server before giving up
+        """
+        self.size = size
+        self.timeout = timeout
+        self.conn = Connection(host, port, timeout)
+        self.conn.sock.settimeout(None)
+        # resource name -> (state, client_addresses), the least recently asked first
+        self.entries = OrderedDict()
+        # the names of the watched resources, a resource is watched before its first event arrives
+        self.watching = set()
+        # request id -> reply of the watch commands waiting for it
+        self.replies = {}
+        self.broken = False
+        self.cond = threading.Condition()
+        reader = threading.Thread(target=self.read_forever)
+        reader.daemon = True
+        reader.start()
+
+    def get(self, resource_name):
+        """
+        get the lock state of a resource, a resource that is not cached is watched then cached
+
+        :param str resource_name: a unique identifier for a resource
+
+        :rtype: tuple (state, client_addresses)
+        """
+        with self.cond:
+            entry = self.entries.pop(resource_name, None)
+            if entry is not None:
+                self.entries[resource_name] = entry
+                return entry
+            if self.broken:
+                raise socket.error("the watching connection is closed")
+            if resource_name not in self.watching:
+                self.watching.add(resource_name)
+                request_id = self.conn.send(["watch " + resource_name])[0]
+                self.replies[request_id] = None
+                try:
+                    reply = self.wait(lambda: self.replies[request_id])
+                except socket.error:
+                    self.watching.discard(resource_name)
+                    raise
+                finally:
+                    del self.replies[request_id]
+                if not reply.startswith(WATCHING):
+                    self.watching.discard(resource_name)
+                    raise LockError(reply)
+            # the first event of a watched resource is its current state
+            entry = self.wait(lambda: self.entries.get(resource_name))
+            while len(self.entries) > self.size:
+                evicted, _ = self.entries.popitem(last=False)
+                self.watching.discard(evicted)
+                self.conn.send(["unwatch " + evicted])
+            return entry
+
+    def wait(self, ready):
+        """
+        wait for the reader thread at most timeout secs, must be called holding the condition
+
+        :param function ready: returns the awaited value once it arrived
+
+        :rtype: the value returned by ready
+        """
+        deadline = time.time() + self.timeout
+        value = ready()
+        while not value:
+            if self.broken:
+                raise socket.error("the watching connection is closed")
+            if time.time() >= deadline:
+                raise socket.error("the server did not send the state")
+            self.cond.wait(deadline - time.time())
+            value = ready()
+        return value
+
+    def read_forever(self):
+        """
+        the body of the reader thread, it applies the events and hands the replies over
+
+        :rtype: None
+        """
+        try:
+            while True:
+                request_id, _, reply = self.conn.readline().partition(" ")
+                with self.cond:
+                    if request_id == EVENT_ID:
+                        resource_name, state, client_addresses = parse_event(reply)
+                        if resource_name in self.watching:
+                            self.entries[resource_name] = (state, client_addresses)
+                    elif request_id in self.replies:
+                        self.replies[request_id] = reply
+                    else:
+                        # the reply of an unwatch
+                        continue
+                    self.cond.notify_all()
+        except socket.error:
+            with self.cond:
+                self.broken = True
+                self.entries.clear()
+                self.watching.clear()
+                self.cond.notify_all()
+
+    def close(self):
+        """
+        close the watching connection, the server stops the watches
+
+        :rtype: None
+        """
+        try:
+            # wake the reader thread up
+            self.conn.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.conn.close()
+
+class LockClient(object):
+    """
+    a thread safe client that keeps a pool of persistent connections to the server.
+    the server releases the locks of a connection when it is closed, so a connection that holds locks is pinned:
+    it stays out of the pool until they are released, and they are released and renewed over the same connection
+    """
+    def __init__(self, host='127.0.0.1', port=8888, pool_size=4, timeout=TIMEOUT + 5, cache_size=STATUS_CACHE_SIZE):
+        """
+        the constructor of the class LockClient
+
+        :param str host: the ip address of the server
+        :param int port: the port number that the server is listening to
+        :param int pool_size: maximum number of idle connections kept open
+        :param float timeout: number of seconds to wait for a reply, it has to be longer than
+            the TIMEOUT of the server because a busy resource is answered after it
+        :param int cache_size: maximum number of resources whose lock state is cached, 0 asks the server every time
+        """
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.idle = []
+        # resource name -> the pinned connections holding it, the oldest lock first
+        self.held = {}
+        # pinned connection -> Counter of the resources it holds
+        self.pinned = {}
+        self.mutex = threading.Lock()
+        self.cache_size = cache_size
+        # the cache of the lock states, opened by the first status
+        self.cache = None
+
+    def checkout(self):
+        """
+        take an idle connection from the pool, or open a new one if none is idle
+
+        :rtype: Connection
+        """
+        with self.mutex:
+            conn = self.idle.pop() if self.idle else None
+        if conn is None:
+            conn = Connection(self.host, self.port, self.timeout)
+        return conn
+
+    def checkin(self, conn):
+        """
+        give a connection back to the pool unless it is pinned, it is closed if the pool is full
+
+        :param Connection conn: a connection returned by checkout
+
+        :rtype: None
+        """
+        with self.mutex:
+            if conn in self.pinned:
+                return
+            if len(self.idle) < self.pool_size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        """
+        check out a connection from the pool inside a with block, it goes back to the pool afterwards
+        unless it holds locks. a connection that fails is closed instead of going back to the pool
+
+        :rtype: Connection
+        """
+        conn = self.checkout()
+        try:
+            yield conn
+        except socket.error:
+            self.forget(conn)
+            conn.close()
+            raise
+        except:
+            self.checkin(conn)
+            raise
+        self.checkin(conn)
+
+    def run(self, conn, commands):
+        """
+        pipeline many commands on a connection and keep track of the locks it holds from their replies
+
+        :param Connection conn: a checked out or pinned connection
+        :param list commands: the commands, for example "lock resourceX"
+
+        :rtype: list of str, the replies in the same order
+        """
+        replies = conn.call(commands)
+        with self.mutex:
+            for command, reply in zip(commands, replies):
+                words = command.split()
+                resource_names = [word for word in words[1:] if "=" not in word]
+                if reply.startswith(GRANTED) or reply.startswith(GRANTED_SHARED):
+                    self.pinned.setdefault(conn, Counter()).update(resource_names)
+                    for resource_name in resource_names:
+                        self.held.setdefault(resource_name, []).append(conn)
+                elif words and words[0] == "release" and (reply.startswith(RELEASED) or reply in (ALREADY_FREE, NOT_ALLOWED)):
+                    # the connection does not hold the resources anymore, their leases may have ended
+                    for resource_name in resource_names:
+                        self.unpin(conn, resource_name)
+        return replies
+
+    def unpin(self, conn, resource_name):
+        """
+        forget a lock of a pinned connection, must be called holding the mutex
+
+        :param Connection conn: the pinned connection
+        :param str resource_name: a unique identifier for a resource
+
+        :rtype: None
+        """
+        held = self.pinned.get(conn)
+        if held is None or not held[resource_name]:
+            return
+        held[resource_name] -= 1
+        if not held[resource_name]:
+            del held[resource_name]
+        if not held:
+            del self.pinned[conn]
+        holders = self.held[resource_name]
+        holders.remove(conn)
+        if not holders:
+            del self.held[resource_name]
+
+    def forget(self, conn):
+        """
+        forget all the locks of a failed connection, the server releases them when it is closed
+
+        :param Connection conn: the failed connection
+
+        :rtype: None
+        """
+        with self.mutex:
+            for resource_name, count in self.pinned.pop(conn, Counter()).items():
+                holders = [holder for holder in self.held[resource_name] if holder is not conn]
+                if holders:
+                    self.held[resource_name] = holders
+                else:
+                    del self.held[resource_name]
+
+    def holder(self, resource_name):
+        """
+        get the pinned connection holding the oldest lock of a resource
+
+        :param str resource_name: a unique identifier for a resource
+
+        :rtype: Connection or None if the client does not hold the resource
+        """
+        with self.mutex:
+            holders = self.held.get(resource_name)
+            if holders:
+                return holders[0]
+            return None
+
+    def batch(self, commands, conn=None):
+        """
+        pipeline many commands on a single connection and return their replies.
+        the locks granted by the batch belong to its connection, it is pinned until they are released
+
+        :param list commands: the commands, for example "lock resourceX"
+        :param Connection conn: the pinned connection to send them on, by default a pooled connection
+
+        :rtype: list of str, the replies in the same order
+        """
+        if conn is not None:
+            try:
+                return self.run(conn, commands)
+            except socket.error:
+                self.forget(conn)
+                conn.close()
+                raise
+        with self.connection() as conn:
+            return self.run(conn, commands)
+
+    def acquire(self, *resource_names, **options):
+        """
+        lock one or more resources, waiting at most the TIMEOUT of the server.
+        the lock is held by a connection of its own until it is released
+
+        :param str resource_names: the unique identifiers of the resources
+        :param int ttl: keyword only, number of milliseconds the lease lasts, by default the lock lasts until released
+        :param bool shared: keyword only, share a single resource with the other readers
+
+        :rtype: int, the fencing token of the lock, or the list of the tokens of many resources
+        """
+        command, expected = lock_command(resource_names, options.get('ttl'), options.get('shared'))
+        return parse_tokens(check_reply(self.batch([command])[0], expected))
+
+    def release(self, *resource_names):
+        """
+        release one or more resources over the connections holding them, the resources locked together
+        are released together, the others one connection after the other
+
+        :param str resource_names: the unique identifiers of the resources
+
+        :rtype: None
+        """
+        # pinned connection or None -> the resources it releases
+        groups = OrderedDict()
+        for resource_name in resource_names:
+            groups.setdefault(self.holder(resource_name), []).append(resource_name)
+        for conn, names in groups.items():
+            check_reply(self.batch(["release " + " ".join(names)], conn)[0], RELEASED)
+
+    def renew(self, resource_name, ttl):
+        """
+        renew the lease of a resource locked by this client
+
+        :param str resource_name: a unique identifier for a resource
+        :param int ttl: number of milliseconds the lease lasts from now
+
+        :rtype: None
+        """
+        check_reply(self.batch(["renew %s ttl=%d" % (resource_name, ttl)], self.holder(resource_name))[0], RENEWED)
+
+    def status(self, resource_name):
+        """
+        get the lock state of a resource and its holders, from the cache if it is cached
+
+        :param str resource_name: a unique identifier for a resource
+
+        :rtype: tuple (state, client_addresses), the state is free, busy or shared
+        """
+        if self.cache_size:
+            with self.mutex:
+                if self.cache is None or self.cache.broken:
+                    self.cache = StatusCache(self.host, self.port, self.cache_size, self.timeout)
+                cache = self.cache
+            try:
+                return cache.get(resource_name)
+            except socket.error:
+                # the cache is opened again by the next status
+                pass
+        reply = self.batch(["status " + resource_name])[0]
+        try:
+            return parse_event(reply)[1:]
+        except (IndexError, KeyError):
+            raise LockError(reply)
+
+    def history(self, resource_name, **options):
+        """
+        generate the operations of a resource in time order, a page at a time
+
+        :param str resource_name: a unique identifier for a resource
+        :param str since: keyword only, the first operation_time, like 2017-01-31T10:00:00
+        :param str client: keyword only, generate the operations of this client address only
+        :param str type: keyword only, generate the operations of this type only, like lock or release
+        :param int limit: keyword only, number of operations read by a single command
+
+        :rtype: generator of lists [operation_id, operation_time, operation_type, client_address]
+        """
+        command = "history " + resource_name + "".join(
+            " %s=%s" % (key, str(value).replace(" ", "T")) for key, value in sorted(options.items()))
+        after = ""
+        while True:
+            reply = self.batch([command + after])[0]
+            if not reply.startswith("{"):
+                raise LockError(reply)
+            page = json.loads(reply)
+            for operation in page["operations"]:
+                yield operation
+            if page["next"] is None:
+                return
+            after = " after=%d" % page["next"]
+
+    @contextmanager
+    def lock(self, *resource_names, **options):
+        """
+        hold the lock of one or more resources inside a with block.
+        the same connection is kept for the lock and the release, so if the client dies
+        the server releases the resources when the connection is closed
+
+        :param str resource_names: the unique identifiers of the resources
+        :param int ttl: keyword only, number of milliseconds the lease lasts, by default the lock lasts until released
+        :param bool shared: keyword only, share a single resource with the other readers
+
+        :rtype: int, the fencing token of the lock, or the list of the tokens of many resources, given by the with statement
+        """
+        command, expected = lock_command(resource_names, options.get('ttl'), options.get('shared'))
+        with self.connection() as conn:
+            tokens = parse_tokens(check_reply(self.run(conn, [command])[0], expected))
+            try:
+                yield tokens
+            finally:
+                check_reply(self.run(conn, ["release " + " ".join(resource_names)])[0], RELEASED)
+
+    def close(self):
+        """
+        close all the connections and the watching connection of the cache,
+        the server releases the locks still held by the pinned connections
+
+        :rtype: None
+        """
+        with self.mutex:
+            idle, self.idle = self.idle, []
+            pinned, self.pinned, self.held = list(self.pinned), {}, {}
+            cache, self.cache = self.cache, None
+        for conn in idle + pinned:
+            conn.close()
+        if cache is not None:
+            cache.close()
+
+def lock_command(resource_names, ttl, shared):
+    """
+    build the command that locks the given resources and the beginning of its expected reply,
+    the command always asks for the fencing tokens
+
+    :param list resource_names: the unique identifiers of the resources
+    :param int ttl: number of milliseconds the lease lasts, None to lock until released
+    :param bool shared: share the resource with the other readers
+
+    :rtype: tuple (command, expected)
+    """
+    if shared:
+        command, expected = "lock_shared ", GRANTED_SHARED
+    else:
+        command, expected = "lock ", GRANTED
+    command += " ".join(resource_names)
+    if ttl is not None:
+        command += " ttl=%d" % ttl
+    command += " fence=1"
+    return command, expected
+
+def check_reply(reply, expected):
+    """
+    raise an error if the reply is not the expected one
+
+    :param str reply: the reply sent by the server
+    :param str expected: the beginning of the expected reply
+
+    :rtype: str, the reply
+    """
+    if reply.startswith(expected):
+        return reply
+    if reply == BUSY:
+        raise LockTimeout(reply)
+    raise LockError(reply)
+
+def parse_tokens(reply):
+    """
+    get the fencing tokens sent at the end of a grant
+
+    :param str reply: the grant reply, like "You have an exclusive access to resource resourceX token=42"
+
+    :rtype: int for a single resource, list of int for many resources
+    """
+    tokens = [int(token) for token in reply.rsplit(" token=", 1)[1].split(",")]
+    if len(tokens) == 1:
+        return tokens[0]
+    return tokens
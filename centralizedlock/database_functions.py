@@ -1,18 +1,265 @@
 """
 this file contains functions that connects to the database and update it.
+the connections are opened once and kept in a pool, every function checks out
+a connection, runs its statements and puts the connection back.
+the rows of the operations table are written by a group commit writer, see OPERATIONS_DURABILITY.
+the clients sharing a resource locked with lock_shared are kept in the resource_readers table.
+the time spent connecting, executing the statements and committing is added to the sqlite histograms of the metrics.
 """
 import sqlite3
-from settings import DATABASE_NAME
+import threading
+import time
+from contextlib import contextmanager
+from Queue import Queue, Empty
+from metrics import metrics
+from schema import migrate
+from settings import DATABASE_NAME, DATABASE_POOL_SIZE, DATABASE_JOURNAL_MODE, DATABASE_CACHED_STATEMENTS
+from settings import OPERATIONS_DURABILITY, OPERATIONS_BATCH_SIZE, OPERATIONS_MAX_DELAY, WRITE_BEHIND_RETRY
+from settings import HISTORY_PAGE
 
-def connect():
+class TimedCursor(sqlite3.Cursor):
+    """
+    a cursor that adds the time spent executing its statements to the metrics
+    """
+    def execute(self, *args):
+        with metrics.timed("sqlite_execute"):
+            return sqlite3.Cursor.execute(self, *args)
+
+    def executemany(self, *args):
+        with metrics.timed("sqlite_execute"):
+            return sqlite3.Cursor.executemany(self, *args)
+
+class TimedConnection(sqlite3.Connection):
+    """
+    a connection that adds the time spent executing its statements and committing to the metrics
+    """
+    def cursor(self, factory=TimedCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def commit(self):
+        with metrics.timed("sqlite_commit"):
+            sqlite3.Connection.commit(self)
+
+class UnknownOperation(LookupError):
+    """
+    the operation a page of the history starts after is not an operation of the resource,
+    it was never written or the retention job moved it to the archive
+    """
+
+def connect(database_name=DATABASE_NAME):
     """
     connect to the sqlite database and return the connection
 
+    :param str database_name: the file of the database
+
     :rtype: sqlite db connection
     """
-    con = sqlite3.connect(DATABASE_NAME)
+    with metrics.timed("sqlite_connect"):
+        con = sqlite3.connect(database_name, check_same_thread=False,
+                              cached_statements=DATABASE_CACHED_STATEMENTS, factory=TimedConnection)
+    con.execute("PRAGMA journal_mode = " + DATABASE_JOURNAL_MODE)
+    #create the tables and indexes missing from the database file
+    migrate(con)
     return con
 
+class ConnectionPool(object):
+    """
+    a bounded pool of open connections shared between all the threads
+    """
+    def __init__(self, size):
+        """
+        the constructor of the class ConnectionPool
+
+        :param int size: maximum number of connections opened at the same time
+        """
+        self.size = size
+        self.opened = 0
+        self.idle = Queue()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def get(self):
+        """
+        take an idle connection, open a new one if the pool is not full or wait for one
+
+        :rtype: sqlite db connection
+        """
+        try:
+            return self.idle.get_nowait()
+        except Empty:
+            pass
+        with self.lock:
+            full = self.opened >= self.size
+            if not full:
+                self.opened += 1
+        if full:
+            return self.idle.get()
+        try:
+            return connect()
+        except Exception:
+            # give the slot back, otherwise the pool would wait forever for a connection never opened
+            with self.lock:
+                self.opened -= 1
+            raise
+
+    def put(self, conn):
+        """
+        give the connection back to the pool
+
+        :param conn: sqlite db connection
+
+        :rtype: None
+        """
+        self.idle.put(conn)
+
+pool = ConnectionPool(DATABASE_POOL_SIZE)
+
+@contextmanager
+def checkout():
+    """
+    check out a connection from the pool for the current thread.
+    nested checkouts in the same thread share the same connection, so a caller can
+    run several functions of this file using a single checkout.
+    if an error happens the uncommitted changes are rolled back
+
+    :rtype: sqlite db connection
+    """
+    local = pool.local
+    if getattr(local, "conn", None) is not None:
+        # the thread already holds a connection
+        yield local.conn
+        return
+
+    local.conn = pool.get()
+    try:
+        yield local.conn
+    except:
+        local.conn.rollback()
+        raise
+    finally:
+        conn, local.conn = local.conn, None
+        pool.put(conn)
+
+class OperationsWriter(object):
+    """
+    a group commit writer for the operations table, it collects the rows appended by all
+    the threads and inserts them in batched transactions using its own connection.
+    a batch is committed when it has OPERATIONS_BATCH_SIZE rows or when its first row
+    waited OPERATIONS_MAX_DELAY secs. a batch the database refuses is retried on a new connection
+    until it is committed, so the writer thread never dies with the waiters of its batches
+    """
+    def __init__(self, batch_size, max_delay, database_name=DATABASE_NAME):
+        """
+        the constructor of the class OperationsWriter
+
+        :param int batch_size: maximum number of rows committed in a single transaction
+        :param float max_delay: maximum number of seconds a row waits for its batch to fill up
+        :param str database_name: the file of the database
+        """
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.database_name = database_name
+        self.rows = []
+        # the number of the batch being filled and of the last committed batch
+        self.batch_number = 0
+        self.committed = -1
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def append(self, row):
+        """
+        queue a row to be inserted into the operations table
+
+        :param tuple row: (client_address, operation_time, operation_type, resource_id)
+
+        :rtype: int, the number of the batch of the row
+        """
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.write_forever)
+                self.thread.daemon = True
+                self.thread.start()
+            self.rows.append(row)
+            self.condition.notify_all()
+            return self.batch_number
+
+    def wait(self, batch):
+        """
+        wait until a batch is committed
+
+        :param int batch: the number of the batch returned by append
+
+        :rtype: None
+        """
+        with self.condition:
+            while self.committed < batch:
+                self.condition.wait()
+
+    def write_forever(self):
+        """
+        the body of the writer thread
+
+        :rtype: None
+        """
+        # the connection is opened by the first write
+        conn = None
+        while True:
+            with self.condition:
+                while not self.rows:
+                    self.condition.wait()
+                # give the other threads a chance to join the batch
+                deadline = time.time() + self.max_delay
+                while len(self.rows) < self.batch_size and time.time() < deadline:
+                    self.condition.wait(deadline - time.time())
+                rows, self.rows = self.rows[:self.batch_size], self.rows[self.batch_size:]
+                batch = self.batch_number
+                if not self.rows:
+                    self.batch_number += 1
+
+            conn = self.write(conn, rows)
+
+            with self.condition:
+                if batch < self.batch_number:
+                    # no rows of this batch are left behind
+                    self.committed = batch
+                self.condition.notify_all()
+
+    def write(self, conn, rows):
+        """
+        insert a batch of rows in a single transaction, retry until the database accepts it.
+        the connection is closed after a failure and opened again by the next try
+
+        :param conn: the sqlite db connection of the writer or None to open it
+        :param list rows: tuples of (client_address, operation_time, operation_type, resource_id)
+
+        :rtype: sqlite db connection, the connection to write the next batch with
+        """
+        sql_query = "insert into operations(client_ip_address, operation_time, operation_type, resource_id) values(?, ?, ?, ?)"
+        while True:
+            try:
+                if conn is None:
+                    conn = connect(self.database_name)
+                conn.executemany(sql_query, rows)
+                conn.commit()
+                return conn
+            except (sqlite3.Error, EnvironmentError) as e:
+                print 'Operations writer failed: ' + str(e)
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except sqlite3.Error:
+                        pass
+                conn = None
+                time.sleep(WRITE_BEHIND_RETRY)
+
+operations_writer = OperationsWriter(OPERATIONS_BATCH_SIZE, OPERATIONS_MAX_DELAY)
+
 def get_resource_status(resource_name):
     """
     get resource status by resource name and return a tuple of a value free or busy
@@ -21,12 +268,11 @@ def get_resource_status(resource_name):
 
     :rtype: None
     """
-    conn = connect()
-    cur = conn.cursor()
-    sql_query = "select resources_names.current_state from resources_names where resources_names.resource_name = ?"
-    cur.execute(sql_query, (resource_name,))
-    data = cur.fetchone()
-    conn.close()
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "select resources_names.current_state from resources_names where resources_names.resource_name = ?"
+        cur.execute(sql_query, (resource_name,))
+        data = cur.fetchone()
     return data
 
 def update_resource_status(resource_name, resource_status, client_address):
@@ -39,28 +285,400 @@ def update_resource_status(resource_name, resource_status, client_address):
 
     :rtype: None
     """
-    conn = connect()
-    cur = conn.cursor()
-    sql_query = "update resources_names set current_state = ?, client_address = ? where resources_names.resource_name = ?"
-    cur.execute(sql_query,(resource_status, client_address, resource_name))
-    conn.commit()
-    conn.close()
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "update resources_names set current_state = ?, client_address = ? where resources_names.resource_name = ?"
+        cur.execute(sql_query,(resource_status, client_address, resource_name))
+        conn.commit()
+
+def get_resources():
+    """
+    select all the resources with their lock state
+
+    :rtype: 2 d tuple, (resource_id, resource_name, current_state, client_address, fencing_token)
+    """
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "select resource_id, resource_name, current_state, client_address, fencing_token from resources_names"
+        cur.execute(sql_query)
+        data = cur.fetchall()
+    return data
+
+def get_readers():
+    """
+    select the clients sharing every resource locked with lock_shared
+
+    :rtype: 2 d tuple, (resource_id, client_address)
+    """
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "select resource_id, client_address from resource_readers"
+        cur.execute(sql_query)
+        data = cur.fetchall()
+    return data
+
+def get_held_locks():
+    """
+    select the holder of every busy resource and every reader of every shared resource
+
+    :rtype: 2 d tuple, (resource_id, resource_name, client_address)
+    """
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "select resource_id, resource_name, client_address from resources_names where current_state = 'busy' union select distinct resources_names.resource_id, resources_names.resource_name, resource_readers.client_address from resources_names join resource_readers on resource_readers.resource_id = resources_names.resource_id where resources_names.current_state = 'shared'"
+        cur.execute(sql_query)
+        data = cur.fetchall()
+    return data
+
+def get_last_operation_type(resource_id, client_address):
+    """
+    get the type of the last operation of a client on a resource
+
+    :param int resource_id: the id of the resource
+    :param str client_address: the ip address of the client
+
+    :rtype: str or None if the client never operated on the resource
+    """
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "select operation_type from operations where resource_id = ? and client_ip_address = ? order by operation_id desc limit 1"
+        cur.execute(sql_query, (resource_id, client_address))
+        data = cur.fetchone()
+    if data is not None:
+        return data[0]
+    return None
+
+def get_readers_by_resourceName(resource_name):
+    """
+    get the client addresses sharing a given resource
+
+    :param str resource_name: a unique identifier for a resource
+
+    :rtype: tuple
+    """
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "select resource_readers.client_address from resource_readers join resources_names on resources_names.resource_id = resource_readers.resource_id where resources_names.resource_name = ?"
+        cur.execute(sql_query, (resource_name,))
+        data = cur.fetchall()
+    return tuple(row[0] for row in data)
+
+def write_lock_changes(states, operations, readers=(), numbered=False):
+    """
+    write a batch of lock state changes and their operations in a single transaction
+
+    :param list states: tuples of (current_state, client_address, fencing_token, resource_id)
+    :param list operations: tuples of (client_address, operation_time, operation_type, resource_id)
+    :param list readers: tuples of (resource_id, client_addresses) of the resources whose readers changed
+    :param bool numbered: True if every operation starts with its operation_id, an operation already
+        written with the same operation_id is skipped
+
+    :rtype: None
+    """
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "update resources_names set current_state = ?, client_address = ?, fencing_token = ? where resources_names.resource_id = ?"
+        cur.executemany(sql_query, states)
+        sql_query = "delete from resource_readers where resource_id = ?"
+        cur.executemany(sql_query, [(resource_id,) for resource_id, client_addresses in readers])
+        sql_query = "insert into resource_readers(resource_id, client_address) values(?, ?)"
+        cur.executemany(sql_query, [(resource_id, client_address) for resource_id, client_addresses in readers
+                                    for client_address in client_addresses])
+        if numbered:
+            sql_query = "insert or ignore into operations(operation_id, client_ip_address, operation_time, operation_type, resource_id) values(?, ?, ?, ?, ?)"
+        else:
+            sql_query = "insert into operations(client_ip_address, operation_time, operation_type, resource_id) values(?, ?, ?, ?)"
+        cur.executemany(sql_query, operations)
+        conn.commit()
+
+def get_last_operation_id():
+    """
+    get the highest operation_id ever given to an operations row, including the deleted rows
+
+    :rtype: int
+    """
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "select coalesce(max(seq), 0) from sqlite_sequence where name = 'operations'"
+        cur.execute(sql_query)
+        return cur.fetchone()[0]
+
+def write_snapshot(snapshot):
+    """
+    replace the lock state of all the resources in a single transaction, used by the followers
+    to store the lock state received from the leader
+
+    :param list snapshot: tuples of (resource_id, resource_name, current_state, client_address, readers, fencing_token)
+
+    :rtype: None
+    """
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "insert or replace into resources_names(resource_id, resource_name, current_state, client_address, fencing_token) values(?, ?, ?, ?, ?)"
+        cur.executemany(sql_query, [(resource_id, resource_name, state, client_address, token)
+                                    for resource_id, resource_name, state, client_address, readers, token in snapshot])
+        sql_query = "delete from resource_readers"
+        cur.execute(sql_query)
+        sql_query = "insert into resource_readers(resource_id, client_address) values(?, ?)"
+        cur.executemany(sql_query, [(resource_id, client_address)
+                                    for resource_id, resource_name, state, owner, readers, token in snapshot
+                                    for client_address in readers])
+        conn.commit()
+
+def log_operation(cur, resource_name, operation_time, operation_type, client_address):
+    """
+    store the operation of a lock state change that is being made by the cursor.
+    with the sync durability it is inserted in the same transaction, otherwise
+    it is handed over to the group commit writer
+
+    :param cur: the cursor of the transaction that changes the lock state
+    :param str resource_name: a unique identifier for a resource
+    :param str operation_time: time that this operation happened
+    :param str operation_type: the type of an operation, lock, lock_shared or release
+    :param str client_address: the ip address of the client
+
+    :rtype: int, the number of the batch of the group commit writer or None
+    """
+    if OPERATIONS_DURABILITY == "sync":
+        sql_query = "insert into operations(client_ip_address, operation_time, operation_type, resource_id) select ?, ?, ?, resource_id from resources_names where resources_names.resource_name = ?"
+        cur.execute(sql_query, (client_address, operation_time, operation_type, resource_name))
+        return None
+    sql_query = "select resources_names.resource_id from resources_names where resources_names.resource_name = ?"
+    cur.execute(sql_query, (resource_name,))
+    return operations_writer.append((client_address, operation_time, operation_type, cur.fetchone()[0]))
+
+def wait_for_operation(batch):
+    """
+    with the group durability wait until the batch of an operation is committed,
+    it has to be called after the lock state change is committed
+
+    :param int batch: the number of the batch returned by log_operation
+
+    :rtype: None
+    """
+    if OPERATIONS_DURABILITY == "group" and batch is not None:
+        operations_writer.wait(batch)
+
+def get_fencing_token(cur, resource_name):
+    """
+    read the fencing token of a resource just granted by an update. it is part of the transaction of the cursor,
+    so it is the token of this grant. it is read by a select instead of update ... returning, which needs sqlite 3.35
+
+    :param cur: the cursor of the transaction
+    :param str resource_name: a unique identifier for a resource
+
+    :rtype: int
+    """
+    sql_query = "select fencing_token from resources_names where resources_names.resource_name = ?"
+    cur.execute(sql_query, (resource_name,))
+    return cur.fetchone()[0]
+
+def acquire_resource(resource_name, client_address, operation_time):
+    """
+    lock a resource only if it is free and insert the lock operation, in a single transaction.
+    two clients can never lock the same resource because the update checks the status itself
+
+    :param str resource_name: a unique identifier for a resource
+    :param str client_address: the ip address of the client
+    :param str operation_time: time that this operation happened
+
+    :rtype: int, the fencing token of the lock or 0 if the resource is not locked by this call
+    """
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "update resources_names set current_state = 'busy', client_address = ?, fencing_token = fencing_token + 1 where resources_names.resource_name = ? and resources_names.current_state = 'free'"
+        cur.execute(sql_query, (client_address, resource_name))
+        acquired = 0
+        batch = None
+        if cur.rowcount == 1:
+            acquired = get_fencing_token(cur, resource_name)
+            batch = log_operation(cur, resource_name, operation_time, "lock", client_address)
+        conn.commit()
+    wait_for_operation(batch)
+    return acquired
+
+def acquire_shared_resource(resource_name, client_address, operation_time):
+    """
+    share a resource with its other readers if it is free or shared, add the client to its readers
+    and insert the lock_shared operation, in a single transaction
+
+    :param str resource_name: a unique identifier for a resource
+    :param str client_address: the ip address of the client
+    :param str operation_time: time that this operation happened
+
+    :rtype: int, the fencing token of the shared lock or 0 if the resource is not shared with the client by this call
+    """
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "update resources_names set current_state = 'shared', client_address = null, fencing_token = fencing_token + 1 where resources_names.resource_name = ? and resources_names.current_state in ('free', 'shared')"
+        cur.execute(sql_query, (resource_name,))
+        acquired = 0
+        batch = None
+        if cur.rowcount == 1:
+            acquired = get_fencing_token(cur, resource_name)
+            sql_query = "insert into resource_readers(resource_id, client_address) select resource_id, ? from resources_names where resources_names.resource_name = ?"
+            cur.execute(sql_query, (client_address, resource_name))
+            batch = log_operation(cur, resource_name, operation_time, "lock_shared", client_address)
+        conn.commit()
+    wait_for_operation(batch)
+    return acquired
+
+def release_reader(cur, resource_name, client_address):
+    """
+    remove the client from the readers of a shared resource, the resource becomes free
+    after its last reader is removed. it is part of the transaction of the cursor
+
+    :param cur: the cursor of the transaction
+    :param str resource_name: a unique identifier for a resource
+    :param str client_address: the ip address of the client
+
+    :rtype: bool, True if the client was one of the readers
+    """
+    sql_query = "delete from resource_readers where rowid = (select resource_readers.rowid from resource_readers join resources_names on resources_names.resource_id = resource_readers.resource_id where resources_names.resource_name = ? and resource_readers.client_address = ? limit 1)"
+    cur.execute(sql_query, (resource_name, client_address))
+    if cur.rowcount != 1:
+        return False
+    sql_query = "update resources_names set current_state = 'free' where resources_names.resource_name = ? and resources_names.current_state = 'shared' and not exists (select 1 from resource_readers where resource_readers.resource_id = resources_names.resource_id)"
+    cur.execute(sql_query, (resource_name,))
+    return True
+
+def release_resource(resource_name, client_address, operation_time):
+    """
+    release a resource only if it is locked or shared by the given client and insert the release operation,
+    in a single transaction.
+
+    :param str resource_name: a unique identifier for a resource
+    :param str client_address: the ip address of the client
+    :param str operation_time: time that this operation happened
+
+    :rtype: bool, True if the resource is released by this call
+    """
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "update resources_names set current_state = 'free', client_address = null where resources_names.resource_name = ? and resources_names.current_state = 'busy' and resources_names.client_address = ?"
+        cur.execute(sql_query, (resource_name, client_address))
+        released = cur.rowcount == 1 or release_reader(cur, resource_name, client_address)
+        batch = None
+        if released:
+            batch = log_operation(cur, resource_name, operation_time, "release", client_address)
+        conn.commit()
+    wait_for_operation(batch)
+    return released
+
+def acquire_resources(resource_names, client_address, operation_time):
+    """
+    lock all the given resources if all of them are free, otherwise none of them, in a single transaction.
+    the resources are updated in the given order so it has to be the same canonical order for every caller
+
+    :param list resource_names: the unique identifiers of the targeted resources
+    :param str client_address: the ip address of the client
+    :param str operation_time: time that this operation happened
+
+    :rtype: list, the fencing tokens of the locks in the same order, or False if the resources are not locked by this call
+    """
+    return change_resources(resource_names, client_address, operation_time, "lock")
+
+def release_resources(resource_names, client_address, operation_time):
+    """
+    release all the given resources if all of them are locked or shared by the given client, otherwise
+    none of them, in a single transaction.
+
+    :param list resource_names: the unique identifiers of the targeted resources
+    :param str client_address: the ip address of the client
+    :param str operation_time: time that this operation happened
+
+    :rtype: bool, True if all the resources are released by this call
+    """
+    return change_resources(resource_names, client_address, operation_time, "release")
+
+def change_resources(resource_names, client_address, operation_time, operation_type):
+    """
+    lock or release all the given resources or none of them, in a single transaction
+
+    :param list resource_names: the unique identifiers of the targeted resources
+    :param str client_address: the ip address of the client
+    :param str operation_time: time that this operation happened
+    :param str operation_type: the type of an operation, lock or release
+
+    :rtype: bool or the list of the fencing tokens of the locks, True or a list if all the resources are changed by this call
+    """
+    if operation_type == "lock":
+        sql_query = "update resources_names set current_state = 'busy', client_address = ?, fencing_token = fencing_token + 1 where resources_names.resource_name = ? and resources_names.current_state = 'free'"
+    else:
+        sql_query = "update resources_names set current_state = 'free', client_address = null where resources_names.client_address = ? and resources_names.resource_name = ? and resources_names.current_state = 'busy'"
+    batch = None
+    tokens = []
+    with checkout() as conn:
+        cur = conn.cursor()
+        for resource_name in resource_names:
+            cur.execute(sql_query, (client_address, resource_name))
+            if operation_type == "lock":
+                changed = cur.rowcount == 1
+                if changed:
+                    tokens.append(get_fencing_token(cur, resource_name))
+            else:
+                changed = cur.rowcount == 1 or release_reader(cur, resource_name, client_address)
+            if not changed:
+                # one of them is not available, undo the others
+                conn.rollback()
+                return False
+        for resource_name in resource_names:
+            batch = log_operation(cur, resource_name, operation_time, operation_type, client_address)
+        conn.commit()
+    wait_for_operation(batch)
+    if operation_type == "lock":
+        return tokens
+    return True
+
+def release_held_resources(held, client_address, operation_time):
+    """
+    release the resources a connection still holds after its client disconnected, in a single transaction.
+    only the held resources are visited instead of every resource of the client address
+
+    :param dict held: resource name -> number of times the connection holds the resource
+    :param str client_address: the ip address of the client
+    :param str operation_time: time that this operation happened
+
+    :rtype: list, names of the released resources
+    """
+    resource_names = []
+    batch = None
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "update resources_names set current_state = 'free', client_address = null where resources_names.resource_name = ? and resources_names.current_state = 'busy' and resources_names.client_address = ?"
+        for resource_name, count in sorted(held.items()):
+            released = 0
+            while released < count:
+                cur.execute(sql_query, (resource_name, client_address))
+                if cur.rowcount != 1 and not release_reader(cur, resource_name, client_address):
+                    break
+                released += 1
+            if released:
+                batch = log_operation(cur, resource_name, operation_time, "release", client_address)
+                resource_names.append(resource_name)
+        conn.commit()
+    wait_for_operation(batch)
+    return resource_names
 
 def release_resource_by_client_address(client_address):
     """
     given a client address then make this resource status is free,
     used to free the resource after the client disconnected.
+    the client is removed from the readers of the shared resources too
 
     :param str client_address: the ip address of the client
 
     :rtype: None
     """
-    conn = connect()
-    cur = conn.cursor()
-    sql_query = "update resources_names set current_state = ?, client_address = null where client_address = ?"
-    cur.execute(sql_query,("free", client_address))
-    conn.commit()
-    conn.close()
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "update resources_names set current_state = ?, client_address = null where client_address = ?"
+        cur.execute(sql_query,("free", client_address))
+        sql_query = "delete from resource_readers where client_address = ?"
+        cur.execute(sql_query, (client_address,))
+        sql_query = "update resources_names set current_state = 'free' where current_state = 'shared' and not exists (select 1 from resource_readers where resource_readers.resource_id = resources_names.resource_id)"
+        cur.execute(sql_query)
+        conn.commit()
 
 def get_client_address_by_resourceName(resource_name):
     """
@@ -70,12 +688,11 @@ def get_client_address_by_resourceName(resource_name):
 
     :rtype: tuple
     """
-    conn = connect()
-    cur = conn.cursor()
-    sql_query = "select resources_names.client_address from resources_names where resources_names.resource_name = ?"
-    cur.execute(sql_query, (resource_name,))
-    data = cur.fetchone()
-    conn.close()
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "select resources_names.client_address from resources_names where resources_names.resource_name = ?"
+        cur.execute(sql_query, (resource_name,))
+        data = cur.fetchone()
     return data
 
 def get_resource_id_by_name(resource_name):
@@ -86,12 +703,11 @@ def get_resource_id_by_name(resource_name):
 
     :rtype: tuple
     """
-    conn = connect()
-    cur = conn.cursor()
-    sql_query = "select resources_names.resource_id from resources_names where resources_names.resource_name = ?"
-    cur.execute(sql_query, (resource_name,))
-    data = cur.fetchone()
-    conn.close()
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "select resources_names.resource_id from resources_names where resources_names.resource_name = ?"
+        cur.execute(sql_query, (resource_name,))
+        data = cur.fetchone()
     return data
 
 def insert_operation(resource_id, operation_time, operation_type, client_address):
@@ -105,12 +721,16 @@ def insert_operation(resource_id, operation_time, operation_type, client_address
 
     :rtype: None
     """
-    conn = connect()
-    cur = conn.cursor()
-    sql_query = "insert into operations(client_ip_address, operation_time, operation_type, resource_id) values(?, ?, ?, ?)"
-    cur.execute(sql_query,(client_address, operation_time, operation_type, resource_id))
-    conn.commit()
-    conn.close()
+    if OPERATIONS_DURABILITY != "sync":
+        # the group commit writer inserts it
+        batch = operations_writer.append((client_address, operation_time, operation_type, resource_id))
+        wait_for_operation(batch)
+        return
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "insert into operations(client_ip_address, operation_time, operation_type, resource_id) values(?, ?, ?, ?)"
+        cur.execute(sql_query,(client_address, operation_time, operation_type, resource_id))
+        conn.commit()
 
 def delete_operation_by_resource_id(resource_id):
     """
@@ -120,29 +740,90 @@ def delete_operation_by_resource_id(resource_id):
 
     :rtype: None
     """
-    conn = connect()
-    cur = conn.cursor()
-    sql_query = "delete from operations where operations.resource_id = ?"
-    cur.execute(sql_query, (resource_id,))
-    conn.commit()
-    conn.close()
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "delete from operations where operations.resource_id = ?"
+        cur.execute(sql_query, (resource_id,))
+        conn.commit()
 
 def get_resource_ids_by_client_address(client_address):
     """
-    get all resources ids for a specific client ip address
+    get the ids of all the resources locked by a specific client ip address
 
     :param str client_address: the ip address of the client
 
     :rtype: 2 d tuple
     """
-    conn = connect()
-    cur = conn.cursor()
-    sql_query = "select resources_names.resource_id from resources_names where resources_names.client_address = ?"
-    cur.execute(sql_query, (client_address,))
-    data = cur.fetchall()
-    conn.close()
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "select resources_names.resource_id from resources_names where resources_names.client_address = ? and resources_names.current_state = 'busy'"
+        cur.execute(sql_query, (client_address,))
+        data = cur.fetchall()
+    return data
+
+def get_resources_by_client_address(client_address):
+    """
+    get the ids and names of all the resources locked or shared by a specific client ip address
+
+    :param str client_address: the ip address of the client
+
+    :rtype: 2 d tuple, (resource_id, resource_name)
+    """
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "select resources_names.resource_id, resources_names.resource_name from resources_names where resources_names.client_address = ? and resources_names.current_state = 'busy' union select distinct resources_names.resource_id, resources_names.resource_name from resources_names join resource_readers on resource_readers.resource_id = resources_names.resource_id where resource_readers.client_address = ?"
+        cur.execute(sql_query, (client_address, client_address))
+        data = cur.fetchall()
     return data
 
+def iter_operations(resource_id, since=None, after=None, client_address=None, operation_type=None, page=HISTORY_PAGE):
+    """
+    generate the operations of a resource in time order, reading page rows at a time.
+    the pages are read using keyset pagination over the (resource_id, operation_time) index,
+    so a long history is never loaded in memory and a connection is checked out only to read a page
+
+    :param str resource_id: a unique identifier for a resource
+    :param str since: the first operation_time to be generated, None to start from the oldest operation
+    :param int after: generate the operations that come after this operation_id only, UnknownOperation is raised
+        if it is not an operation of the resource instead of starting over from since
+    :param str client_address: generate the operations of this client only
+    :param str operation_type: generate the operations of this type only, like lock or release
+    :param int page: number of rows read by a single query
+
+    :rtype: generator of tuples (operation_id, operation_time, operation_type, client_ip_address)
+    """
+    # the last generated (operation_time, operation_id), the next page starts after it
+    last = (since or '', 0)
+    if after is not None:
+        with checkout() as conn:
+            cur = conn.cursor()
+            cur.execute("select operation_time from operations where operation_id = ? and resource_id = ?", (after, resource_id))
+            data = cur.fetchone()
+        if data is None:
+            raise UnknownOperation(after)
+        last = max(last, (data[0], after))
+
+    sql_query = "select operation_id, operation_time, operation_type, client_ip_address from operations where resource_id = ? and (operation_time, operation_id) > (?, ?)"
+    filters = []
+    if client_address is not None:
+        sql_query += " and client_ip_address = ?"
+        filters.append(client_address)
+    if operation_type is not None:
+        sql_query += " and operation_type = ?"
+        filters.append(operation_type)
+    sql_query += " order by operation_time, operation_id limit ?"
+
+    while True:
+        with checkout() as conn:
+            cur = conn.cursor()
+            cur.execute(sql_query, [resource_id, last[0], last[1]] + filters + [page])
+            rows = cur.fetchall()
+        for row in rows:
+            yield row
+        if len(rows) < page:
+            return
+        last = (rows[-1][1], rows[-1][0])
+
 def get_operations_by_resource_id(resource_id):
     """
     select operations information that related to specific resource.
@@ -151,10 +832,9 @@ def get_operations_by_resource_id(resource_id):
 
     :rtype: 2 d tuple, (client_ip_address, operation_time, operation_type)
     """
-    conn = connect()
-    cur = conn.cursor()
-    sql_query = "select client_ip_address, operation_time, operation_type from operations where resource_id = ?"
-    cur.execute(sql_query, (resource_id,))
-    data = cur.fetchall()
-    conn.close()
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "select client_ip_address, operation_time, operation_type from operations where resource_id = ?"
+        cur.execute(sql_query, (resource_id,))
+        data = cur.fetchall()
     return data
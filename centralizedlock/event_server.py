@@ -0,0 +1,471 @@
+"""
+this file contains an event driven implementation of the socket server.
+all the client connections are served from a single asyncore loop instead of a thread
+per connection, and the blocking database work is pushed to a small pool of worker threads.
+"""
+import asyncore
+import heapq
+import os
+import socket
+import threading
+import time
+from collections import deque
+from Queue import Queue
+from lock import Lock
+from metrics import metrics
+from protocol import *
+from settings import *
+from waiters import Waiter
+
+class EventLoop(object):
+    """
+    a poll based loop over the asyncore channels with timers and a wake up pipe
+    so the worker threads can hand their results back to the loop
+    """
+    def __init__(self):
+        """
+        the constructor of the class EventLoop
+        """
+        self.map = {}
+        self.timers = []
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        self.waker = Waker(self)
+
+    def call_later(self, delay, func, *args):
+        """
+        run func(*args) in the loop after delay secs
+
+        :param float delay: number of seconds to wait
+        :param function func: the function to be called
+
+        :rtype: None
+        """
+        heapq.heappush(self.timers, (time.time() + delay, func, args))
+
+    def call_soon_threadsafe(self, func, *args):
+        """
+        run func(*args) in the loop as soon as possible, can be called from any thread
+
+        :param function func: the function to be called
+
+        :rtype: None
+        """
+        with self.pending_lock:
+            # the loop is already woken up by the first callback it did not run yet
+            wake = not self.pending
+            self.pending.append((func, args))
+        if wake:
+            self.waker.wake()
+
+    def run_pending(self):
+        """
+        run the callbacks handed over by the other threads
+
+        :rtype: None
+        """
+        with self.pending_lock:
+            pending, self.pending = self.pending, []
+        for func, args in pending:
+            func(*args)
+
+    def run_timers(self):
+        """
+        run the timers that are due and return the number of seconds until the next one
+
+        :rtype: float or None
+        """
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, func, args = heapq.heappop(self.timers)
+            func(*args)
+        if self.timers:
+            return max(self.timers[0][0] - now, 0)
+        return None
+
+    def run(self):
+        """
+        keep polling the channels forever
+
+        :rtype: None
+        """
+        while True:
+            timeout = self.run_timers()
+            asyncore.poll2(timeout, self.map)
+            self.run_pending()
+
+class Waker(asyncore.file_dispatcher):
+    """
+    the read end of a pipe registered in the loop, writing to it wakes the loop up
+    """
+    def __init__(self, loop):
+        """
+        the constructor of the class Waker
+
+        :param EventLoop loop: the loop to be woken up
+        """
+        self.read_fd, self.write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self.read_fd, map=loop.map)
+        os.close(self.read_fd)
+
+    def wake(self):
+        """
+        wake the loop up
+
+        :rtype: None
+        """
+        os.write(self.write_fd, 'x')
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(RECV_BUFFER)
+
+class WorkerPool(object):
+    """
+    a bounded pool of threads that runs the blocking database work
+    """
+    def __init__(self, loop, size):
+        """
+        the constructor of the class WorkerPool
+
+        :param EventLoop loop: the loop that receives the results
+        :param int size: number of worker threads
+        """
+        self.loop = loop
+        self.tasks = Queue()
+        for i in range(size):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, callback, func, *args):
+        """
+        run func(*args) in a worker thread then call callback(result) in the loop
+
+        :param function callback: called in the loop with the result of func
+        :param function func: the blocking function to be run
+
+        :rtype: None
+        """
+        self.tasks.put((callback, func, args))
+
+    def work(self):
+        """
+        the body of every worker thread
+
+        :rtype: None
+        """
+        while True:
+            callback, func, args = self.tasks.get()
+            try:
+                result = func(*args)
+            except Exception as e:
+                print 'Worker failed: ' + repr(e)
+                result = e
+            self.loop.call_soon_threadsafe(callback, result)
+
+class ClientConnection(asyncore.dispatcher):
+    """
+    a single client connection, it runs one command at a time like the threaded server.
+    with the framed protocol the pipelined commands are queued and run in order
+    """
+    def __init__(self, server, conn, client_address):
+        """
+        the constructor of the class ClientConnection
+
+        :param LockServer server: the server that accepted the connection
+        :param socket conn: the accepted socket
+        :param str client_address: the ip address of the client
+        """
+        asyncore.dispatcher.__init__(self, conn, map=server.loop.map)
+        self.server = server
+        self.client_address = client_address
+        self.out_buffer = ''
+        self.in_progress = False
+        # the session of this connection, the resources it locks are released after the client disconnects
+        self.session = Session(client_address)
+        # the waiter of the current lock command while the resource is busy and its fence option
+        self.waiter = None
+        self.fence = None
+        # the reader of the framed protocol, None until the client switches to it
+        self.reader = None
+        # the frames waiting to be run and the request id of the running one
+        self.frames = deque()
+        self.request_id = None
+        self.running_frames = False
+        # the operation of the running command and the time it was received, None if it is not timed
+        self.operation = None
+        self.started = None
+        self.open = True
+        metrics.gauge("connections", 1)
+
+    def readable(self):
+        if self.reader is not None:
+            # keep reading pipelined frames while the queue is not full
+            return len(self.frames) < MAX_PIPELINE
+        # do not read the next message until the current one is answered
+        return not self.in_progress
+
+    def writable(self):
+        return len(self.out_buffer) > 0
+
+    def handle_read(self):
+        data = self.recv(RECV_BUFFER) #release or lock followed by the resource names
+        if not data:
+            # recv already closed the connection
+            return
+        if self.reader is None:
+            framed = switch_framed(data)
+            if framed is None and SHARD is not None:
+                #the router of the shards connects on behalf of its clients
+                proxy = switch_proxy(data, SHARD_SECRET)
+                if proxy is not None:
+                    self.client_address, framed = proxy
+                    self.session.client_address = self.client_address
+            if framed is None:
+                self.run_command(data)
+                return
+            #from now on the commands are pipelined frames and the events of the watched resources can be sent
+            self.out_buffer += FRAMED_ON + "\n"
+            self.reader = FrameReader()
+            self.session.push = self.push_event
+            data = framed
+        try:
+            self.frames.extend(self.reader.feed(data))
+        except ValueError:
+            #the frame is too long, send an error message and close the connection
+            self.frames.clear()
+            self.out_buffer += format_frame("-", FRAME_TOO_LONG)
+            self.handle_write()
+            self.handle_close()
+            return
+        self.run_frames()
+
+    def run_frames(self):
+        """
+        run the queued frames in order, one at a time
+
+        :rtype: None
+        """
+        if self.running_frames:
+            # a command finished inside this loop, the loop goes on with the next frame
+            return
+        self.running_frames = True
+        while not self.in_progress and self.frames and self.connected:
+            self.request_id, message = split_frame(self.frames.popleft())
+            self.run_command(message)
+        self.running_frames = False
+
+    def run_command(self, data):
+        """
+        parse a command and run it
+
+        :param str data: the command received from the client
+
+        :rtype: None
+        """
+        self.started = time.time()
+        message = parse_message(data)
+        if message is None:
+            #the message Received does not follow the correct format so send an error message
+            self.send_reply(WRONG_MESSAGE)
+            return
+        operation, resource_names, options = message
+        self.operation = operation
+        if operation == STATS:
+            self.send_reply(execute(operation, resource_names, self.client_address))
+            return
+        self.in_progress = True
+        if operation == HISTORY:
+            #the history is always read from the database so it never runs in the loop
+            self.server.pool.submit(lambda reply: self.on_executed(reply, resource_names),
+                                    history, resource_names[0], options)
+            return
+        if operation == STATUS:
+            self.server.run(lambda reply: self.on_executed(reply, []), status, resource_names[0])
+            return
+        if operation in (WATCH, UNWATCH):
+            self.server.run(lambda reply: self.on_executed(reply, []), watch, operation, resource_names[0], self.session)
+            return
+        waiter = Waiter(resource_names[0], self.client_address,
+                        lambda: self.server.loop.call_soon_threadsafe(self.end_wait, waiter),
+                        options.get("ttl"), operation == "lock_shared", self.session.session_id)
+        self.waiter = waiter
+        self.fence = options.get("fence")
+        self.server.run(lambda reply: self.on_executed(reply, resource_names), execute, operation, resource_names,
+                        self.client_address, waiter, options.get("ttl"), self.session.session_id, self.fence)
+
+    def on_executed(self, reply, resource_names):
+        """
+        called in the loop after the command is executed
+
+        :param str reply: the reply or None if the resource is busy
+        :param list resource_names: the unique identifiers of the targeted resources
+
+        :rtype: None
+        """
+        if isinstance(reply, Exception):
+            self.send_reply(SERVER_ERROR)
+            return
+        if reply is None:
+            # the resource is busy, wait until it is handed over or TIMEOUT secs pass without blocking the loop
+            self.server.loop.call_later(TIMEOUT, self.end_wait, self.waiter)
+            return
+        self.waiter = None
+        self.session.track(reply, resource_names)
+        if not self.connected:
+            # the client went away while the command was running
+            self.handle_close()
+            return
+        self.send_reply(reply)
+
+    def end_wait(self, waiter):
+        """
+        stop waiting for the resource and send the reply, called when the waiter is granted,
+        after TIMEOUT secs or after the client disconnected
+
+        :param Waiter waiter: the waiting client
+
+        :rtype: None
+        """
+        if waiter is not self.waiter:
+            # the wait is already finished
+            return
+        self.waiter = None
+        self.server.run(lambda reply: self.on_executed(reply, [waiter.resource_name]), finish_wait, waiter, self.fence)
+
+    def send_reply(self, reply):
+        """
+        queue the reply to be sent to the client
+
+        :param str reply: the message to be sent
+
+        :rtype: None
+        """
+        self.in_progress = False
+        if self.started is not None:
+            record(self.operation, reply, self.started)
+            self.operation = self.started = None
+        if not self.connected:
+            return
+        if self.reader is None:
+            self.out_buffer += reply
+            return
+        self.out_buffer += format_frame(self.request_id, reply)
+        self.run_frames()
+
+    def push_event(self, event):
+        """
+        queue an event of a watched resource to be sent to the client, can be called from any thread
+
+        :param str event: the event, like "released resourceX"
+
+        :rtype: None
+        """
+        self.server.loop.call_soon_threadsafe(self.send_event, event)
+
+    def send_event(self, event):
+        """
+        queue an event of a watched resource to be sent to the client, between the replies
+
+        :param str event: the event
+
+        :rtype: None
+        """
+        if self.connected:
+            self.out_buffer += format_frame(EVENT_ID, event)
+
+    def handle_write(self):
+        sent = self.send(self.out_buffer)
+        self.out_buffer = self.out_buffer[sent:]
+
+    def close(self):
+        if self.open:
+            self.open = False
+            metrics.gauge("connections", -1)
+        asyncore.dispatcher.close(self)
+
+    def handle_close(self):
+        self.close()
+        self.session.unwatch_all()
+        if self.waiter is not None:
+            # stop waiting, if the resource was handed over meanwhile it is released below
+            self.end_wait(self.waiter)
+        if self.session.held:
+            #release all the resources locked by this connection
+            self.server.run(lambda result: None, self.session.release)
+
+    def handle_error(self):
+        print 'Connection error with ' + self.client_address
+        self.handle_close()
+
+class LockServer(asyncore.dispatcher):
+    """
+    the listening socket of the event driven server
+    """
+    # the class of the accepted connections
+    connection_class = ClientConnection
+
+    def __init__(self, loop, pool, host, port):
+        """
+        the constructor of the class LockServer
+
+        :param EventLoop loop: the loop that serves the connections
+        :param WorkerPool pool: the pool that runs the database work
+        :param str host: the host name of the socket server
+        :param int port: the port number of the socket server
+        """
+        asyncore.dispatcher.__init__(self, map=loop.map)
+        self.loop = loop
+        self.pool = pool
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(LISTEN_BACKLOG)
+
+    def run(self, callback, func, *args):
+        """
+        run func(*args) then call callback(result) in the loop.
+        with the in memory lock table the commands only change memory so they run directly in the loop.
+        otherwise they run in the worker pool: without the lock table they run in the database, and with
+        the log storage every change is appended to the log and synced before it is answered
+
+        :param function callback: called in the loop with the result of func
+        :param function func: the function to be run
+
+        :rtype: None
+        """
+        if Lock.table is None or Lock.table.storage is not None:
+            self.pool.submit(callback, func, *args)
+            return
+        try:
+            result = func(*args)
+        except Exception as e:
+            print 'Command failed: ' + repr(e)
+            result = e
+        callback(result)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        conn, addr = pair
+        print 'Connected with ' + addr[0] + ':' + str(addr[1])
+        self.connection_class(self, conn, addr[0])
+
+def serve(host=HOST, port=PORT):
+    """
+    start the event driven socket server and serve the clients forever
+
+    :param str host: the host name of the socket server
+    :param int port: the port number of the socket server
+
+    :rtype: None
+    """
+    loop = EventLoop()
+    pool = WorkerPool(loop, WORKER_THREADS)
+    LockServer(loop, pool, host, port)
+    print 'Socket now listening'
+    loop.run()
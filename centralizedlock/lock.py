@@ -1,73 +1,442 @@
 """
 this file contains the implementation of the Lock class which is responsible for
-interacting with the database
+interacting with the backend of the lock state, or with the in memory lock table when the server installs one
 """
-from database_functions import *
+import time
+from backends import SqliteBackend
 from datetime import datetime
+from retention import get_last_archived_operation_type
+from timer_wheel import TimerWheel
+from waiters import WaitQueues
+from watchers import Watchers, format_event
 
 class Lock(object):
     """
     this class is responsible for lock or release resources
     """
-    def __init__(self, resource_name, client_address):
+    # the in memory lock table, when it is set it is the authority for the lock state
+    # and the database is written behind it
+    table = None
+
+    # where the lock state is kept when the lock table is not installed, see backends.py
+    backend = SqliteBackend()
+
+    # the FIFO queues of the clients waiting for busy resources
+    waiters = WaitQueues()
+
+    # the clients watching the lock state of the resources
+    watchers = Watchers()
+
+    # the timers that expire the leased locks and the timer of every lease by (resource name, client address, session)
+    timers = TimerWheel()
+    leases = {}
+
+    def __init__(self, resource_name, client_address, session=None):
         """
         the constructor of the class Lock
 
         :param str resource_name: a unique identifier for a resource
+        :param str client_address: the ip address of the client
+        :param int session: the session of the connection of the client. with the in memory lock table
+            a resource locked by a session can be released only by the same session,
+            None for every session of the client address
         """
         self.resource_name = resource_name
         self.client_address = client_address
+        self.session = session
+
+    @staticmethod
+    def store():
+        """
+        get the in memory lock table if it is installed, otherwise the backend
+
+        :rtype: LockTable or a backend of backends.py
+        """
+        if Lock.table is not None:
+            return Lock.table
+        return Lock.backend
 
     def check_status(self):
         """
-        get the status of a resource. free or busy
+        get the status of a resource. free, busy or shared
 
         :rtype: str
         """
-        status = get_resource_status(self.resource_name)
-        if status is not None:
-            return status[0]
-        else:
-            return None
+        return Lock.store().check_status(self.resource_name)
 
     def acquire(self):
         """
-        lock the selected resource
+        lock the selected resource if it is free, the status check, the update and
+        the operation row are done in a single transaction
 
-        :rtype: None
+        :rtype: int, the fencing token of the lock, it is higher than the token of every earlier grant of
+            the resource, or 0 if the lock is not acquired
+        """
+        token = Lock.store().acquire(self.resource_name, self.client_address, str(datetime.now()), self.session)
+        if token:
+            self.notify()
+        return token
+
+    def acquire_shared(self):
         """
-        update_resource_status(self.resource_name, "busy", self.client_address)
-        #insert row
-        resource_id = get_resource_id_by_name(self.resource_name)[0]
-        insert_operation(resource_id, str(datetime.now()), "lock", self.client_address)
+        share the selected resource with its other readers if it is free or shared, the status check,
+        the update and the operation row are done in a single transaction
+
+        :rtype: int, the fencing token of the shared lock or 0 if the shared lock is not acquired
+        """
+        token = Lock.store().acquire_shared(self.resource_name, self.client_address, str(datetime.now()), self.session)
+        if token:
+            self.notify()
+        return token
+
+    def acquire_or_wait(self, waiter):
+        """
+        lock the selected resource, or share it if the waiter is shared, if it is available
+        and nobody is waiting for it, otherwise put the waiter at the end of the queue of the resource.
+        so a reader never passes a waiting writer. the waiter is not queued if the resource is not listed
+
+        :param Waiter waiter: the client that waits for the resource if it is busy
+
+        :rtype: int, the fencing token of the lock or 0 if the lock is not acquired
+        """
+        with Lock.waiters.mutex:
+            if waiter.shared:
+                acquire = self.acquire_shared
+            else:
+                acquire = self.acquire
+            token = 0
+            if not Lock.waiters.has_waiters(self.resource_name):
+                token = acquire()
+            if token:
+                if waiter.ttl is not None:
+                    self.lease(waiter.ttl)
+                return token
+            if self.check_status() is not None:
+                Lock.waiters.append(waiter)
+            return 0
+
+    def cancel_wait(self, waiter):
+        """
+        stop waiting for the selected resource
+
+        :param Waiter waiter: the waiting client
+
+        :rtype: bool, False if the resource was already handed over to the waiter
+        """
+        with Lock.waiters.mutex:
+            cancelled = Lock.waiters.cancel(waiter)
+            if cancelled and not waiter.shared:
+                # the readers queued behind the writer that gave up may share the resource now
+                self.grant_next()
+            return cancelled
 
     def release(self):
         """
-        release the selected resource
+        release the selected resource if it is locked or shared by the same client, the ownership check,
+        the update and the operation row are done in a single transaction.
+        the resource is handed over to the first waiter immediately
 
-        :rtype: None
+        :rtype: bool, True if the lock is released
         """
-        update_resource_status(self.resource_name, "free", self.client_address)
-        #insert row
-        resource_id = get_resource_id_by_name(self.resource_name)[0]
-        insert_operation(resource_id, str(datetime.now()), "release", self.client_address)
+        with Lock.waiters.mutex:
+            released = Lock.store().release(self.resource_name, self.client_address, str(datetime.now()), self.session)
+            if released:
+                self.cancel_lease()
+                self.notify()
+                self.grant_next()
+        return released
 
     def release_by_client_address(self):
         """
-        release the selected resources related to the selected client ip address
+        release the selected resources related to the selected client ip address,
+        every released resource is handed over to its first waiter immediately
 
         :rtype: None
         """
-        release_resource_by_client_address(self.client_address)
-        #insert rows
-        resource_ids = get_resource_ids_by_client_address(self.client_address)
-        for resource_id in resource_ids:
-            insert_operation(resource_id[0], str(datetime.now()), "release", self.client_address)
+        with Lock.waiters.mutex:
+            resource_names = Lock.store().release_by_client_address(self.client_address, str(datetime.now()))
+            for resource_name in resource_names:
+                client_lock = Lock(resource_name, self.client_address)
+                client_lock.cancel_lease()
+                client_lock.notify()
+                client_lock.grant_next()
+
+    def grant_next(self):
+        """
+        hand the selected resource over to the first client waiting for it, or to all the readers
+        at the head of the queue, must be called holding the mutex of the waiters
+
+        :rtype: None
+        """
+        while True:
+            waiter = Lock.waiters.popleft(self.resource_name)
+            if waiter is None:
+                return
+            client_lock = Lock(self.resource_name, waiter.client_address, waiter.session)
+            if waiter.shared:
+                acquired = client_lock.acquire_shared()
+            else:
+                acquired = client_lock.acquire()
+            if not acquired:
+                # it is still shared by other readers or someone outside this server locked it meanwhile, keep waiting
+                Lock.waiters.appendleft(waiter)
+                return
+            if waiter.ttl is not None:
+                client_lock.lease(waiter.ttl)
+            waiter.token = acquired
+            waiter.grant()
+            next_waiter = Lock.waiters.peek(self.resource_name)
+            if not waiter.shared or next_waiter is None or not next_waiter.shared:
+                return
+
+    def lease(self, ttl):
+        """
+        release the selected resource after ttl milliseconds unless the lease is renewed or the resource
+        is released before, a new lease replaces the previous one. the client must hold the resource
+
+        :param int ttl: number of milliseconds the lock lasts
+
+        :rtype: None
+        """
+        with Lock.waiters.mutex:
+            self.cancel_lease()
+            key = (self.resource_name, self.client_address, self.session)
+            Lock.leases[key] = Lock.timers.schedule(ttl / 1000.0, self.expire)
+            if Lock.table is not None:
+                # the followers expire the lock at the same time after a failover
+                Lock.table.lease(key, time.time() + ttl / 1000.0)
+
+    def renew(self, ttl):
+        """
+        renew the lease of the selected resource if it is locked or shared by the same client
+
+        :param int ttl: number of milliseconds the lock lasts from now
+
+        :rtype: bool, True if the lease is renewed
+        """
+        with Lock.waiters.mutex:
+            if not self.holds():
+                return False
+            self.lease(ttl)
+            return True
+
+    def cancel_lease(self):
+        """
+        cancel the lease of the selected resource, must be called holding the mutex of the waiters.
+        a lock recovered when the server started belongs to every session of its client address, so it is the
+        one released by a session of the client and its grace lease is cancelled instead of the lease of the session
+
+        :rtype: None
+        """
+        key = (self.resource_name, self.client_address, None)
+        if key not in Lock.leases:
+            key = (self.resource_name, self.client_address, self.session)
+        timer = Lock.leases.pop(key, None)
+        if timer is not None:
+            Lock.timers.cancel(timer)
+            if Lock.table is not None:
+                Lock.table.lease(key, None)
+
+    def expire(self):
+        """
+        release the selected resource after its lease ended, called by the thread of the timer wheel
+
+        :rtype: None
+        """
+        with Lock.waiters.mutex:
+            timer = Lock.leases.get((self.resource_name, self.client_address, self.session))
+            if timer is None or timer.slot is not None:
+                # the lease was released or renewed meanwhile
+                return
+            print 'Lease expired on ' + self.resource_name + ' locked by ' + self.client_address
+            self.release()
+
+    def holds(self):
+        """
+        check if the selected resource is locked or shared by the client
+
+        :rtype: bool
+        """
+        return Lock.store().holds(self.resource_name, self.client_address, self.session)
+
+    @staticmethod
+    def acquire_many(resource_names, client_address, ttl=None, session=None):
+        """
+        lock all the given resources or none of them, in a single transaction.
+        the resources are locked in canonical order and none of them may have waiters
+
+        :param list resource_names: the unique identifiers of the targeted resources
+        :param str client_address: the ip address of the client
+        :param int ttl: number of milliseconds the locks last, None to keep them until released
+        :param int session: the session of the client
+
+        :rtype: list, the fencing tokens of the locks in the order of resource_names, or False if the resources are not locked
+        """
+        names = resource_names
+        resource_names = sorted(set(resource_names))
+        with Lock.waiters.mutex:
+            for resource_name in resource_names:
+                if Lock.waiters.has_waiters(resource_name):
+                    return False
+            acquired = Lock.store().acquire_many(resource_names, client_address, str(datetime.now()), session)
+            if not acquired:
+                return False
+            for resource_name in resource_names:
+                client_lock = Lock(resource_name, client_address, session)
+                if ttl is not None:
+                    client_lock.lease(ttl)
+                client_lock.notify()
+            tokens = dict(zip(resource_names, acquired))
+            return [tokens[resource_name] for resource_name in names]
+
+    @staticmethod
+    def release_many(resource_names, client_address, session=None):
+        """
+        release all the given resources or none of them, in a single transaction.
+        all of them must be locked by the same client, every released resource is
+        handed over to its first waiter immediately
+
+        :param list resource_names: the unique identifiers of the targeted resources
+        :param str client_address: the ip address of the client
+        :param int session: the session of the client or None for every session of its client address
+
+        :rtype: bool, True if all the resources are released
+        """
+        resource_names = sorted(set(resource_names))
+        with Lock.waiters.mutex:
+            released = Lock.store().release_many(resource_names, client_address, str(datetime.now()), session)
+            if released:
+                for resource_name in resource_names:
+                    client_lock = Lock(resource_name, client_address, session)
+                    client_lock.cancel_lease()
+                    client_lock.notify()
+                    client_lock.grant_next()
+        return released
+
+    @staticmethod
+    def release_session(held, client_address, session):
+        """
+        release the resources a session still holds after its client disconnected, in a single transaction.
+        only the held resources are visited, every released resource is handed over to its first waiter immediately
+
+        :param dict held: resource name -> number of times the session holds the resource
+        :param str client_address: the ip address of the client
+        :param int session: the session of the client
+
+        :rtype: list, names of the released resources
+        """
+        with Lock.waiters.mutex:
+            resource_names = Lock.store().release_session(held, client_address, session, str(datetime.now()))
+            for resource_name in resource_names:
+                client_lock = Lock(resource_name, client_address, session)
+                client_lock.cancel_lease()
+                client_lock.notify()
+                client_lock.grant_next()
+        return resource_names
+
+    @staticmethod
+    def recover(grace, leases=None, replicated=False):
+        """
+        reconcile the locks found held when the server starts or when a follower is promoted, their clients lost their
+        connections with the previous server. a lock with a lease of the previous server is kept until the lease ends.
+        a lock whose last operation of its holder is not a lock is a phantom and is released,
+        the others are released too or kept for a grace lease so their holders can finish and release them.
+        the last operation is looked up in the store then in the archive of the retention job
+
+        :param int grace: number of milliseconds the recovered locks last, None to release them all
+        :param dict leases: (resource name, client address) -> the time the lease of the lock ends in seconds since the epoch
+        :param bool replicated: True when the lock state is a copy of the one of a leader, the leader already released
+            its phantoms and the operations of the locks taken before the follower connected are not in its database,
+            so every lock is kept
+
+        :rtype: tuple of lists, the (resource_name, client_address) of the released locks and of the kept ones
+        """
+        released = []
+        kept = []
+        leases = leases or {}
+        for resource_id, resource_name, client_address in Lock.store().held_locks():
+            client_lock = Lock(resource_name, client_address)
+            if (resource_name, client_address) in leases:
+                client_lock.lease(max(0, (leases[(resource_name, client_address)] - time.time()) * 1000))
+                kept.append((resource_name, client_address))
+                continue
+            if grace is not None and (replicated or Lock.last_operation_type(resource_id, client_address) in ("lock", "lock_shared")):
+                client_lock.lease(grace)
+                kept.append((resource_name, client_address))
+                continue
+            while client_lock.release():
+                # the client shared it more than once
+                pass
+            released.append((resource_name, client_address))
+        return released, kept
+
+    @staticmethod
+    def last_operation_type(resource_id, client_address):
+        """
+        get the type of the last operation of a client on a resource, from the store or else from the archive
+
+        :param int resource_id: the id of the resource
+        :param str client_address: the ip address of the client
+
+        :rtype: str or None if the client never operated on the resource
+        """
+        operation_type = Lock.store().last_operation_type(resource_id, client_address)
+        if operation_type is None:
+            operation_type = get_last_archived_operation_type(resource_id, client_address)
+        return operation_type
+
+    def event(self):
+        """
+        describe the lock state of the selected resource and its holders, like "locked resourceX 127.0.0.1"
+
+        :rtype: str or None if the resource is not listed
+        """
+        state = self.check_status()
+        if state is None:
+            return None
+        return format_event(self.resource_name, state, self.get_client_address() if state != "free" else ())
+
+    def notify(self):
+        """
+        send the lock state of the selected resource to its watchers after it changed.
+        the changes are made holding the mutex of the waiters, so the watchers get the events in order
+
+        :rtype: None
+        """
+        if Lock.watchers.has_watchers(self.resource_name):
+            Lock.watchers.notify(self.resource_name, self.event())
+
+    def watch(self, send):
+        """
+        send the lock state of the selected resource to a watcher now and after every change
+
+        :param function send: called with every event of the resource, it must not block
+
+        :rtype: bool, False if the resource is not listed
+        """
+        with Lock.waiters.mutex:
+            event = self.event()
+            if event is None:
+                return False
+            Lock.watchers.watch(self.resource_name, send)
+            send(event)
+            return True
+
+    def unwatch(self, send):
+        """
+        stop sending the lock state of the selected resource to a watcher
+
+        :param function send: the function given to watch
+
+        :rtype: bool, False if the watcher was not watching the resource
+        """
+        return Lock.watchers.unwatch(self.resource_name, send)
 
     def get_client_address(self):
         """
-        get the client ip address that has locked the selected resource
+        get the client ip address that has locked the selected resource,
+        or the client ip addresses sharing it
 
         :rtype: tuple
         """
-        return get_client_address_by_resourceName(self.resource_name)
+        return Lock.store().get_client_address(self.resource_name)
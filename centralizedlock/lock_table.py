@@ -0,0 +1,671 @@
+"""
+this file contains the implementation of the in memory lock table.
+when the server installs it, it is the authority for the lock state and the
+database is only written behind it by a background flusher thread, or with the
+log storage every change is appended to the log before it is answered.
+every change is also handed over to the followers of the table, see replication.py.
+"""
+import sqlite3
+import threading
+import time
+from Queue import Queue, Empty
+from database_functions import *
+from settings import WRITE_BEHIND_BATCH, WRITE_BEHIND_RETRY, HISTORY_PAGE
+
+def same_session(owner, session):
+    """
+    check if a lock taken by the session owner belongs to the given session. a lock whose session is
+    not known, like a lock loaded from the database, belongs to every session of its client address
+
+    :param int owner: the session that took the lock or None
+    :param int session: the session of the client or None for every session of its client address
+
+    :rtype: bool
+    """
+    return owner is None or session is None or owner == session
+
+class ResourceEntry(object):
+    """
+    the lock state of a single resource
+    """
+    def __init__(self, resource_id, state, client_address, readers=None, token=0):
+        """
+        the constructor of the class ResourceEntry
+
+        :param int resource_id: the id of the resource in the database
+        :param str state: free, busy or shared
+        :param str client_address: the ip address of the client that locked the resource
+        :param list readers: the ip addresses of the clients sharing the resource, once per lock_shared
+        :param int token: the fencing token of the last grant of the resource
+        """
+        self.resource_id = resource_id
+        self.state = state
+        self.client_address = client_address
+        self.readers = readers or []
+        self.token = token
+        # the session that locked the resource and the session of every reader, they are not persisted
+        self.session = None
+        self.reader_sessions = [None] * len(self.readers)
+
+    def holder(self, client_address, session=None):
+        """
+        find the lock of the given client, must be called holding the mutex of the table
+
+        :param str client_address: the ip address of the client
+        :param int session: the session of the client or None for every session of its client address
+
+        :rtype: int, -1 if the client locked the resource, the index of the client in the readers if it
+            shares the resource or None if it does not hold the resource
+        """
+        if self.state == "busy":
+            if self.client_address == client_address and same_session(self.session, session):
+                return -1
+            return None
+        for index, reader in enumerate(self.readers):
+            if reader == client_address and same_session(self.reader_sessions[index], session):
+                return index
+        return None
+
+    def release(self, client_address, session=None):
+        """
+        release the resource if it is locked or shared by the given client, must be called holding the mutex of the table
+
+        :param str client_address: the ip address of the client
+        :param int session: the session of the client or None for every session of its client address
+
+        :rtype: bool, True if the resource is released by this call
+        """
+        index = self.holder(client_address, session)
+        if index is None:
+            return False
+        if index == -1:
+            self.state = "free"
+            self.client_address = None
+            self.session = None
+            return True
+        del self.readers[index]
+        del self.reader_sessions[index]
+        if not self.readers:
+            self.state = "free"
+        return True
+
+class LockTable(object):
+    """
+    resource name -> lock state, kept in memory and persisted asynchronously
+    """
+    def __init__(self, storage=None):
+        """
+        the constructor of the class LockTable
+
+        :param LogStorage storage: keeps the lock state instead of the rows of the database, see log_storage.py
+        """
+        self.storage = storage
+        self.entries = {}
+        # resource id -> resource name, for the changes received from the leader
+        self.names = {}
+        self.mutex = threading.Lock()
+        self.pending = Queue()
+        # the followers that receive the changes, and True while this table is a copy of a leader
+        self.followers = []
+        self.read_only = False
+        # (resource name, client address, session) -> the time the lease of the lock ends, sent to the followers
+        # with the changes so a promoted follower expires the leased locks when the leader would have
+        self.leases = {}
+
+    def load(self):
+        """
+        load the lock state of all the resources from the database, or from the storage
+
+        :rtype: None
+        """
+        if self.storage is not None:
+            entries = dict((resource_name, ResourceEntry(resource_id, state, client_address, readers, token))
+                           for resource_id, resource_name, state, client_address, readers, token in self.storage.load())
+            with self.mutex:
+                self.entries = entries
+                self.names = dict((entry.resource_id, resource_name) for resource_name, entry in entries.items())
+            return
+        readers = {}
+        for resource_id, client_address in get_readers():
+            readers.setdefault(resource_id, []).append(client_address)
+        entries = {}
+        for resource_id, resource_name, current_state, client_address, token in get_resources():
+            entries[resource_name] = ResourceEntry(resource_id, current_state, client_address, readers.get(resource_id), token)
+        with self.mutex:
+            self.entries = entries
+            self.names = dict((entry.resource_id, resource_name) for resource_name, entry in entries.items())
+
+    def count(self):
+        """
+        get the number of listed resources
+
+        :rtype: int
+        """
+        return len(self.entries)
+
+    def held_locks(self):
+        """
+        list the holder of every busy resource and every reader of every shared resource
+
+        :rtype: list of (resource_id, resource_name, client_address)
+        """
+        with self.mutex:
+            held = []
+            for resource_name, entry in self.entries.items():
+                if entry.state == "busy":
+                    held.append((entry.resource_id, resource_name, entry.client_address))
+                elif entry.state == "shared":
+                    held.extend((entry.resource_id, resource_name, reader) for reader in sorted(set(entry.readers)))
+            return held
+
+    def last_operation_type(self, resource_id, client_address):
+        """
+        get the type of the last operation of a client on a resource, after the queued changes are written
+
+        :param int resource_id: the id of the resource
+        :param str client_address: the ip address of the client
+
+        :rtype: str or None if the client never operated on the resource
+        """
+        self.flush()
+        if self.storage is not None:
+            with self.mutex:
+                return self.storage.last_operation_type(resource_id, client_address)
+        return get_last_operation_type(resource_id, client_address)
+
+    def get_resource_id(self, resource_name):
+        """
+        get the resource id of a given resource name
+
+        :param str resource_name: a unique identifier for a resource
+
+        :rtype: int or None if the resource is not listed
+        """
+        entry = self.entries.get(resource_name)
+        if entry is not None:
+            return entry.resource_id
+        return None
+
+    def iter_operations(self, resource_id, since=None, after=None, client_address=None, operation_type=None, page=HISTORY_PAGE):
+        """
+        generate the operations of a resource in time order after the queued changes are written. with the log storage
+        the ones moved to the database by the compactions come first then the ones still in the log,
+        see iter_operations of database_functions.py
+
+        :rtype: generator of tuples (operation_id, operation_time, operation_type, client_ip_address)
+        """
+        self.flush()
+        if self.storage is None:
+            for row in iter_operations(resource_id, since, after, client_address, operation_type, page):
+                yield row
+            return
+        with self.mutex:
+            rows = [(operation_id, operation_time, kind, client)
+                    for operation_id, client, operation_time, kind, operation_resource_id in self.storage.operations
+                    if operation_resource_id == resource_id]
+        last = None
+        if after is None or after not in [row[0] for row in rows]:
+            # the operations of the log come after all the ones of the database
+            for row in iter_operations(resource_id, since, after, client_address, operation_type, page):
+                last = (row[1], row[0])
+                yield row
+            after = None
+        for row in select_operations(rows, since, after, client_address, operation_type):
+            # a compaction that ran meanwhile moved the row to the database
+            if last is None or (row[1], row[0]) > last:
+                yield row
+
+    def start(self):
+        """
+        start the flusher thread that writes the changes to the database
+
+        :rtype: None
+        """
+        flusher = threading.Thread(target=self.flush_forever)
+        flusher.daemon = True
+        flusher.start()
+
+    def check_status(self, resource_name):
+        """
+        get the status of a resource. free, busy, shared or None if it is not listed
+
+        :param str resource_name: a unique identifier for a resource
+
+        :rtype: str
+        """
+        entry = self.entries.get(resource_name)
+        if entry is None:
+            return None
+        return entry.state
+
+    def get_client_address(self, resource_name):
+        """
+        get the client address that has locked a resource, shaped like the database row,
+        or the client addresses sharing it
+
+        :param str resource_name: a unique identifier for a resource
+
+        :rtype: tuple
+        """
+        entry = self.entries.get(resource_name)
+        if entry is None:
+            return None
+        if entry.state == "shared":
+            return tuple(entry.readers)
+        return (entry.client_address,)
+
+    def holds(self, resource_name, client_address, session=None):
+        """
+        check if a resource is locked or shared by the given client
+
+        :param str resource_name: a unique identifier for a resource
+        :param str client_address: the ip address of the client
+        :param int session: the session of the client or None for every session of its client address
+
+        :rtype: bool
+        """
+        with self.mutex:
+            entry = self.entries.get(resource_name)
+            return entry is not None and entry.holder(client_address, session) is not None
+
+    def acquire(self, resource_name, client_address, operation_time, session=None):
+        """
+        lock a resource if it is free
+
+        :param str resource_name: a unique identifier for a resource
+        :param str client_address: the ip address of the client
+        :param str operation_time: time that this operation happened
+        :param int session: the session of the client
+
+        :rtype: int, the fencing token of the lock or 0 if the resource is not locked by this call
+        """
+        with self.mutex:
+            entry = self.entries.get(resource_name)
+            if entry is None or entry.state != "free":
+                return 0
+            entry.state = "busy"
+            entry.client_address = client_address
+            entry.session = session
+            entry.token += 1
+            self.write_behind(entry, "lock", client_address, operation_time)
+            return entry.token
+
+    def acquire_shared(self, resource_name, client_address, operation_time, session=None):
+        """
+        share a resource with its other readers if it is free or shared
+
+        :param str resource_name: a unique identifier for a resource
+        :param str client_address: the ip address of the client
+        :param str operation_time: time that this operation happened
+        :param int session: the session of the client
+
+        :rtype: int, the fencing token of the shared lock or 0 if the resource is not shared with the client by this call
+        """
+        with self.mutex:
+            entry = self.entries.get(resource_name)
+            if entry is None or entry.state == "busy":
+                return 0
+            entry.state = "shared"
+            entry.readers.append(client_address)
+            entry.reader_sessions.append(session)
+            entry.token += 1
+            self.write_behind(entry, "lock_shared", client_address, operation_time, True)
+            return entry.token
+
+    def release(self, resource_name, client_address, operation_time, session=None):
+        """
+        release a resource if it is locked or shared by the given client
+
+        :param str resource_name: a unique identifier for a resource
+        :param str client_address: the ip address of the client
+        :param str operation_time: time that this operation happened
+        :param int session: the session of the client or None for every session of its client address
+
+        :rtype: bool, True if the resource is released by this call
+        """
+        with self.mutex:
+            entry = self.entries.get(resource_name)
+            if entry is None:
+                return False
+            shared = entry.state == "shared"
+            if not entry.release(client_address, session):
+                return False
+            self.write_behind(entry, "release", client_address, operation_time, shared)
+        return True
+
+    def acquire_many(self, resource_names, client_address, operation_time, session=None):
+        """
+        lock all the given resources if all of them are free, otherwise none of them
+
+        :param list resource_names: the unique identifiers of the targeted resources
+        :param str client_address: the ip address of the client
+        :param str operation_time: time that this operation happened
+        :param int session: the session of the client
+
+        :rtype: list, the fencing tokens of the locks in the same order, or False if the resources are not locked by this call
+        """
+        with self.mutex:
+            entries = [self.entries.get(resource_name) for resource_name in resource_names]
+            for entry in entries:
+                if entry is None or entry.state != "free":
+                    return False
+            for entry in entries:
+                entry.state = "busy"
+                entry.client_address = client_address
+                entry.session = session
+                entry.token += 1
+                self.write_behind(entry, "lock", client_address, operation_time)
+            return [entry.token for entry in entries]
+
+    def release_many(self, resource_names, client_address, operation_time, session=None):
+        """
+        release all the given resources if all of them are locked or shared by the given client, otherwise none of them
+
+        :param list resource_names: the unique identifiers of the targeted resources
+        :param str client_address: the ip address of the client
+        :param str operation_time: time that this operation happened
+        :param int session: the session of the client or None for every session of its client address
+
+        :rtype: bool, True if all the resources are released by this call
+        """
+        with self.mutex:
+            entries = [self.entries.get(resource_name) for resource_name in resource_names]
+            for entry in entries:
+                if entry is None or entry.holder(client_address, session) is None:
+                    return False
+            for entry in entries:
+                shared = entry.state == "shared"
+                entry.release(client_address, session)
+                self.write_behind(entry, "release", client_address, operation_time, shared)
+        return True
+
+    def release_session(self, held, client_address, session, operation_time):
+        """
+        release the resources a session still holds after its client disconnected, only the held resources
+        are visited and their changes are queued together so the flusher writes them in a single transaction
+
+        :param dict held: resource name -> number of times the session holds the resource
+        :param str client_address: the ip address of the client
+        :param int session: the session of the client
+        :param str operation_time: time that this operation happened
+
+        :rtype: list, names of the released resources
+        """
+        resource_names = []
+        with self.mutex:
+            for resource_name, count in held.items():
+                entry = self.entries.get(resource_name)
+                if entry is None:
+                    continue
+                shared = entry.state == "shared"
+                released = 0
+                while released < count and entry.release(client_address, session):
+                    released += 1
+                if released:
+                    self.write_behind(entry, "release", client_address, operation_time, shared)
+                    resource_names.append(resource_name)
+        return resource_names
+
+    def release_by_client_address(self, client_address, operation_time):
+        """
+        release all the resources locked or shared by the given client
+
+        :param str client_address: the ip address of the client
+        :param str operation_time: time that this operation happened
+
+        :rtype: list, names of the released resources
+        """
+        resource_names = []
+        with self.mutex:
+            for resource_name, entry in self.entries.items():
+                shared = entry.state == "shared"
+                if entry.release(client_address):
+                    while entry.release(client_address):
+                        # the client shared it more than once
+                        pass
+                    self.write_behind(entry, "release", client_address, operation_time, shared)
+                    resource_names.append(resource_name)
+        return resource_names
+
+    def write_behind(self, entry, operation_type, client_address, operation_time, shared=False):
+        """
+        queue a change to be written to the database by the flusher, must be called holding the mutex
+        so the changes are queued in the same order they are made
+
+        :param ResourceEntry entry: the changed resource
+        :param str operation_type: the type of an operation, lock, lock_shared or release
+        :param str client_address: the ip address of the client
+        :param str operation_time: time that this operation happened
+        :param bool shared: True if the change adds or removes a reader
+
+        :rtype: None
+        """
+        # the readers are written only when they change
+        readers = None
+        if shared:
+            readers = tuple(entry.readers)
+        self.queue_change((entry.resource_id, entry.state, entry.client_address, readers,
+                           (client_address, operation_time, operation_type, entry.resource_id), entry.token))
+
+    def queue_change(self, change):
+        """
+        queue a change for the flusher and the followers, must be called holding the mutex.
+        with the log storage the change is appended to the log instead, so it is durable before it is answered
+
+        :param tuple change: (resource_id, state, client_address, readers, operation, token)
+
+        :rtype: None
+        """
+        if self.storage is not None:
+            self.append(change)
+        else:
+            self.pending.put(change)
+        for follower in self.followers:
+            follower.send(change)
+
+    def append(self, change):
+        """
+        append a change to the log of the storage, must be called holding the mutex so the changes are appended in order
+
+        :param tuple change: (resource_id, state, client_address, readers, operation, token)
+
+        :rtype: None
+        """
+        resource_id, state, client_address, readers, operation, token = change
+        resource_readers = ()
+        if readers is not None:
+            resource_readers = ((resource_id, readers),)
+        self.storage.append(((state, client_address, token, resource_id),), (operation,), resource_readers)
+
+    def lease(self, key, expires):
+        """
+        record the end of the lease of a lock and send it to the followers
+
+        :param tuple key: (resource name, client address, session) of the lock
+        :param float expires: the time the lease ends in seconds since the epoch, None when the lease is cancelled
+
+        :rtype: None
+        """
+        with self.mutex:
+            if expires is None:
+                self.leases.pop(key, None)
+            else:
+                self.leases[key] = expires
+            for follower in self.followers:
+                follower.send_lease(list(key) + [expires])
+
+    def apply_lease(self, lease):
+        """
+        apply the end of a lease received from the leader
+
+        :param list lease: (resource name, client address, session, expires), see lease
+
+        :rtype: None
+        """
+        resource_name, client_address, session, expires = lease
+        self.lease((resource_name, client_address, session), expires)
+
+    def lease_ends(self):
+        """
+        get the time the leases of every client end, to expire them after the follower is promoted.
+        the sessions of the leader are lost with it, so a client with several leases on a resource keeps the latest one
+
+        :rtype: dict, (resource name, client address) -> the time the lease ends in seconds since the epoch
+        """
+        ends = {}
+        with self.mutex:
+            for (resource_name, client_address, session), expires in self.leases.items():
+                ends[(resource_name, client_address)] = max(expires, ends.get((resource_name, client_address), 0))
+        return ends
+
+    def add_follower(self, follower):
+        """
+        register a follower and return the lock state and the leases it starts from, the follower receives
+        every change and every lease made after it
+
+        :param follower: an object with send(change) and send_lease(lease) methods that must not block
+
+        :rtype: tuple, list of (resource_id, resource_name, state, client_address, readers, token) and
+            list of (resource_name, client_address, session, expires)
+        """
+        with self.mutex:
+            self.followers.append(follower)
+            snapshot = [(entry.resource_id, resource_name, entry.state, entry.client_address, list(entry.readers), entry.token)
+                        for resource_name, entry in self.entries.items()]
+            return snapshot, [list(key) + [expires] for key, expires in self.leases.items()]
+
+    def remove_follower(self, follower):
+        """
+        stop sending the changes to a follower
+
+        :param follower: a registered follower
+
+        :rtype: None
+        """
+        with self.mutex:
+            if follower in self.followers:
+                self.followers.remove(follower)
+
+    def load_snapshot(self, snapshot, leases=()):
+        """
+        replace the lock state and the leases by the ones received from the leader and write the lock state to the database
+
+        :param list snapshot: the lock state returned by add_follower of the leader
+        :param list leases: the leases returned by add_follower of the leader
+
+        :rtype: None
+        """
+        self.flush()
+        entries = {}
+        for resource_id, resource_name, state, client_address, readers, token in snapshot:
+            entries[resource_name] = ResourceEntry(resource_id, state, client_address, list(readers), token)
+        with self.mutex:
+            self.entries = entries
+            self.names = dict((entry.resource_id, resource_name) for resource_name, entry in entries.items())
+            self.leases = dict(((resource_name, client_address, session), expires)
+                               for resource_name, client_address, session, expires in leases)
+        if self.storage is not None:
+            self.storage.replace(snapshot)
+        else:
+            write_snapshot(snapshot)
+
+    def apply(self, change):
+        """
+        apply a change received from the leader
+
+        :param list change: (resource_id, state, client_address, readers, operation, token)
+
+        :rtype: None
+        """
+        resource_id, state, client_address, readers, operation, token = change
+        with self.mutex:
+            entry = self.entries[self.names[resource_id]]
+            entry.state = state
+            entry.client_address = client_address
+            entry.token = token
+            if readers is not None:
+                entry.readers = list(readers)
+                entry.reader_sessions = [None] * len(entry.readers)
+            entry.session = None
+            self.queue_change((resource_id, state, client_address, readers, tuple(operation), token))
+
+    def flush_forever(self):
+        """
+        the body of the flusher thread, it writes the queued changes in batches
+
+        :rtype: None
+        """
+        while True:
+            changes = [self.pending.get()]
+            # the changes queued meanwhile are written in the same transaction
+            while len(changes) < WRITE_BEHIND_BATCH:
+                try:
+                    changes.append(self.pending.get_nowait())
+                except Empty:
+                    break
+            self.write(changes)
+            for change in changes:
+                self.pending.task_done()
+
+    def write(self, changes):
+        """
+        write a batch of changes to the database, retry until the database accepts it
+
+        :param list changes: the changes queued by write_behind
+
+        :rtype: None
+        """
+        # only the last state and the last readers of every resource are written
+        states = {}
+        readers = {}
+        operations = []
+        for resource_id, state, client_address, resource_readers, operation, token in changes:
+            states[resource_id] = (state, client_address, token, resource_id)
+            if resource_readers is not None:
+                readers[resource_id] = resource_readers
+            operations.append(operation)
+
+        while True:
+            try:
+                write_lock_changes(states.values(), operations, readers.items())
+                return
+            except (sqlite3.Error, EnvironmentError) as e:
+                print 'Write behind failed: ' + str(e)
+                time.sleep(WRITE_BEHIND_RETRY)
+
+    def flush(self):
+        """
+        wait until all the queued changes are written to the database
+
+        :rtype: None
+        """
+        self.pending.join()
+
+def select_operations(rows, since=None, after=None, client_address=None, operation_type=None):
+    """
+    generate the operations kept in memory in time order, with the filters of iter_operations of database_functions.py
+
+    :param list rows: tuples of (operation_id, operation_time, operation_type, client_ip_address) of a resource
+    :param str since: the first operation_time to be generated, None to start from the oldest operation
+    :param int after: generate the operations that come after this operation_id only, UnknownOperation is raised
+        if it is not one of the rows
+    :param str client_address: generate the operations of this client only
+    :param str operation_type: generate the operations of this type only, like lock or release
+
+    :rtype: generator of tuples (operation_id, operation_time, operation_type, client_ip_address)
+    """
+    rows = sorted(rows, key=lambda row: (row[1], row[0]))
+    last = (since or '', 0)
+    if after is not None:
+        found = [row for row in rows if row[0] == after]
+        if not found:
+            raise UnknownOperation(after)
+        last = max(last, (found[0][1], after))
+    for row in rows:
+        if (row[1], row[0]) <= last:
+            continue
+        if client_address is not None and row[3] != client_address:
+            continue
+        if operation_type is not None and row[2] != operation_type:
+            continue
+        yield row
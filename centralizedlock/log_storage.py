@@ -0,0 +1,258 @@
+"""
+this file contains the log storage of the in memory lock table, it is used instead of updating the rows
+of the resources when lock_backend is "log". every change of the lock table is appended to a memory mapped log
+as a single record before it is answered, so a change costs a sequential write instead of a transaction.
+
+the log is compacted when it is full or LOG_COMPACT_INTERVAL secs after the previous compaction: the lock state
+and the operations of the log are written to the database in a single transaction, the lock state is written
+to the snapshot file and the log starts over with its next generation. on start the lock state is recovered
+from the snapshot and the records of the log written after it.
+
+the log starts with its generation, then every record is
+    length (4 bytes) crc32 of the payload and the generation (4 bytes) payload (length bytes of json)
+a record torn by a crash, or left by an older generation, fails its crc and ends the log.
+"""
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import time
+import zlib
+from database_functions import get_resources, get_readers, get_last_operation_id, get_last_operation_type, write_lock_changes
+from metrics import metrics
+from settings import LOG_NAME, SNAPSHOT_NAME, LOG_SIZE, LOG_COMPACT_INTERVAL, LOG_SYNC
+
+# the beginning of the log file, followed by its generation
+MAGIC = "CLLOG001"
+LOG_HEADER = struct.Struct("<8sQ")
+
+# the header of every record
+RECORD_HEADER = struct.Struct("<II")
+
+class LogStorage(object):
+    """
+    the lock state of all the resources kept in a memory mapped log and a snapshot
+    """
+    def __init__(self, log_name=LOG_NAME, snapshot_name=SNAPSHOT_NAME, size=LOG_SIZE,
+                 compact_interval=LOG_COMPACT_INTERVAL, sync=LOG_SYNC):
+        """
+        the constructor of the class LogStorage
+
+        :param str log_name: the log file
+        :param str snapshot_name: the snapshot file
+        :param int size: size of the log in bytes
+        :param float compact_interval: maximum number of seconds between two compactions of a log that is not empty
+        :param bool sync: flush every record to the disk before the next one
+        """
+        self.log_name = log_name
+        self.snapshot_name = snapshot_name
+        self.size = size
+        self.compact_interval = compact_interval
+        self.sync = sync
+        # resource id -> [resource_name, state, client_address, readers, token]
+        self.resources = {}
+        # the operations appended since the last compaction, they start with their operation_id
+        self.operations = []
+        self.next_operation_id = 1
+        self.generation = 0
+        self.offset = LOG_HEADER.size
+        self.compacted_at = time.time()
+        self.log = None
+
+    def load(self):
+        """
+        recover the lock state from the snapshot and the log, the resources missing from the snapshot
+        are read from the database
+
+        :rtype: list of (resource_id, resource_name, state, client_address, readers, token)
+        """
+        generation = 0
+        if os.path.exists(self.snapshot_name):
+            with open(self.snapshot_name, "rb") as snapshot:
+                data = json.load(snapshot)
+            generation = data["generation"]
+            for resource_id, resource_name, state, client_address, readers, token in data["resources"]:
+                self.resources[resource_id] = [resource_name, state, client_address, readers, token]
+
+        # the resources added to the database after the snapshot
+        readers = {}
+        for resource_id, client_address in get_readers():
+            readers.setdefault(resource_id, []).append(client_address)
+        for resource_id, resource_name, state, client_address, token in get_resources():
+            if resource_id not in self.resources:
+                self.resources[resource_id] = [resource_name, state, client_address, readers.get(resource_id, []), token]
+
+        self.open_log()
+        if self.generation > generation:
+            for payload in self.read_records():
+                self.apply(payload)
+        else:
+            # the log was compacted into the snapshot before it started over
+            self.reset(generation + 1)
+        last_operation_id = get_last_operation_id()
+        if self.operations:
+            last_operation_id = max(last_operation_id, self.operations[-1][0])
+        self.next_operation_id = last_operation_id + 1
+        metrics.probe("log_bytes", lambda: self.offset)
+        return [(resource_id, resource_name, state, client_address, list(resource_readers), token)
+                for resource_id, (resource_name, state, client_address, resource_readers, token) in self.resources.items()]
+
+    def open_log(self):
+        """
+        map the log file into memory, a missing log is created empty
+
+        :rtype: None
+        """
+        if not os.path.exists(self.log_name) or os.path.getsize(self.log_name) < self.size:
+            with open(self.log_name, "ab") as log:
+                log.truncate(self.size)
+        with open(self.log_name, "r+b") as log:
+            self.log = mmap.mmap(log.fileno(), self.size)
+        magic, self.generation = LOG_HEADER.unpack_from(self.log, 0)
+        if magic != MAGIC:
+            self.reset(1)
+
+    def read_records(self):
+        """
+        generate the payloads of the valid records of the log and move the offset after them
+
+        :rtype: generator of dict
+        """
+        self.offset = LOG_HEADER.size
+        while self.offset + RECORD_HEADER.size <= self.size:
+            length, crc = RECORD_HEADER.unpack_from(self.log, self.offset)
+            start = self.offset + RECORD_HEADER.size
+            if length == 0 or start + length > self.size:
+                return
+            payload = self.log[start:start + length]
+            if zlib.crc32(payload, self.generation) & 0xffffffff != crc:
+                return
+            self.offset = start + length
+            yield json.loads(payload)
+
+    def apply(self, payload):
+        """
+        apply a record to the lock state
+
+        :param dict payload: the changes of the record
+
+        :rtype: None
+        """
+        for state, client_address, token, resource_id in payload["states"]:
+            resource = self.resources[resource_id]
+            resource[1] = state
+            resource[2] = client_address
+            resource[4] = token
+        for resource_id, readers in payload["readers"]:
+            self.resources[resource_id][3] = list(readers)
+        self.operations.extend(tuple(operation) for operation in payload["operations"])
+
+    def last_operation_type(self, resource_id, client_address):
+        """
+        get the type of the last operation of a client on a resource, from the log or else from the database
+
+        :param int resource_id: the id of the resource
+        :param str client_address: the ip address of the client
+
+        :rtype: str or None if the client never operated on the resource
+        """
+        for operation_id, client, operation_time, operation_type, operation_resource_id in reversed(self.operations):
+            if operation_resource_id == resource_id and client == client_address:
+                return operation_type
+        return get_last_operation_type(resource_id, client_address)
+
+    def append(self, states, operations, readers=()):
+        """
+        append a batch of lock state changes and their operations to the log as a single record,
+        the log is compacted first if the record does not fit
+
+        :param list states: tuples of (current_state, client_address, fencing_token, resource_id)
+        :param list operations: tuples of (client_address, operation_time, operation_type, resource_id)
+        :param list readers: tuples of (resource_id, client_addresses) of the resources whose readers changed
+
+        :rtype: None
+        """
+        numbered = []
+        for operation in operations:
+            numbered.append((self.next_operation_id,) + tuple(operation))
+            self.next_operation_id += 1
+        payload = {"states": list(states), "operations": numbered, "readers": [list(item) for item in readers]}
+        data = json.dumps(payload, separators=(",", ":"))
+        if self.offset + RECORD_HEADER.size + len(data) > self.size:
+            self.compact()
+            if LOG_HEADER.size + RECORD_HEADER.size + len(data) > self.size:
+                raise IOError("the changes do not fit in the log")
+
+        with metrics.timed("log_append"):
+            RECORD_HEADER.pack_into(self.log, self.offset, len(data), zlib.crc32(data, self.generation) & 0xffffffff)
+            start = self.offset + RECORD_HEADER.size
+            self.log[start:start + len(data)] = data
+            if self.sync:
+                self.log.flush()
+        self.offset = start + len(data)
+        self.apply(payload)
+
+        if time.time() - self.compacted_at >= self.compact_interval:
+            try:
+                self.compact()
+            except (sqlite3.Error, EnvironmentError) as e:
+                # the record is already in the log, the compaction is tried again after the next one
+                print 'Log compaction failed: ' + str(e)
+
+    def compact(self):
+        """
+        write the lock state and the operations of the log to the database and the snapshot, then start
+        the log over. a crash in the middle leaves the log to be replayed again, the operations already
+        written to the database are skipped by their operation_id
+
+        :rtype: None
+        """
+        with metrics.timed("log_compact"):
+            states = [(state, client_address, token, resource_id)
+                      for resource_id, (resource_name, state, client_address, readers, token) in self.resources.items()]
+            readers = [(resource_id, resource_readers)
+                       for resource_id, (resource_name, state, client_address, resource_readers, token) in self.resources.items()]
+            write_lock_changes(states, self.operations, readers, numbered=True)
+
+            data = json.dumps({
+                "generation": self.generation,
+                "resources": [(resource_id, resource_name, state, client_address, resource_readers, token)
+                              for resource_id, (resource_name, state, client_address, resource_readers, token) in self.resources.items()],
+            })
+            temporary_name = self.snapshot_name + ".tmp"
+            with open(temporary_name, "wb") as snapshot:
+                snapshot.write(data)
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.rename(temporary_name, self.snapshot_name)
+
+            self.reset(self.generation + 1)
+        self.operations = []
+        self.compacted_at = time.time()
+
+    def reset(self, generation):
+        """
+        start the log over with a new generation, the records of the previous generations fail their crc
+
+        :param int generation: the generation of the log
+
+        :rtype: None
+        """
+        self.generation = generation
+        LOG_HEADER.pack_into(self.log, 0, MAGIC, generation)
+        RECORD_HEADER.pack_into(self.log, LOG_HEADER.size, 0, 0)
+        self.log.flush()
+        self.offset = LOG_HEADER.size
+
+    def replace(self, snapshot):
+        """
+        replace the lock state by a snapshot received from the leader of the replication and compact it
+
+        :param list snapshot: tuples of (resource_id, resource_name, state, client_address, readers, token)
+
+        :rtype: None
+        """
+        self.resources = dict((resource_id, [resource_name, state, client_address, list(readers), token])
+                              for resource_id, resource_name, state, client_address, readers, token in snapshot)
+        self.compact()
@@ -0,0 +1,188 @@
+"""
+this file contains the instrumentation of the server: counters, gauges and latency histograms.
+all of them are kept in memory by the metrics object of this file and sent to the clients by
+the stats command as a single line of json.
+
+the histograms count the latencies in fixed buckets, so observing a latency is O(1) and the
+percentiles are estimated from the bucket bounds.
+"""
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# the upper bounds of the buckets of the latency histograms in milliseconds, the last bucket has no bound
+HISTOGRAM_BOUNDS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+class Histogram(object):
+    """
+    a latency histogram with fixed buckets
+    """
+    def __init__(self):
+        """
+        the constructor of the class Histogram
+        """
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, milliseconds):
+        """
+        count a latency, must be called holding the mutex of the metrics
+
+        :param float milliseconds: the latency
+
+        :rtype: None
+        """
+        bucket = 0
+        while bucket < len(HISTOGRAM_BOUNDS) and milliseconds > HISTOGRAM_BOUNDS[bucket]:
+            bucket += 1
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += milliseconds
+        self.max = max(self.max, milliseconds)
+
+    def percentile(self, fraction):
+        """
+        estimate a percentile by the upper bound of the bucket that holds it
+
+        :param float fraction: the percentile between 0 and 1, for example 0.99
+
+        :rtype: float or None
+        """
+        if not self.count:
+            return None
+        rank = max(int(fraction * self.count + 0.5), 1)
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                break
+        if bucket < len(HISTOGRAM_BOUNDS):
+            return round(min(HISTOGRAM_BOUNDS[bucket], self.max), 3)
+        return round(self.max, 3)
+
+    def to_dict(self):
+        """
+        the summary of the histogram sent by the stats command
+
+        :rtype: dict
+        """
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count, 3) if self.count else None,
+            "p50_ms": self.percentile(0.5),
+            "p99_ms": self.percentile(0.99),
+            "p999_ms": self.percentile(0.999),
+            "max_ms": round(self.max, 3),
+            "buckets": dict((str(bound), count) for bound, count in zip(HISTOGRAM_BOUNDS + ("inf",), self.counts)),
+        }
+
+class Metrics(object):
+    """
+    the counters, gauges and histograms of the server, they can be updated from any thread
+    """
+    def __init__(self):
+        """
+        the constructor of the class Metrics
+        """
+        self.started_at = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        # name -> function that returns the current value of a gauge kept by another object
+        self.probes = {}
+        self.mutex = threading.Lock()
+
+    def increment(self, name, count=1):
+        """
+        add to a counter
+
+        :param str name: the name of the counter
+        :param int count: the number to be added
+
+        :rtype: None
+        """
+        with self.mutex:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def gauge(self, name, delta):
+        """
+        move a gauge up or down, like the number of open connections
+
+        :param str name: the name of the gauge
+        :param int delta: the number to be added, negative to move it down
+
+        :rtype: None
+        """
+        with self.mutex:
+            self.gauges[name] = self.gauges.get(name, 0) + delta
+
+    def probe(self, name, func):
+        """
+        register a gauge whose value is read by func() when the stats are taken
+
+        :param str name: the name of the gauge
+        :param function func: returns the current value of the gauge
+
+        :rtype: None
+        """
+        self.probes[name] = func
+
+    def observe(self, name, seconds):
+        """
+        add a latency to a histogram
+
+        :param str name: the name of the histogram
+        :param float seconds: the latency
+
+        :rtype: None
+        """
+        with self.mutex:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds * 1000)
+
+    @contextmanager
+    def timed(self, name):
+        """
+        add the time spent in the with block to a histogram
+
+        :param str name: the name of the histogram
+
+        :rtype: None
+        """
+        began = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - began)
+
+    def snapshot(self):
+        """
+        take the current values of all the metrics
+
+        :rtype: dict
+        """
+        gauges = dict((name, func()) for name, func in self.probes.items())
+        with self.mutex:
+            gauges.update(self.gauges)
+            return {
+                "uptime": round(time.time() - self.started_at, 3),
+                "counters": dict(self.counters),
+                "gauges": gauges,
+                "histograms": dict((name, histogram.to_dict()) for name, histogram in self.histograms.items()),
+            }
+
+    def to_json(self):
+        """
+        the reply of the stats command, a single line of json
+
+        :rtype: str
+        """
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+# the metrics of this process
+metrics = Metrics()
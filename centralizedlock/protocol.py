@@ -0,0 +1,571 @@
+"""
+this file contains the commands that the socket server understands, it parses the
+received messages and runs them against the Lock class.
+it is shared between the threaded and the event driven socket servers.
+
+by default every received message is a single command and its reply is sent without
+a delimiter. a client can send the message "framed" to switch its connection to the
+framed protocol, then every command is a line "<request_id> <command>\n" and every
+reply is a line "<request_id> <reply>\n", so many commands can be pipelined and
+their replies come back in order.
+
+"lock_shared <resource_name>" shares a resource with the other readers, it waits while the resource
+is locked or a lock command is waiting for it. "release" releases both kinds of locks.
+
+a lock or lock_shared command can end with the option ttl=<ms>, then the lock is a lease that is released
+by the server after ttl milliseconds unless the client renews it with "renew <resource_name> ttl=<ms>".
+
+every grant increments the fencing token of the resource, so a later lock of a resource always has a higher token.
+a lock or lock_shared command can end with the option fence=1, then the token is sent at the end of the grant,
+"You have an exclusive access to resource resourceX token=42", or a token per resource in the order of the
+command for many resources, "token=42,7". the holder passes it to the storage it writes, which refuses the writes
+with a token lower than the highest one it has seen, so a client whose lock expired while it was paused cannot
+overwrite the writes of the next holder.
+
+"status <resource_name>" replies with the lock state of a resource and its holders, in the words of the events
+below: "locked resourceX 127.0.0.1", "shared resourceX 127.0.0.1,127.0.0.2" or "released resourceX".
+
+"watch <resource_name>" sends the events of a resource over a framed connection until "unwatch <resource_name>"
+or until the connection is closed. the events are frames with the request id *, the first one is the current state
+then one is sent after every change: "* locked resourceX 127.0.0.1", "* shared resourceX 127.0.0.1,127.0.0.2"
+and "* released resourceX". they are sent between the replies, so a client tells them apart by their request id.
+
+"stats" replies with the counters, gauges and latency histograms of the server as a single line of json.
+
+"history <resource_name>" replies with the oldest operations of a resource as a single line of json
+{"operations": [[operation_id, operation_time, operation_type, client_address], ...], "next": operation_id}.
+it takes the options since=<operation_time>, limit=<n>, client=<ip address>, type=<operation_type> and after=<next>,
+the next page of the same query is read by sending it again with after set to the next of the previous reply,
+an after that is no longer in the history, like an operation moved to the archive, is refused.
+a time can be written with a T instead of the space, like 2017-01-31T10:00:00, next is null on the last page.
+"""
+import hmac
+import itertools
+import json
+import time
+from collections import Counter
+from database_functions import UnknownOperation
+from lock import Lock
+from metrics import metrics
+from settings import MAX_FRAME, HISTORY_LIMIT, HISTORY_MAX_LIMIT
+
+# error message sent back when the received message does not follow the format
+WRONG_MESSAGE = "wrong message, you must send release or lock as the first word then space then the resource_name"
+
+# reply sent when the resource is not listed in the database
+NOT_LISTED = "required resource is not listed"
+
+# reply sent when the client tries to release a free resource
+ALREADY_FREE = "resource is already free."
+
+# reply sent when the client tries to release a resource locked by another client
+NOT_ALLOWED = 'it is not allowed to release someone else resource'
+
+# error message sent back when the server fails to run the command
+SERVER_ERROR = "server error, try again later"
+
+# the beginning of the reply sent when the client gains access to a resource
+GRANTED = "You have an exclusive access to resource "
+
+# reply sent when the resource is still busy after waiting TIMEOUT secs
+BUSY = "required resource is busy now, you have to wait a while"
+
+# the beginning of the reply sent when the client gains shared access to a resource
+GRANTED_SHARED = "You have a shared access to resource "
+
+# the beginning of the reply sent when the client releases a resource
+RELEASED = "lock released from resource "
+
+# the beginning of the reply sent when the client renews the lease of a resource
+RENEWED = "lease renewed for resource "
+
+# message that asks for the metrics of the server
+STATS = "stats"
+
+# the operation that reads the operations of a resource
+HISTORY = "history"
+
+# the operation that reads the lock state of a resource
+STATUS = "status"
+
+# the operations that start and stop watching a resource
+WATCH = "watch"
+UNWATCH = "unwatch"
+
+# the beginning of the replies of watch and unwatch
+WATCHING = "watching resource "
+UNWATCHED = "stopped watching resource "
+
+# reply sent to unwatch when the connection does not watch the resource
+NOT_WATCHING = "resource is not watched"
+
+# reply sent to watch before the connection switches to the framed protocol
+WATCH_FRAMED = "watch needs the framed protocol, send framed first"
+
+# the request id of the frames of the events sent to the watchers
+EVENT_ID = "*"
+
+# the options accepted by every operation
+OPTIONS = {
+    "lock": ("ttl", "fence"),
+    "lock_shared": ("ttl", "fence"),
+    "release": (),
+    "renew": ("ttl",),
+    HISTORY: ("since", "after", "limit", "client", "type"),
+    STATUS: (),
+    WATCH: (),
+    UNWATCH: (),
+}
+
+# the options whose value is a positive number
+NUMBER_OPTIONS = ("ttl", "after", "limit", "fence")
+
+# message that switches a connection to the framed protocol and its reply
+FRAMED = "framed"
+FRAMED_ON = "framed protocol on"
+
+# reply sent to history when its after option is not an operation of the resource, like an operation moved to the archive
+UNKNOWN_AFTER = "unknown after, the operation is not in the history of the resource"
+
+# reply sent by a follower of the replication, it does not accept the commands until it is promoted
+READ_ONLY = "this server is a follower, send the commands to the leader"
+
+# message sent by the shard router to open a framed connection to a shard on behalf of a client,
+# it is followed by the ip address of the client and the secret the router gave to its shards
+PROXY = "proxy"
+
+# reply sent by the shard router when the resources of a command are owned by different shards
+CROSS_SHARD = "the resources are owned by different shards, lock or release them separately"
+
+# error message sent back before closing the connection if a frame is longer than MAX_FRAME
+FRAME_TOO_LONG = "frame too long"
+
+class FrameReader(object):
+    """
+    a buffered reader of newline delimited frames
+    """
+    def __init__(self):
+        """
+        the constructor of the class FrameReader
+        """
+        self.buffer = ''
+
+    def feed(self, data):
+        """
+        add the received data and return the complete frames, empty lines are ignored
+
+        :param str data: the data received from the client
+
+        :rtype: list of str
+        """
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        if len(self.buffer) > MAX_FRAME:
+            raise ValueError(FRAME_TOO_LONG)
+        return [line for line in lines if line.strip()]
+
+def switch_framed(data):
+    """
+    check if a message asks to switch the connection to the framed protocol
+
+    :param str data: the message received from the client
+
+    :rtype: str, the data received after the switch or None if it is a normal message
+    """
+    head, separator, rest = data.partition('\n')
+    if head.strip() != FRAMED:
+        return None
+    return rest
+
+def switch_proxy(data, secret):
+    """
+    check if a message is sent by the shard router to switch the connection to the framed protocol
+    on behalf of a client, only the router knows the secret so another process can not borrow the
+    address of a client
+
+    :param str data: the message received from the router
+    :param str secret: the secret of the shard, None refuses every proxy message
+
+    :rtype: tuple (client_address, data received after the switch) or None if it is a normal message
+    """
+    head, separator, rest = data.partition('\n')
+    words = head.split()
+    if secret is None or len(words) != 3 or words[0] != PROXY or not hmac.compare_digest(words[2], secret):
+        return None
+    return words[1], rest
+
+def split_frame(frame):
+    """
+    split a frame into its request id and its message
+
+    :param str frame: a line received from the client
+
+    :rtype: tuple (request_id, message)
+    """
+    parts = frame.split(None, 1)
+    if len(parts) < 2:
+        return parts[0], ''
+    return parts[0], parts[1]
+
+def format_frame(request_id, reply):
+    """
+    build the frame of a reply
+
+    :param str request_id: the request id sent by the client
+    :param str reply: the reply of the command
+
+    :rtype: str
+    """
+    return request_id + " " + reply + "\n"
+
+def parse_message(data):
+    """
+    split the received message to get the command, the resource names and the options,
+    a command can be followed by one or more resource names then options like ttl=<ms>
+
+    :param str data: the message received from the client
+
+    :rtype: tuple (operation, resource_names, options) or None if the message is wrong
+    """
+    tmp = data.split()
+    if tmp == [STATS]:
+        return STATS, [], {}
+    if not tmp or tmp[0] not in OPTIONS:
+        return None
+
+    resource_names = []
+    options = {}
+    for word in tmp[1:]:
+        if "=" not in word:
+            resource_names.append(word)
+            continue
+        key, value = word.split("=", 1)
+        if key not in OPTIONS[tmp[0]] or not value:
+            return None
+        if key in NUMBER_OPTIONS:
+            if not value.isdigit() or int(value) == 0:
+                return None
+            value = int(value)
+        elif key == "since":
+            value = value.replace("T", " ")
+        options[key] = value
+
+    # check if the message received follows the correct format
+    if not resource_names:
+        return None
+    if tmp[0] in ("lock_shared", "renew", HISTORY, STATUS, WATCH, UNWATCH) and len(resource_names) > 1:
+        return None
+    if tmp[0] == "renew" and "ttl" not in options:
+        return None
+    return tmp[0], resource_names, options
+
+def fenced(reply, token, fence):
+    """
+    add the fencing token to a grant reply if the client asked for it
+
+    :param str reply: the grant reply
+    :param token: the fencing token of the lock, or the list of the tokens of many resources
+    :param bool fence: True if the client sent the fence option
+
+    :rtype: str
+    """
+    if not fence:
+        return reply
+    if isinstance(token, list):
+        return reply + " token=" + ",".join(str(resource_token) for resource_token in token)
+    return reply + " token=" + str(token)
+
+def execute(operation, resource_names, client_address, waiter=None, ttl=None, session=None, fence=False):
+    """
+    run a lock, lock_shared, release or renew operation for a client and return the reply.
+    if the client asks to lock a single busy resource, the waiter is queued and None is returned,
+    then the caller has to wait until the waiter is granted or TIMEOUT secs pass and call finish_wait
+
+    :param str operation: lock, lock_shared, release or renew
+    :param list resource_names: the unique identifiers of the targeted resources
+    :param str client_address: the ip address of the client
+    :param Waiter waiter: the client waiting for the resource if it is busy, required to lock
+    :param int ttl: number of milliseconds the lease lasts, None to lock until released
+    :param int session: the session of the connection, it owns the locks it takes
+    :param bool fence: True to send the fencing token with the grant
+
+    :rtype: str or None
+    """
+    if operation == STATS:
+        return metrics.to_json()
+
+    if Lock.table is not None and Lock.table.read_only:
+        return READ_ONLY
+
+    if len(resource_names) > 1:
+        return execute_many(operation, resource_names, client_address, ttl, session, fence)
+
+    resource_name = resource_names[0]
+    client_lock = Lock(resource_name, client_address, session)
+
+    if operation == 'lock':
+        token = client_lock.acquire_or_wait(waiter)
+        if token:
+            # you gain access to the resource
+            return fenced(GRANTED + resource_name, token, fence)
+    elif operation == 'lock_shared':
+        token = client_lock.acquire_or_wait(waiter)
+        if token:
+            # you share the resource with the other readers
+            return fenced(GRANTED_SHARED + resource_name, token, fence)
+    elif operation == 'renew':
+        if client_lock.renew(ttl):
+            return RENEWED + resource_name
+    elif client_lock.release():
+        # the client who request release is the same client who lock it in the first place
+        return RELEASED + resource_name
+
+    # the operation failed, check the resource status to know why
+    resource_status = client_lock.check_status()
+
+    if resource_status is None:
+        # targeted resource is not listed in the database
+        return NOT_LISTED
+
+    if operation in ('lock', 'lock_shared'):
+        # the resource is busy, the waiter is queued
+        metrics.increment("waits")
+        return None
+
+    if resource_status == "free":
+        #trying to release or renew a free resource, not allowed
+        return ALREADY_FREE
+
+    # trying to release or renew someone else's resource, not allowed
+    return NOT_ALLOWED
+
+def execute_many(operation, resource_names, client_address, ttl=None, session=None, fence=False):
+    """
+    lock or release several resources at once, either all of them or none of them.
+    locking many resources does not wait, if any of them is busy the busy reply is sent immediately
+
+    :param str operation: lock or release
+    :param list resource_names: the unique identifiers of the targeted resources
+    :param str client_address: the ip address of the client
+    :param int ttl: number of milliseconds the leases last, None to lock until released
+    :param int session: the session of the connection, it owns the locks it takes
+    :param bool fence: True to send the fencing tokens with the grant
+
+    :rtype: str
+    """
+    if operation == 'lock':
+        tokens = Lock.acquire_many(resource_names, client_address, ttl, session)
+        if tokens:
+            return fenced(GRANTED + " ".join(resource_names), tokens, fence)
+    elif Lock.release_many(resource_names, client_address, session):
+        return RELEASED + " ".join(resource_names)
+
+    # the operation failed, check the resources to know why
+    for resource_name in resource_names:
+        client_lock = Lock(resource_name, client_address, session)
+        resource_status = client_lock.check_status()
+        if resource_status is None:
+            return NOT_LISTED
+        if operation == 'release' and resource_status == "free":
+            return ALREADY_FREE
+        if operation == 'release' and not client_lock.holds():
+            return NOT_ALLOWED
+    return BUSY
+
+def history(resource_name, options):
+    """
+    read a page of the operations of a resource and return the reply of the history command
+
+    :param str resource_name: a unique identifier for a resource
+    :param dict options: the options of the history command
+
+    :rtype: str
+    """
+    resource_id = Lock.store().get_resource_id(resource_name)
+    if resource_id is None:
+        return NOT_LISTED
+    limit = min(options.get("limit", HISTORY_LIMIT), HISTORY_MAX_LIMIT)
+    # one more operation is read to know if there is a next page
+    try:
+        rows = list(itertools.islice(Lock.store().iter_operations(resource_id, options.get("since"), options.get("after"),
+                                                                options.get("client"), options.get("type"), limit + 1), limit + 1))
+    except UnknownOperation:
+        return UNKNOWN_AFTER
+    next_page = rows[limit - 1][0] if len(rows) > limit else None
+    return json.dumps({"operations": [list(row) for row in rows[:limit]], "next": next_page})
+
+def status(resource_name):
+    """
+    get the reply of the status command
+
+    :param str resource_name: a unique identifier for a resource
+
+    :rtype: str
+    """
+    event = Lock(resource_name, None).event()
+    if event is None:
+        return NOT_LISTED
+    return event
+
+def watch(operation, resource_name, session):
+    """
+    start or stop sending the events of a resource to the connection of a session and return the reply
+
+    :param str operation: watch or unwatch
+    :param str resource_name: a unique identifier for a resource
+    :param Session session: the session of the connection
+
+    :rtype: str
+    """
+    if operation == WATCH:
+        if session.push is None:
+            return WATCH_FRAMED
+        if not session.watch(resource_name):
+            return NOT_LISTED
+        return WATCHING + resource_name
+    if not session.unwatch(resource_name):
+        return NOT_WATCHING
+    return UNWATCHED + resource_name
+
+def finish_wait(waiter, fence=False):
+    """
+    stop waiting for a resource, either because it was handed over to the waiter
+    or because TIMEOUT secs passed, and return the reply
+
+    :param Waiter waiter: the waiting client
+    :param bool fence: True to send the fencing token with the grant
+
+    :rtype: str
+    """
+    client_lock = Lock(waiter.resource_name, waiter.client_address)
+    if client_lock.cancel_wait(waiter):
+        # it is still busy, try again later
+        return BUSY
+
+    #it was handed over to the waiter, you gain access
+    if waiter.shared:
+        return fenced(GRANTED_SHARED + waiter.resource_name, waiter.token, fence)
+    return fenced(GRANTED + waiter.resource_name, waiter.token, fence)
+
+class Session(object):
+    """
+    the identity of a single client connection. the locks taken by a connection belong to its session,
+    so two connections of the same client address do not share their locks, and the session keeps
+    the resources it holds so they are released without looking for them after the client disconnects.
+    a client that pools its connections has to release a lock over the connection that took it, see LockClient
+    """
+    # the ids of the sessions of this process
+    ids = itertools.count(1)
+
+    def __init__(self, client_address):
+        """
+        the constructor of the class Session
+
+        :param str client_address: the ip address of the client
+        """
+        self.session_id = next(Session.ids)
+        self.client_address = client_address
+        # resource name -> number of times the session holds the resource, a resource can be shared more than once
+        self.held = Counter()
+        # the function that sends an event to the connection, set by the server once the connection is framed.
+        # it is called holding the mutex of the waiters so it must not block
+        self.push = None
+        # the names of the watched resources
+        self.watching = set()
+
+    def track(self, reply, resource_names):
+        """
+        keep track of the resources held by the session using the reply sent to the client
+
+        :param str reply: the reply sent to the client
+        :param list resource_names: the unique identifiers of the targeted resources
+
+        :rtype: None
+        """
+        if reply.startswith(GRANTED) or reply.startswith(GRANTED_SHARED):
+            self.held.update(resource_names)
+        elif reply.startswith(RELEASED):
+            for resource_name in resource_names:
+                self.held[resource_name] -= 1
+                if self.held[resource_name] <= 0:
+                    del self.held[resource_name]
+
+    def release(self):
+        """
+        release the resources the session still holds in a single transaction, used after the client disconnected.
+        the other sessions of the same client address keep their locks
+
+        :rtype: None
+        """
+        held, self.held = self.held, Counter()
+        if held:
+            released = Lock.release_session(held, self.client_address, self.session_id)
+            metrics.increment("disconnect_releases", len(released))
+
+    def watch(self, resource_name):
+        """
+        send the events of a resource to the connection
+
+        :param str resource_name: a unique identifier for a resource
+
+        :rtype: bool, False if the resource is not listed
+        """
+        if resource_name in self.watching:
+            return True
+        if not Lock(resource_name, self.client_address).watch(self.push):
+            return False
+        self.watching.add(resource_name)
+        return True
+
+    def unwatch(self, resource_name):
+        """
+        stop sending the events of a resource to the connection
+
+        :param str resource_name: a unique identifier for a resource
+
+        :rtype: bool, False if the connection does not watch the resource
+        """
+        if resource_name not in self.watching:
+            return False
+        self.watching.discard(resource_name)
+        return Lock(resource_name, self.client_address).unwatch(self.push)
+
+    def unwatch_all(self):
+        """
+        stop sending the events of all the watched resources, used after the client disconnected
+
+        :rtype: None
+        """
+        watching, self.watching = self.watching, set()
+        for resource_name in watching:
+            Lock(resource_name, self.client_address).unwatch(self.push)
+
+def record(operation, reply, started):
+    """
+    count the reply of a command and add its latency, including the wait for a busy resource,
+    to the histogram of its operation
+
+    :param str operation: the operation of the command, None if the message is wrong
+    :param str reply: the reply sent to the client
+    :param float started: the time the command was received
+
+    :rtype: None
+    """
+    metrics.observe(operation or "wrong", time.time() - started)
+    if reply.startswith(GRANTED) or reply.startswith(GRANTED_SHARED):
+        metrics.increment("grants")
+    elif reply.startswith(RELEASED):
+        metrics.increment("releases")
+    elif reply.startswith(RENEWED):
+        metrics.increment("renewals")
+    elif reply == BUSY:
+        # the resource stayed busy for TIMEOUT secs or a resource of an all or nothing lock is busy
+        metrics.increment("timeouts")
+    elif reply == SERVER_ERROR:
+        metrics.increment("errors")
+    elif operation not in (STATS, HISTORY, STATUS, WATCH, UNWATCH):
+        metrics.increment("denials")
+
+metrics.probe("waiters", Lock.waiters.count)
+metrics.probe("leases", lambda: len(Lock.leases))
+metrics.probe("watchers", Lock.watchers.count)
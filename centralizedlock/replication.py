@@ -0,0 +1,225 @@
+"""
+this file contains the replication of the lock state from a leader to its followers.
+the leader streams every change of its lock table, in the order it is made, to the followers
+connected to its REPLICATION_PORT. a follower keeps a hot copy of the lock table in memory,
+writes it to its own database and refuses the lock commands until it is promoted, so a failover
+only needs a follower to be promoted instead of a restart and a database recovery.
+
+the stream is a line of json per message, the first one is the lock state and the leases of the leader
+and every next one is a single change or the end of a single lease. when a follower is promoted the leased
+locks expire when the leader would have expired them and the other locks are reconciled like the ones
+a server finds held when it starts, see recover of lock.py.
+"""
+import json
+import socket
+import threading
+import time
+from Queue import Queue, Full
+from lock import Lock
+from settings import REPLICATION_QUEUE, REPLICATION_RETRY, RECOVERY_GRACE
+
+class FollowerStream(object):
+    """
+    the changes waiting to be sent to a single follower
+    """
+    def __init__(self):
+        """
+        the constructor of the class FollowerStream
+        """
+        self.changes = Queue(REPLICATION_QUEUE)
+        self.lagging = False
+
+    def send(self, change):
+        """
+        queue a change to be sent, called by the lock table holding its mutex so it must not block
+
+        :param tuple change: (resource_id, state, client_address, readers, operation, token)
+
+        :rtype: None
+        """
+        self.put({"change": change})
+
+    def send_lease(self, lease):
+        """
+        queue the end of a lease to be sent, called by the lock table holding its mutex so it must not block
+
+        :param list lease: (resource_name, client_address, session, expires)
+
+        :rtype: None
+        """
+        self.put({"lease": lease})
+
+    def put(self, message):
+        """
+        queue a message without blocking
+
+        :param dict message: a change or a lease
+
+        :rtype: None
+        """
+        try:
+            self.changes.put_nowait(message)
+        except Full:
+            # the follower is too slow, it is disconnected and loads the lock state again
+            self.lagging = True
+
+class ReplicationServer(object):
+    """
+    the leader side of the replication, it serves every follower from its own thread
+    """
+    def __init__(self, table, host, port):
+        """
+        the constructor of the class ReplicationServer
+
+        :param LockTable table: the lock table of the leader
+        :param str host: the host name of the replication port
+        :param int port: the replication port
+        """
+        self.table = table
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(5)
+
+    def start(self):
+        """
+        start accepting the followers in the background
+
+        :rtype: None
+        """
+        acceptor = threading.Thread(target=self.accept_forever)
+        acceptor.daemon = True
+        acceptor.start()
+
+    def accept_forever(self):
+        """
+        the body of the thread that accepts the followers
+
+        :rtype: None
+        """
+        while True:
+            conn, addr = self.listener.accept()
+            print 'Follower connected from ' + addr[0] + ':' + str(addr[1])
+            follower = threading.Thread(target=self.serve, args=(conn,))
+            follower.daemon = True
+            follower.start()
+
+    def serve(self, conn):
+        """
+        send the lock state then stream the changes to a follower until it disconnects
+
+        :param socket conn: the connection of the follower
+
+        :rtype: None
+        """
+        stream = FollowerStream()
+        snapshot, leases = self.table.add_follower(stream)
+        try:
+            conn.sendall(json.dumps({"snapshot": snapshot, "leases": leases}) + "\n")
+            while not stream.lagging:
+                changes = [stream.changes.get()]
+                #the changes queued meanwhile are sent together
+                while not stream.changes.empty() and len(changes) < 1000:
+                    changes.append(stream.changes.get())
+                conn.sendall("".join(json.dumps(change) + "\n" for change in changes))
+        except socket.error as e:
+            print 'Follower disconnected: ' + str(e)
+        finally:
+            self.table.remove_follower(stream)
+            conn.close()
+
+class Replica(object):
+    """
+    the follower side of the replication, a thread keeps the lock table a copy of the one of the leader
+    """
+    def __init__(self, table, leader):
+        """
+        the constructor of the class Replica
+
+        :param LockTable table: the lock table of the follower
+        :param str leader: "host:port" of the replication port of the leader
+        """
+        host, port = leader.rsplit(":", 1)
+        self.table = table
+        self.leader = (host, int(port))
+        self.promoted = False
+        self.conn = None
+        self.mutex = threading.Lock()
+        table.read_only = True
+
+    def start(self):
+        """
+        start following the leader in the background
+
+        :rtype: None
+        """
+        follower = threading.Thread(target=self.follow_forever)
+        follower.daemon = True
+        follower.start()
+
+    def follow_forever(self):
+        """
+        the body of the thread that follows the leader, it connects again after the leader is lost
+        until the follower is promoted
+
+        :rtype: None
+        """
+        while not self.promoted:
+            try:
+                self.follow()
+            except (socket.error, ValueError, KeyError) as e:
+                print 'Replication stopped: ' + repr(e)
+            if not self.promoted:
+                time.sleep(REPLICATION_RETRY)
+
+    def follow(self):
+        """
+        load the lock state of the leader then apply its changes until the connection is closed
+
+        :rtype: None
+        """
+        conn = socket.create_connection(self.leader)
+        with self.mutex:
+            if self.promoted:
+                conn.close()
+                return
+            self.conn = conn
+        stream = conn.makefile('r')
+        try:
+            for line in stream:
+                if self.promoted:
+                    break
+                message = json.loads(line)
+                if "snapshot" in message:
+                    self.table.load_snapshot(message["snapshot"], message["leases"])
+                    print 'Following ' + self.leader[0] + ':' + str(self.leader[1])
+                elif "lease" in message:
+                    self.table.apply_lease(message["lease"])
+                else:
+                    self.table.apply(message["change"])
+        finally:
+            stream.close()
+            conn.close()
+
+    def promote(self, grace=RECOVERY_GRACE):
+        """
+        stop following the leader and start accepting the lock commands, the lock state
+        is the last one received from the leader. the clients of the leader lost their connections with it,
+        so its locks are reconciled before the commands are accepted: the leased ones expire when the leader would
+        have expired them and the others are kept for a grace lease like the locks a server finds held when it starts
+
+        :param int grace: number of milliseconds the locks without a lease last, None to release them all
+
+        :rtype: None
+        """
+        with self.mutex:
+            self.promoted = True
+            if self.conn is not None:
+                try:
+                    self.conn.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+        # the clients are refused until the locks are reconciled
+        released, kept = Lock.recover(grace, self.table.lease_ends(), replicated=True)
+        self.table.read_only = False
+        print 'Promoted to leader: %d locks released, %d kept' % (len(released), len(kept))
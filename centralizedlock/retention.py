@@ -0,0 +1,183 @@
+"""
+this file contains the retention job of the operations table.
+the rows older than OPERATIONS_RETENTION secs are copied to the archive database, then deleted from
+the database of the server, RETENTION_CHUNK rows at a time. every chunk is a short transaction, so the
+lock changes written meanwhile wait at most for a single chunk.
+
+a chunk is committed to the archive before it is deleted, if the job stops between the two
+the rows are copied again by the next run and the archive keeps a single copy of them.
+
+to run the job once, for example to keep the last 30 days, run
+
+    python retention.py --retention 2592000
+"""
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from database_functions import checkout
+from metrics import metrics
+from settings import OPERATIONS_RETENTION, RETENTION_INTERVAL, RETENTION_CHUNK, RETENTION_PAUSE
+from settings import ARCHIVE_DATABASE_NAME, DATABASE_JOURNAL_MODE
+
+def connect_archive(database_name=ARCHIVE_DATABASE_NAME):
+    """
+    connect to the archive database, its table is created by the first connection
+
+    :param str database_name: the archive database file
+
+    :rtype: sqlite db connection
+    """
+    con = sqlite3.connect(database_name)
+    con.execute("PRAGMA journal_mode = " + DATABASE_JOURNAL_MODE)
+    con.execute("create table if not exists operations_archive ("
+                "operation_id INTEGER NOT NULL PRIMARY KEY, "
+                "resource_id INTEGER NOT NULL, "
+                "resource_name TEXT, "
+                "operation_time TEXT NOT NULL, "
+                "operation_type TEXT NOT NULL, "
+                "client_ip_address TEXT NOT NULL)")
+    con.execute("create index if not exists operations_archive_resource_id on operations_archive (resource_id, operation_id)")
+    con.commit()
+    return con
+
+def get_last_archived_operation_type(resource_id, client_address, database_name=ARCHIVE_DATABASE_NAME):
+    """
+    get the type of the last archived operation of a client on a resource
+
+    :param int resource_id: the id of the resource
+    :param str client_address: the ip address of the client
+    :param str database_name: the archive database file
+
+    :rtype: str or None if the archive has no operation of the client on the resource
+    """
+    if not os.path.exists(database_name):
+        return None
+    con = connect_archive(database_name)
+    try:
+        sql_query = "select operation_type from operations_archive where resource_id = ? and client_ip_address = ? order by operation_id desc limit 1"
+        data = con.execute(sql_query, (resource_id, client_address)).fetchone()
+    finally:
+        con.close()
+    if data is not None:
+        return data[0]
+    return None
+
+def archive_chunk(archive, cutoff, chunk=RETENTION_CHUNK):
+    """
+    move the oldest operations rows written before cutoff to the archive
+
+    :param archive: the sqlite db connection of the archive
+    :param str cutoff: the rows whose operation_time is older are moved
+    :param int chunk: maximum number of rows to be moved
+
+    :rtype: int, the number of moved rows
+    """
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "select operations.operation_id, operations.resource_id, resources_names.resource_name, operations.operation_time, operations.operation_type, operations.client_ip_address from operations left join resources_names on resources_names.resource_id = operations.resource_id where operations.operation_time < ? order by operations.operation_time limit ?"
+        cur.execute(sql_query, (cutoff, chunk))
+        rows = cur.fetchall()
+    if not rows:
+        return 0
+
+    # the rows moved by an interrupted run are already archived
+    sql_query = "insert or ignore into operations_archive(operation_id, resource_id, resource_name, operation_time, operation_type, client_ip_address) values(?, ?, ?, ?, ?, ?)"
+    archive.executemany(sql_query, rows)
+    archive.commit()
+
+    with checkout() as conn:
+        cur = conn.cursor()
+        sql_query = "delete from operations where operation_id = ?"
+        cur.executemany(sql_query, [(row[0],) for row in rows])
+        conn.commit()
+    metrics.increment("operations_archived", len(rows))
+    return len(rows)
+
+def run_retention(retention, chunk=RETENTION_CHUNK, pause=RETENTION_PAUSE, archive_name=ARCHIVE_DATABASE_NAME):
+    """
+    move all the operations rows older than retention secs to the archive
+
+    :param int retention: number of seconds the rows are kept in the database of the server
+    :param int chunk: maximum number of rows moved in a single transaction
+    :param float pause: number of seconds to sleep between two chunks
+    :param str archive_name: the archive database file
+
+    :rtype: int, the number of moved rows
+    """
+    cutoff = str(datetime.now() - timedelta(seconds=retention))
+    archive = connect_archive(archive_name)
+    moved = 0
+    try:
+        while True:
+            count = archive_chunk(archive, cutoff, chunk)
+            moved += count
+            if count < chunk:
+                break
+            time.sleep(pause)
+    finally:
+        archive.close()
+    if moved:
+        # give the pages of the write ahead log back to the file system
+        with checkout() as conn:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return moved
+
+class RetentionJob(object):
+    """
+    a background thread that runs the retention every RETENTION_INTERVAL secs
+    """
+    def __init__(self, retention=OPERATIONS_RETENTION, interval=RETENTION_INTERVAL):
+        """
+        the constructor of the class RetentionJob
+
+        :param int retention: number of seconds the rows are kept in the database of the server
+        :param float interval: number of seconds between two runs
+        """
+        self.retention = retention
+        self.interval = interval
+
+    def start(self):
+        """
+        start running the retention in the background
+
+        :rtype: None
+        """
+        job = threading.Thread(target=self.run_forever)
+        job.daemon = True
+        job.start()
+
+    def run_forever(self):
+        """
+        the body of the thread of the job
+
+        :rtype: None
+        """
+        while True:
+            try:
+                moved = run_retention(self.retention)
+                if moved:
+                    print 'Archived ' + str(moved) + ' operations'
+            except sqlite3.Error as e:
+                print 'Retention failed: ' + str(e)
+            time.sleep(self.interval)
+
+def main():
+    parser = argparse.ArgumentParser(description="move the old rows of the operations table to the archive database")
+    parser.add_argument("--retention", type=int, default=OPERATIONS_RETENTION,
+                        help="number of seconds the rows are kept in the database")
+    parser.add_argument("--vacuum", action="store_true",
+                        help="rebuild the database file afterwards to give the free pages back, the server must be stopped")
+    args = parser.parse_args()
+    if args.retention is None:
+        parser.error("the retention is not set")
+
+    print 'Archived ' + str(run_retention(args.retention)) + ' operations'
+    if args.vacuum:
+        with checkout() as conn:
+            conn.execute("VACUUM")
+
+if __name__ == '__main__':
+    main()
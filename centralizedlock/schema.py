@@ -0,0 +1,125 @@
+"""
+this file contains the versioned schema of the database and the tool that creates and upgrades it.
+the version of a database file is kept in its user_version pragma, every migration of MIGRATIONS
+whose version is higher runs once in its own transaction, so an old database is upgraded in place
+and a missing database is created from scratch.
+
+to create the database with some resources, or to upgrade it, run for example
+
+    python schema.py resourceX resourceY resourceZ
+"""
+import argparse
+import sqlite3
+from settings import DATABASE_NAME
+
+# (version, description, statements) of every change of the schema, in order. a released migration
+# must never be changed, a new change of the schema is added as a new migration
+MIGRATIONS = [
+    (1, "resources and operations tables", [
+        "create table if not exists resources_names ("
+        "resource_id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE, "
+        "resource_name TEXT NOT NULL, "
+        "current_state TEXT NOT NULL, "
+        "client_address TEXT)",
+        "create table if not exists operations ("
+        "operation_id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE, "
+        "resource_id INTEGER NOT NULL, "
+        "operation_time TEXT NOT NULL, "
+        "operation_type TEXT NOT NULL, "
+        "client_ip_address TEXT NOT NULL, "
+        "FOREIGN KEY(resource_id) REFERENCES resources_names)",
+    ]),
+    (2, "readers of the shared locks", [
+        "create table if not exists resource_readers (resource_id INTEGER NOT NULL, client_address TEXT NOT NULL)",
+        "create index if not exists resource_readers_resource_id on resource_readers (resource_id)",
+    ]),
+    (3, "indexes of the lookups by resource name, client address and resource id", [
+        "create unique index if not exists resources_names_resource_name on resources_names (resource_name)",
+        "create index if not exists resources_names_client_address on resources_names (client_address)",
+        "create index if not exists resource_readers_client_address on resource_readers (client_address)",
+        "create index if not exists operations_resource_id on operations (resource_id, operation_id)",
+    ]),
+    (4, "index of the retention job", [
+        "create index if not exists operations_operation_time on operations (operation_time)",
+    ]),
+    (5, "time ordered index of the history of a resource", [
+        "create index if not exists operations_resource_id_operation_time on operations (resource_id, operation_time)",
+    ]),
+    (6, "fencing token of every resource, it grows by one on every grant", [
+        "alter table resources_names add column fencing_token INTEGER NOT NULL DEFAULT 0",
+    ]),
+]
+
+# the version of a database after all the migrations
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_version(con):
+    """
+    get the schema version of a database
+
+    :param con: sqlite db connection
+
+    :rtype: int
+    """
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(con):
+    """
+    run the migrations the database did not run yet, every one of them in its own transaction.
+    the version is checked again holding the write lock, so many processes can migrate the same file
+
+    :param con: sqlite db connection
+
+    :rtype: list of the versions of the migrations that ran
+    """
+    if get_version(con) >= SCHEMA_VERSION:
+        return []
+    isolation_level = con.isolation_level
+    # the transactions are started and committed by the statements below
+    con.isolation_level = None
+    applied = []
+    try:
+        for version, description, statements in MIGRATIONS:
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                if get_version(con) < version:
+                    for statement in statements:
+                        con.execute(statement)
+                    con.execute("PRAGMA user_version = %d" % version)
+                    applied.append(version)
+                con.execute("COMMIT")
+            except:
+                con.execute("ROLLBACK")
+                raise
+    finally:
+        con.isolation_level = isolation_level
+    return applied
+
+def add_resources(con, resource_names):
+    """
+    list new free resources in the database, the resources already listed are skipped
+
+    :param con: sqlite db connection
+    :param list resource_names: the unique identifiers of the resources
+
+    :rtype: None
+    """
+    sql_query = "insert or ignore into resources_names(resource_name, current_state) values(?, 'free')"
+    con.executemany(sql_query, [(resource_name,) for resource_name in resource_names])
+    con.commit()
+
+def main():
+    parser = argparse.ArgumentParser(description="create or upgrade the database of the lock server")
+    parser.add_argument("resource_names", nargs="*", help="resources to be listed in the database")
+    parser.add_argument("--database", default=DATABASE_NAME, help="the database file")
+    args = parser.parse_args()
+
+    con = sqlite3.connect(args.database)
+    for version in migrate(con):
+        print 'Migrated ' + args.database + ' to version ' + str(version)
+    add_resources(con, args.resource_names)
+    print args.database + ' is at version ' + str(get_version(con))
+    con.close()
+
+if __name__ == '__main__':
+    main()
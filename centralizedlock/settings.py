@@ -11,14 +11,173 @@ if "resources_testing_mode" in os.environ:
 else:
     DATABASE_NAME = "resources.sqlite"
 
+# the database file can be chosen by the lock_database_name key, to run several servers side by side
+DATABASE_NAME = os.environ.get("lock_database_name", DATABASE_NAME)
+
 # the host name of the socket server
 HOST = ''
 
 # the port number of the socket server
-PORT = 8888
+PORT = int(os.environ.get("lock_server_port", 8888))
 
 # receiving buffer limits
 RECV_BUFFER = 1024
 
-# number of seconds required to wait if the required resource is not available, then retry again if failed terminate the connection
+# maximum number of seconds to wait for a busy resource, the waiter gains access as soon as the resource is released, otherwise the busy reply is sent
 TIMEOUT = 10
+
+# the mode of the socket server, "threaded" starts a thread for every connection and
+# "event" serves all the connections from a single event loop
+SERVER_MODE = os.environ.get("lock_server_mode", "event")
+
+# number of worker threads used by the event server to run the database work
+WORKER_THREADS = 4
+
+# maximum number of pending connections waiting to be accepted
+LISTEN_BACKLOG = 1024
+
+# maximum number of sqlite connections kept open by the connection pool
+DATABASE_POOL_SIZE = 8
+
+# journal mode of the sqlite database, WAL lets the readers run while a writer commits
+DATABASE_JOURNAL_MODE = "WAL"
+
+# number of prepared statements cached by every sqlite connection
+DATABASE_CACHED_STATEMENTS = 100
+
+# where the lock state is kept, see backends.py:
+# "table" keeps it in the in memory lock table and writes it to the database in the background (the default),
+# "log" keeps it in the in memory lock table and appends every change to LOG_NAME, it is written to the database
+# only when the log is compacted, "sqlite" makes every change a transaction of the database and "memory" keeps it
+# in memory only
+BACKEND = os.environ.get("lock_backend", "table")
+
+# keep the lock state in the in memory lock table, a replica always keeps it there
+IN_MEMORY_LOCKS = BACKEND in ("table", "log")
+
+# maximum number of changes written to the database in a single transaction by the write behind flusher
+WRITE_BEHIND_BATCH = 500
+
+# number of seconds to wait before retrying a failed write behind transaction
+WRITE_BEHIND_RETRY = 1
+
+# durability of the rows of the operations table written by the database functions:
+# "sync" inserts every row in the transaction of its lock change and commits it,
+# "group" hands the rows over to a group commit writer and waits until their batch is committed,
+# "async" hands the rows over to the group commit writer without waiting.
+# it has no effect when IN_MEMORY_LOCKS is True, the write behind flusher or the log compaction of the lock table
+# writes the rows of the operations table with the lock state instead of the database functions
+OPERATIONS_DURABILITY = "group"
+
+# maximum number of operations rows committed in a single transaction by the group commit writer
+OPERATIONS_BATCH_SIZE = 500
+
+# maximum number of seconds an operations row waits for its batch to fill up
+OPERATIONS_MAX_DELAY = 0.002
+
+# maximum length of a frame of the framed protocol
+MAX_FRAME = 4096
+
+# maximum number of pipelined commands of a connection waiting to be executed, the server
+# stops reading from the connection until some of them are executed
+MAX_PIPELINE = 1000
+
+# number of seconds between two ticks of the timer wheel that expires the lock leases
+TIMER_WHEEL_TICK = 0.01
+
+# number of slots in every level of the timer wheel
+TIMER_WHEEL_SLOTS = 64
+
+# number of levels of the timer wheel, the leases longer than TIMER_WHEEL_TICK * TIMER_WHEEL_SLOTS ** TIMER_WHEEL_LEVELS secs
+# wait in its last slot and are placed again when it comes up
+TIMER_WHEEL_LEVELS = 4
+
+# the port where the leader streams the changes of its lock table to the followers, None to disable it
+REPLICATION_PORT = None
+if "lock_replication_port" in os.environ:
+    REPLICATION_PORT = int(os.environ["lock_replication_port"])
+
+# "host:port" of the replication port of the leader, set on the followers. a follower keeps a copy of the
+# lock state of the leader and refuses the lock commands until it is promoted by the SIGUSR1 signal
+REPLICA_OF = os.environ.get("lock_replica_of")
+
+# maximum number of changes waiting to be sent to a follower, a follower that lags more is disconnected
+REPLICATION_QUEUE = 100000
+
+# number of seconds a follower waits before connecting to the leader again
+REPLICATION_RETRY = 1
+
+# number of shard processes, every shard owns a hash partition of the resource names with its own
+# lock state and database file and the process listening on PORT routes the commands to them.
+# 0 serves all the resources from a single process
+SHARDS = int(os.environ.get("lock_shards", 0))
+
+# the first port of the shards, shard i listens on SHARD_BASE_PORT + i of the loopback interface
+SHARD_BASE_PORT = int(os.environ.get("lock_shard_base_port", 9000))
+
+# the database file of every shard
+SHARD_DATABASE_NAME = DATABASE_NAME.replace(".sqlite", "_shard%d.sqlite")
+
+# number of seconds the rows of the operations table are kept in the database, the older rows are moved
+# to the archive database by a background job. None keeps them forever
+OPERATIONS_RETENTION = None
+if "lock_operations_retention" in os.environ:
+    OPERATIONS_RETENTION = int(os.environ["lock_operations_retention"])
+
+# number of milliseconds the locks found held when the server starts are kept, their clients lost their connections
+# with the previous server so this is the time they have to finish and release them. None releases them at once
+RECOVERY_GRACE = 30000
+if "lock_recovery_grace" in os.environ:
+    RECOVERY_GRACE = int(os.environ["lock_recovery_grace"])
+
+# number of seconds between two runs of the retention job
+RETENTION_INTERVAL = 3600
+
+# maximum number of operations rows moved to the archive in a single transaction
+RETENTION_CHUNK = 1000
+
+# number of seconds the retention job sleeps between two chunks, so the lock changes are not held back
+RETENTION_PAUSE = 0.01
+
+# number of the last operations kept by the memory backend for the history command
+MEMORY_OPERATIONS = 100000
+
+# size in bytes of the memory mapped log of the log storage, the log is compacted when it is full
+LOG_SIZE = 16 * 1024 * 1024
+
+# maximum number of seconds between two compactions of a log that is not empty, the operations of the log
+# are moved to the database by the compaction so the history command sees them at most this late
+LOG_COMPACT_INTERVAL = 10
+
+# flush every write of the log to the disk before the next one, False leaves it to the operating system
+LOG_SYNC = True
+
+# number of operations sent by the history command when the client does not set its limit, and its maximum
+HISTORY_LIMIT = 100
+HISTORY_MAX_LIMIT = 1000
+
+# number of operations rows read from the database by a single query of the history
+HISTORY_PAGE = 500
+
+# maximum number of resources whose lock state is cached by a LockClient, 0 disables the cache
+STATUS_CACHE_SIZE = 1024
+
+# the shard served by this process, set by the router for the processes it starts
+SHARD = None
+
+# the secret the router sends with the proxy messages, a shard accepts a proxy message only with it.
+# the router sets a new one for the processes it starts every time it starts
+SHARD_SECRET = None
+if "lock_shard" in os.environ:
+    SHARD_SECRET = os.environ.get("lock_shard_secret")
+    SHARD = int(os.environ["lock_shard"])
+    DATABASE_NAME = SHARD_DATABASE_NAME % SHARD
+    HOST = '127.0.0.1'
+    PORT = SHARD_BASE_PORT + SHARD
+
+# the database file of the operations moved out of DATABASE_NAME by the retention job
+ARCHIVE_DATABASE_NAME = DATABASE_NAME.replace(".sqlite", "_archive.sqlite")
+
+# the files of the log storage, the log of the changes and the snapshot of the lock state it is compacted into
+LOG_NAME = DATABASE_NAME.replace(".sqlite", ".log")
+SNAPSHOT_NAME = DATABASE_NAME.replace(".sqlite", ".snapshot")
@@ -0,0 +1,338 @@
+"""
+this file contains the router of the sharded mode.
+the router starts SHARDS lock server processes, every one of them owns the resources whose
+names hash to it and keeps their lock state in its own database file, so the lock work runs
+on as many cores as there are shards. the clients connect to the router which forwards every
+command to the shard that owns its resources, over a connection opened on behalf of the client,
+so the shard sees the address of the client and releases its resources when it disconnects.
+"""
+import asyncore
+import binascii
+import os
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+import zlib
+from collections import deque
+from shutil import copyfile
+from event_server import EventLoop, ClientConnection, LockServer
+from metrics import metrics
+from protocol import *
+from settings import *
+
+def shard_of(resource_name, shards=SHARDS):
+    """
+    get the shard that owns a resource, the same name always goes to the same shard
+
+    :param str resource_name: a unique identifier for a resource
+    :param int shards: number of shards
+
+    :rtype: int
+    """
+    return (zlib.crc32(resource_name) & 0xffffffff) % shards
+
+def prepare_shard_database(shard, shards=SHARDS):
+    """
+    create the database file of a shard from the main database if it does not exist,
+    it keeps only the resources owned by the shard and their operations
+
+    :param int shard: the index of the shard
+    :param int shards: number of shards
+
+    :rtype: None
+    """
+    database_name = SHARD_DATABASE_NAME % shard
+    if os.path.exists(database_name):
+        return
+    con = sqlite3.connect(DATABASE_NAME)
+    #move the changes written to the write ahead log into the database file before copying it
+    con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    con.close()
+    copyfile(DATABASE_NAME, database_name)
+
+    con = sqlite3.connect(database_name)
+    others = [(resource_id,) for resource_id, resource_name in con.execute("select resource_id, resource_name from resources_names")
+              if shard_of(resource_name, shards) != shard]
+    tables = [row[0] for row in con.execute("select name from sqlite_master where type = 'table'")]
+    con.executemany("delete from operations where resource_id = ?", others)
+    if "resource_readers" in tables:
+        con.executemany("delete from resource_readers where resource_id = ?", others)
+    con.executemany("delete from resources_names where resource_id = ?", others)
+    con.commit()
+    con.close()
+
+class ShardConnection(asyncore.dispatcher):
+    """
+    a framed connection to a shard opened on behalf of a single client
+    """
+    def __init__(self, client, shard):
+        """
+        the constructor of the class ShardConnection
+
+        :param RouterConnection client: the client connection that forwards its commands
+        :param int shard: the index of the shard
+        """
+        asyncore.dispatcher.__init__(self, map=client.server.loop.map)
+        self.client = client
+        self.shard = shard
+        self.reader = FrameReader()
+        self.out_buffer = PROXY + " " + client.client_address + " " + client.server.secret + "\n"
+        # the callbacks of the forwarded commands waiting for their replies, in order
+        self.callbacks = deque()
+        self.next_id = 0
+        self.switched = False
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(('127.0.0.1', SHARD_BASE_PORT + shard))
+
+    def call(self, command, callback):
+        """
+        forward a command to the shard
+
+        :param str command: the command received from the client
+        :param function callback: called with the reply of the shard
+
+        :rtype: None
+        """
+        self.next_id += 1
+        self.callbacks.append(callback)
+        self.out_buffer += format_frame(str(self.next_id), command)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return self.connecting or len(self.out_buffer) > 0
+
+    def handle_connect(self):
+        pass
+
+    def handle_read(self):
+        data = self.recv(RECV_BUFFER)
+        for frame in self.reader.feed(data):
+            if not self.switched:
+                # the reply of the proxy message
+                self.switched = True
+                continue
+            request_id, reply = split_frame(frame)
+            if request_id == EVENT_ID:
+                # an event of a resource watched by the client
+                self.client.send_event(reply)
+                continue
+            self.callbacks.popleft()(reply)
+
+    def handle_write(self):
+        sent = self.send(self.out_buffer)
+        self.out_buffer = self.out_buffer[sent:]
+
+    def handle_close(self):
+        self.close()
+        if self.client.shards.get(self.shard) is self:
+            del self.client.shards[self.shard]
+        # the commands that did not get a reply failed
+        callbacks, self.callbacks = self.callbacks, deque()
+        for callback in callbacks:
+            callback(SERVER_ERROR)
+
+    def handle_error(self):
+        print 'Connection error with shard ' + str(self.shard)
+        self.handle_close()
+
+class RouterConnection(ClientConnection):
+    """
+    a client connection of the router, its commands are forwarded to the shards.
+    with the framed protocol the frames of the same shard are forwarded without waiting
+    for the replies, the router waits for them only before it moves to another shard
+    """
+    def __init__(self, server, conn, client_address):
+        """
+        the constructor of the class RouterConnection
+
+        :param ShardRouter server: the router that accepted the connection
+        :param socket conn: the accepted socket
+        :param str client_address: the ip address of the client
+        """
+        ClientConnection.__init__(self, server, conn, client_address)
+        # shard index -> the connection to the shard opened for this client
+        self.shards = {}
+        # the request ids of the frames forwarded to forward_shard waiting for their replies, in order
+        self.forwarded = deque()
+        self.forward_shard = None
+
+    def readable(self):
+        if self.reader is not None:
+            return len(self.frames) + len(self.forwarded) < MAX_PIPELINE
+        return not self.in_progress
+
+    def route(self, data):
+        """
+        find the shard that owns the resources of a command
+
+        :param str data: the command received from the client
+
+        :rtype: tuple (reply, shard), the reply is None unless the command is refused by the router
+        """
+        message = parse_message(data)
+        if message is None:
+            #the message Received does not follow the correct format so send an error message
+            return WRONG_MESSAGE, None
+        operation, resource_names, options = message
+        if operation == STATS:
+            #the metrics of the router itself, the shards are asked through their own ports
+            return metrics.to_json(), None
+        if operation == WATCH and self.reader is None:
+            #the shards send the events only over framed connections
+            return WATCH_FRAMED, None
+        shards = set(shard_of(resource_name) for resource_name in resource_names)
+        if len(shards) > 1:
+            return CROSS_SHARD, None
+        return None, shards.pop()
+
+    def forward(self, shard, data, callback):
+        """
+        forward a command to a shard, the connection to the shard is opened by the first command
+
+        :param int shard: the index of the shard
+        :param str data: the command received from the client
+        :param function callback: called with the reply of the shard
+
+        :rtype: None
+        """
+        if shard not in self.shards:
+            self.shards[shard] = ShardConnection(self, shard)
+        self.shards[shard].call(" ".join(data.split()), callback)
+
+    def run_command(self, data):
+        """
+        forward a command received without the framed protocol and send its reply
+
+        :param str data: the command received from the client
+
+        :rtype: None
+        """
+        reply, shard = self.route(data)
+        if reply is not None:
+            self.send_reply(reply)
+            return
+        self.in_progress = True
+        self.forward(shard, data, self.send_reply)
+
+    def run_frames(self):
+        """
+        forward the queued frames in order, the replies of the router itself and the frames of
+        another shard wait until all the forwarded frames are answered
+
+        :rtype: None
+        """
+        while self.frames and self.connected:
+            request_id, message = split_frame(self.frames[0])
+            reply, shard = self.route(message)
+            if self.forwarded and (reply is not None or shard != self.forward_shard):
+                return
+            self.frames.popleft()
+            if reply is not None:
+                self.out_buffer += format_frame(request_id, reply)
+                continue
+            self.forward_shard = shard
+            self.forwarded.append(request_id)
+            self.forward(shard, message, self.on_forwarded)
+
+    def on_forwarded(self, reply):
+        """
+        called with the reply of the shard to the oldest forwarded frame
+
+        :param str reply: the reply of the shard
+
+        :rtype: None
+        """
+        request_id = self.forwarded.popleft()
+        if not self.connected:
+            return
+        self.out_buffer += format_frame(request_id, reply)
+        self.run_frames()
+
+    def handle_close(self):
+        self.close()
+        #the shards release the resources locked by this client when their connections are closed
+        for shard in self.shards.values():
+            shard.close()
+        self.shards = {}
+
+class ShardRouter(LockServer):
+    """
+    the listening socket of the router
+    """
+    connection_class = RouterConnection
+
+    def __init__(self, loop, host, port, secret):
+        """
+        the constructor of the class ShardRouter
+
+        :param EventLoop loop: the loop that serves the connections
+        :param str host: the host name of the router
+        :param int port: the port number of the router
+        :param str secret: the secret of the shards, sent with the proxy messages
+        """
+        LockServer.__init__(self, loop, None, host, port)
+        self.secret = secret
+
+def start_shards(secret, shards=SHARDS):
+    """
+    start a lock server process for every shard and wait until all of them are listening
+
+    :param str secret: the secret the shards expect with the proxy messages
+    :param int shards: number of shards
+
+    :rtype: list of the started processes
+    """
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'socket_server.py')
+    processes = []
+    for shard in range(shards):
+        prepare_shard_database(shard, shards)
+        env = dict(os.environ, lock_shard=str(shard), lock_shard_secret=secret, lock_server_mode="event")
+        processes.append(subprocess.Popen([sys.executable, server_path], env=env))
+
+    for shard in range(shards):
+        for i in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', SHARD_BASE_PORT + shard)).close()
+                break
+            except socket.error:
+                time.sleep(0.1)
+    return processes
+
+def stop(signum, frame):
+    """
+    the handler of SIGTERM, it stops the router like Ctrl+C
+
+    :rtype: None
+    """
+    raise KeyboardInterrupt()
+
+def serve_sharded(host=HOST, port=PORT, shards=SHARDS):
+    """
+    start the shards and route the commands of the clients to them forever.
+    the shards are interrupted after the router stops so they write their pending lock changes
+
+    :param str host: the host name of the router
+    :param int port: the port number of the router
+    :param int shards: number of shards
+
+    :rtype: None
+    """
+    #the shards listen on the loopback interface, the secret keeps the other local processes from sending proxy messages
+    secret = binascii.hexlify(os.urandom(16))
+    processes = start_shards(secret, shards)
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        loop = EventLoop()
+        ShardRouter(loop, host, port, secret)
+        print 'Router now listening with ' + str(shards) + ' shards'
+        loop.run()
+    finally:
+        for process in processes:
+            process.send_signal(signal.SIGINT)
+        for process in processes:
+            process.wait()
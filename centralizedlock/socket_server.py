@@ -1,113 +1,311 @@
 '''
-Simple socket server using threads
+Simple socket server, it serves the clients either using a thread per connection
+or using a single event loop depending on SERVER_MODE. if SHARDS is set it starts
+the shard processes and routes the commands of the clients to them
 '''
+import errno
+import signal
 import socket
 import sys
+import threading
+import time
 from thread import *
+from Queue import Queue
 from lock import Lock
-import time
+from backends import make_backend
+from lock_table import LockTable
+from metrics import metrics
+from protocol import *
 from settings import *
+from waiters import Waiter
+
+#Function for running a single command received from a client
+def run_command(data, session):
+    client_address = session.client_address
+    started = time.time()
+    #split the message Received to get the command and the resource names
+    message = parse_message(data)
+
+    # check if the message Received follows the correct format
+    if message is None:
+        #the message Received does not follow the correct format so send an error message
+        record(None, WRONG_MESSAGE, started)
+        return WRONG_MESSAGE
+
+    # operation has to be lock, lock_shared, release, renew, history, status, watch, unwatch or stats
+    operation, resource_names, options = message
+    if operation in (STATUS, WATCH, UNWATCH):
+        if operation == STATUS:
+            reply = status(resource_names[0])
+        else:
+            reply = watch(operation, resource_names[0], session)
+        record(operation, reply, started)
+        return reply
+    if operation in (STATS, HISTORY):
+        if operation == STATS:
+            reply = execute(operation, resource_names, client_address)
+        else:
+            reply = history(resource_names[0], options)
+        record(operation, reply, started)
+        return reply
+    granted = threading.Event()
+    waiter = Waiter(resource_names[0], client_address, granted.set, options.get("ttl"), operation == "lock_shared",
+                    session.session_id)
+    reply = execute(operation, resource_names, client_address, waiter, options.get("ttl"), session.session_id,
+                    options.get("fence"))
+
+    if reply is None:
+        # the resource is busy, you will wait until it is handed over to you or TIMEOUT secs pass
+        granted.wait(TIMEOUT)
+        reply = finish_wait(waiter, options.get("fence"))
+    session.track(reply, resource_names)
+    record(operation, reply, started)
+    return reply
+
+#Function for running the complete frames received from a client using the framed protocol
+def run_frames(reader, data, session):
+    #the replies of all the frames are sent together
+    replies = []
+    for frame in reader.feed(data):
+        request_id, message = split_frame(frame)
+        replies.append(format_frame(request_id, run_command(message, session)))
+    return ''.join(replies)
+
+class EventPusher(object):
+    """
+    sends the events of the resources watched by a connection from its own thread,
+    so a slow client never blocks the thread that changed the lock state
+    """
+    def __init__(self, conn, send_lock):
+        """
+        the constructor of the class EventPusher
 
-#initiate socket server s
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-print 'Socket created'
+        :param socket conn: the connection of the client
+        :param lock send_lock: taken while sending, so an event is never sent inside a reply
+        """
+        self.conn = conn
+        self.send_lock = send_lock
+        self.events = Queue()
+        self.started = False
 
-#Bind socket to local host and port
-try:
-    s.bind((HOST, PORT))
-except socket.error as msg:
-    print 'Bind failed. Error Code : ' + str(msg[0]) + ' Message ' + msg[1]
-    sys.exit()
+    def push(self, event):
+        """
+        queue an event to be sent, the thread is started by the first one
 
-print 'Socket bind complete'
+        :param str event: the event, like "released resourceX"
 
-#Start listening on socket
-s.listen(10)
-print 'Socket now listening'
+        :rtype: None
+        """
+        if not self.started:
+            self.started = True
+            start_new_thread(self.run, ())
+        self.events.put(event)
+
+    def run(self):
+        """
+        the body of the thread, it sends the events until the pusher is stopped
+
+        :rtype: None
+        """
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            try:
+                with self.send_lock:
+                    self.conn.sendall(format_frame(EVENT_ID, event))
+            except socket.error:
+                return
+
+    def stop(self):
+        """
+        stop the thread after the client disconnected
+
+        :rtype: None
+        """
+        if self.started:
+            self.events.put(None)
 
 #Function for handling connections. This will be used to create threads
 def clientthread(conn, client_address):
+    #the session of this connection, the resources it locks are released after the client disconnects
+    session = Session(client_address)
+
+    #the replies and the events of the watched resources are sent one at a time
+    send_lock = threading.Lock()
+    pusher = EventPusher(conn, send_lock)
+
+    #the reader of the framed protocol, None until the client switches to it
+    reader = None
+    metrics.gauge("connections", 1)
+
     #infinite loop so that function do not terminate and thread do not end.
     while True:
         #Receiving from client
         try:
-            data = conn.recv(RECV_BUFFER) #release or lock resource_name
-        except:
-            #release all locked resources for the client address
-            client_lock = Lock("", client_address)
-            client_lock.release_by_client_address()
+            data = conn.recv(RECV_BUFFER) #release or lock followed by the resource names
+        except socket.error:
+            data = ''
+
+        if not data:
+            #the client disconnected, release all the resources locked by this connection
+            session.release()
             break
-        else:
-            #split the message Received to get the command and the resource name
-            tmp = data.split()
-
-            # check if the message Received follows the correct format
-            if tmp is not None and len(tmp) == 2 and ( tmp[0] == "release" or tmp[0] == "lock"):
-
-                # operation has to be lock or release
-                operation = tmp[0]
-                resource_name = tmp[1]
-
-                #targeted resource name and status
-                client_lock = Lock(resource_name, client_address)
-                resource_status = client_lock.check_status()
-
-                if not data:
-                    break
-                elif resource_status is None:
-                    # targeted resource is not listed in the database
-                    reply = "required resource is not listed"
-
-                elif operation == 'lock' and resource_status == "free":
-                    # you gain access to the resource
-                    reply = "You have an exclusive access to resource " + resource_name
-                    client_lock.acquire()
-
-                elif operation == 'lock' and resource_status == "busy":
-                    # the resource is busy, you will wait TIMEOUT secs and retry
-                    time.sleep(TIMEOUT)
-                    # checking the resource status again after TIMEOUT
-                    resource_status_new = client_lock.check_status()
-
-                    if resource_status_new == "busy":
-                        # it is still busy, try again later
-                        reply = "required resource is busy now, you have to wait a while"
-                    else:
-                        #it's free now, you will gain access
-                        reply = "You have an exclusive access to resource " + resource_name
-                        client_lock.acquire()
-
-                elif operation == 'release':
-                    if resource_status == "free":
-                        #trying to release a free resource, not allowed
-                        reply = "resource is already free."
-
-                    #checking if the client who request release is the same client who lock it in the first place
-                    elif client_address in client_lock.get_client_address():
-                        reply = "lock released from resource " + resource_name
-                        client_lock.release()
-                    else:
-                        # trying to release someone else's resource, not allowed
-                        reply = 'it is not allowed to release someone else resource'
+
+        try:
+            if reader is None:
+                framed = switch_framed(data)
+                if framed is None:
+                    reply = run_command(data, session)
+                else:
+                    #from now on the commands are pipelined frames and the events of the watched resources can be sent
+                    reader = FrameReader()
+                    session.push = pusher.push
+                    reply = FRAMED_ON + "\n" + run_frames(reader, framed, session)
             else:
-                #the message Received does not follow the correct format so send an error message
-                reply = "wrong message, you must send release or lock as the first word then space then the resource_name"
+                reply = run_frames(reader, data, session)
+        except ValueError:
+            #the frame is too long, send an error message and close the connection
+            reply = None
+
+        if reply is None:
+            try:
+                conn.sendall(format_frame("-", FRAME_TOO_LONG))
+            except socket.error:
+                pass
+            session.release()
+            break
 
-            #send the message to the client
-            conn.sendall(reply)
+        #send the message to the client
+        try:
+            with send_lock:
+                conn.sendall(reply)
+        except socket.error:
+            session.release()
+            break
 
     #came out of loop and close the connection
+    session.unwatch_all()
+    pusher.stop()
     conn.close()
+    metrics.gauge("connections", -1)
+
+def serve_threaded(host=HOST, port=PORT):
+    #initiate socket server s
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    #the port can be bound again right after the server restarts
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    print 'Socket created'
+
+    #Bind socket to local host and port
+    try:
+        s.bind((host, port))
+    except socket.error as msg:
+        print 'Bind failed. Error Code : ' + str(msg[0]) + ' Message ' + msg[1]
+        sys.exit()
+
+    print 'Socket bind complete'
+
+    #Start listening on socket
+    s.listen(LISTEN_BACKLOG)
+    print 'Socket now listening'
+
+    #now keep talking with the client
+    while 1:
+        #wait to accept a connection - blocking call
+        try:
+            conn, addr = s.accept()
+        except socket.error as e:
+            if e.errno == errno.EINTR:
+                #interrupted by a signal, like the promotion of a follower
+                continue
+            raise
+        client_address = addr[0]
+        print 'Connected with ' + client_address + ':' + str(addr[1])
+
+        #start new thread takes 1st argument as a function name to be run, second is the tuple of arguments to the function.
+        start_new_thread(clientthread ,(conn, client_address))
+
+    # close the socket server
+    s.close()
+
+def load_lock_table():
+    #load the lock state into memory, the database or the log storage is written behind it from now on
+    storage = None
+    if BACKEND == "log":
+        from log_storage import LogStorage
+        storage = LogStorage()
+    table = LockTable(storage)
+    table.load()
+    table.start()
+    Lock.table = table
+
+def warm_start(replication):
+    #load the resources and the lock state before accepting the clients, then release the locks left by the clients
+    #of the previous server or keep them for RECOVERY_GRACE
+    started = time.time()
+    if IN_MEMORY_LOCKS or replication:
+        load_lock_table()
+    else:
+        #keep the lock state in the chosen backend instead of the rows of the database
+        Lock.backend = make_backend(BACKEND)
+    released, kept = [], []
+    if REPLICA_OF is None:
+        storage = getattr(Lock.store(), "storage", None)
+        if storage is not None:
+            #move the replayed log to the database so the recovered locks are checked against all their operations
+            storage.compact()
+        released, kept = Lock.recover(RECOVERY_GRACE)
+        metrics.increment("recovered_locks_released", len(released))
+        metrics.increment("recovered_locks_kept", len(kept))
+    metrics.observe("startup", time.time() - started)
+    print 'Started in %.1f ms: %d resources, %d stale locks released, %d kept' % (
+        (time.time() - started) * 1000, Lock.store().count(), len(released), len(kept))
 
-#now keep talking with the client
-while 1:
-    #wait to accept a connection - blocking call
-    conn, addr = s.accept()
-    client_address = addr[0]
-    print 'Connected with ' + client_address + ':' + str(addr[1])
+def start_replication():
+    from replication import ReplicationServer, Replica
+    if REPLICA_OF is not None:
+        #follow the leader until SIGUSR1 promotes this server, the promotion reconciles the locks of the leader
+        #so it runs in its own thread instead of interrupting the one serving the clients
+        replica = Replica(Lock.table, REPLICA_OF)
+        replica.start()
+        signal.signal(signal.SIGUSR1, lambda signum, frame: start_new_thread(replica.promote, ()))
+    if REPLICATION_PORT is not None:
+        #stream the lock changes to the followers
+        ReplicationServer(Lock.table, HOST, REPLICATION_PORT).start()
 
-    #start new thread takes 1st argument as a function name to be run, second is the tuple of arguments to the function.
-    start_new_thread(clientthread ,(conn, client_address))
+if __name__ == '__main__':
+    if SHARDS and SHARD is None:
+        #this process routes the commands to the shards, they keep the lock state
+        from shard_router import serve_sharded
+        try:
+            serve_sharded()
+        except KeyboardInterrupt:
+            pass
+        sys.exit()
+
+    #the replication streams the changes of the lock table so it always loads it
+    replication = REPLICA_OF is not None or REPLICATION_PORT is not None
+    warm_start(replication)
+
+    if replication:
+        start_replication()
 
-# close the socket server
-s.close()
+    if OPERATIONS_RETENTION is not None:
+        #move the old operations to the archive database in the background
+        from retention import RetentionJob
+        RetentionJob().start()
+
+    try:
+        if SERVER_MODE == "event":
+            from event_server import serve
+            serve()
+        else:
+            serve_threaded()
+    except KeyboardInterrupt:
+        #write the pending lock changes to the database before exiting
+        if Lock.table is not None:
+            Lock.table.flush()
+            if Lock.table.storage is not None:
+                #move the log to the database so the next start has nothing to replay
+                Lock.table.storage.compact()
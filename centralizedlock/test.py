@@ -4,10 +4,13 @@ and also check the database.
 """
 
 import socket
+import sqlite3
 import time
 import os
 from shutil import copyfile
 from lock import Lock
+from schema import migrate, add_resources
+from benchmark import percentile, summarize, uncontended
 from database_functions import *
 
 # put the resources_testing_mode key in os.environ which means that
@@ -22,9 +25,49 @@ PORT = 8888
 
 def setup():
     """
-    make a copy of the database
+    create the database copied by the servers that the test cases start. it is built from the schema instead of
+    copying resources.sqlite, the running server keeps writing that one in the WAL mode so a copy of the file
+    can miss the committed changes and keep stale locks
     """
-    copyfile('resources.sqlite', 'resources_testing.sqlite')
+    for name in ('resources_testing.sqlite', 'resources_testing.sqlite-wal', 'resources_testing.sqlite-shm'):
+        if os.path.exists(name):
+            os.remove(name)
+    con = sqlite3.connect('resources_testing.sqlite')
+    migrate(con)
+    add_resources(con, ['resourceX', 'resourceY', 'resourceZ'])
+    con.close()
+
+def wait_for_status(client_lock, status):
+    """
+    the server keeps the lock state in memory and writes it to the database in the background,
+    so wait a while until the database has the expected status
+
+    :param Lock client_lock: the lock of the targeted resource
+    :param str status: the expected status, free or busy
+
+    :rtype: bool
+    """
+    for i in range(100):
+        if client_lock.check_status() == status:
+            return True
+        time.sleep(0.01)
+    return False
+
+def wait_for_operations(resource_id, length):
+    """
+    wait a while until the operations written in the background by the server reach the expected length
+
+    :param str resource_id: a unique identifier for a resource
+    :param int length: the expected number of operations
+
+    :rtype: 2 d tuple
+    """
+    for i in range(100):
+        operations = get_operations_by_resource_id(resource_id)
+        if len(operations) >= length:
+            return operations
+        time.sleep(0.01)
+    return operations
 
 def test_lock_resourceX_then_unlock():
     """
@@ -48,12 +91,12 @@ def test_lock_resourceX_then_unlock():
 
         # make sure the access is granted
         assert data == 'You have an exclusive access to resource resourceX'
-        assert client_lock.check_status() == 'busy'
+        assert wait_for_status(client_lock, 'busy')
 
         # make sure this operation stored into the db
         #select operations
         # client_ip_address, operation_time, operation_type
-        operations = get_operations_by_resource_id(resource_id)
+        operations = wait_for_operations(resource_id, 1)
         assert len(operations) == 1
         assert operations[0][0] == client_address
         assert operations[0][2] == "lock"
@@ -67,12 +110,12 @@ def test_lock_resourceX_then_unlock():
 
         # make sure the release done
         assert data == 'lock released from resource resourceX'
-        assert client_lock.check_status() == 'free'
+        assert wait_for_status(client_lock, 'free')
 
         # make sure this operation stored into the db
         #select operations
         # client_ip_address, operation_time, operation_type
-        operations = get_operations_by_resource_id(resource_id)
+        operations = wait_for_operations(resource_id, 2)
         assert len(operations) == 2
         assert operations[0][0] == client_address
         assert operations[0][2] == "lock"
@@ -83,7 +126,7 @@ def test_lock_resourceX_then_unlock():
         s.sendall('lock resourceX')
         data = s.recv(1024)
         assert data == 'required resource is busy now, you have to wait a while'
-        assert client_lock.check_status() == 'busy'
+        assert wait_for_status(client_lock, 'busy')
 
     #delete operations
     delete_operation_by_resource_id(resource_id)
@@ -94,44 +137,60 @@ def test_lock_resourceX_then_unlock():
 def test_release_locked_resource_by_different_client():
     """
     TestCase Senario:
-    at first lock the resourceX by the client 192.168.0.1
+    at first lock the resourceX by the client 127.0.0.2
     then ask the server as the client 127.0.0.1 to lock or release the resourceX
     """
     #targeted resource and client_address
     resource_name = 'resourceX'
+    resource_id = get_resource_id_by_name(resource_name)[0]
     client_address1 = '127.0.0.1'
-    client_address2 = '192.168.0.1'
+    client_address2 = '127.0.0.2'
     client_lock = Lock(resource_name, client_address1)
     status = client_lock.check_status()
 
+    #initiate socket s2 from the client address '127.0.0.2', the server owns the lock
+    #state so the resource has to be locked through the server
+    s2 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s2.bind((client_address2, 0))
+    s2.connect((HOST,PORT))
+    if status == 'free':
+        # lock the resourceX by the client '127.0.0.2'
+        s2.sendall('lock resourceX')
+        data = s2.recv(1024)
+        assert data == 'You have an exclusive access to resource resourceX'
+
     #initiate socket s and send the request access to resourceX
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.connect((HOST,PORT))
-    if status == 'free':
-        # lock the resourceX by the client '192.168.0.1'
-        update_resource_status(resource_name, 'busy', client_address2)
 
     #make sure the resourceX status is busy
-    assert client_lock.check_status() == 'busy'
+    assert wait_for_status(client_lock, 'busy')
     s.sendall('lock resourceX')
     data = s.recv(1024)
 
     #make sure the resourceX status is busy
     assert data == 'required resource is busy now, you have to wait a while'
-    assert client_lock.check_status() == 'busy'
+    assert wait_for_status(client_lock, 'busy')
     s.sendall('release resourceX')
     data = s.recv(1024)
 
     #make sure the resourceX status is busy and the release failed because the ip is different
     assert data == 'it is not allowed to release someone else resource'
-    assert client_lock.check_status() == 'busy'
-    update_resource_status(resource_name, 'free', client_address2)
+    assert wait_for_status(client_lock, 'busy')
+    s2.sendall('release resourceX')
+    data = s2.recv(1024)
+    assert data == 'lock released from resource resourceX'
 
     #make sure the resourceX status is free
-    assert client_lock.check_status() == 'free'
+    assert wait_for_status(client_lock, 'free')
 
-    #close the socket client
+    #delete operations
+    wait_for_operations(resource_id, 2)
+    delete_operation_by_resource_id(resource_id)
+
+    #close the socket clients
     s.close()
+    s2.close()
 
 def test_lock_resourceX_then_close_connection():
     """
@@ -156,28 +215,25 @@ def test_lock_resourceX_then_close_connection():
 
         # make sure the access is granted
         assert data == 'You have an exclusive access to resource resourceX'
-        assert client_lock.check_status() == 'busy'
+        assert wait_for_status(client_lock, 'busy')
 
         # make sure this operation stored into the db
         #select operations
         # client_ip_address, operation_time, operation_type
-        operations = get_operations_by_resource_id(resource_id)
+        operations = wait_for_operations(resource_id, 1)
         assert len(operations) == 1
         assert operations[0][0] == client_address
         assert operations[0][2] == "lock"
 
         # the client terminate the connection
         s.close()
-
-        #delete operations
-        delete_operation_by_resource_id(resource_id)
     elif status == 'busy':
         s.sendall('lock resourceX')
         data = s.recv(1024)
 
         # make sure the resourceX is busy
         assert data == 'required resource is busy now, you have to wait a while'
-        assert client_lock.check_status() == 'busy'
+        assert wait_for_status(client_lock, 'busy')
 
         # the client terminate the connection
         s.close()
@@ -186,7 +242,10 @@ def test_lock_resourceX_then_close_connection():
     time.sleep(5)
 
     # make sure the server make resourceX free after the client terminates the connection
-    assert client_lock.check_status() == 'free'
+    assert wait_for_status(client_lock, 'free')
+
+    #delete operations, including the release stored by the server cleaning up
+    delete_operation_by_resource_id(resource_id)
 
 def test_access_locked_resource():
     """
@@ -211,12 +270,12 @@ def test_access_locked_resource():
 
         # make sure the access is granted
         assert data == 'You have an exclusive access to resource resourceX'
-        assert client_lock.check_status() == 'busy'
+        assert wait_for_status(client_lock, 'busy')
 
         # make sure this operation stored into the db
         #select operations
         # client_ip_address, operation_time, operation_type
-        operations = get_operations_by_resource_id(resource_id)
+        operations = wait_for_operations(resource_id, 1)
         assert len(operations) == 1
         assert operations[0][0] == client_address
         assert operations[0][2] == "lock"
@@ -229,7 +288,7 @@ def test_access_locked_resource():
 
     # make sure the resourceX is busy and access is not granted
     assert data == 'required resource is busy now, you have to wait a while'
-    assert client_lock.check_status() == 'busy'
+    assert wait_for_status(client_lock, 'busy')
 
     # the client terminate the connection
     s2.close()
@@ -240,12 +299,12 @@ def test_access_locked_resource():
 
     # make sure the lock released and status is free now
     assert data == 'lock released from resource resourceX'
-    assert client_lock.check_status() == 'free'
+    assert wait_for_status(client_lock, 'free')
 
     # make sure this operation stored into the db
     #select operations
     # client_ip_address, operation_time, operation_type
-    operations = get_operations_by_resource_id(resource_id)
+    operations = wait_for_operations(resource_id, 2)
     assert len(operations) == 2
     assert operations[0][0] == client_address
     assert operations[0][2] == "lock"
@@ -261,9 +320,9 @@ def test_access_locked_resource():
 def test_access_locked_resource_then_unlock_before_timeout():
     """
     TestCase Senario:
-    there are 2 sockets s1 and s2. s1 lock resourceX then s2 tries to access resourceX but he couldn't so s2 have to wait TIMEOUT
-    to retry but before the TIMEOUT ends, s1 release the lock so resourceX become free when TIMEOUT ends and s2 retries to access
-    resourceX then it gains exclusive access to resourceX.
+    there are 2 sockets s1 and s2. s1 lock resourceX then s2 tries to access resourceX but he couldn't so s2 waits
+    at most TIMEOUT. before the TIMEOUT ends, s1 release the lock so resourceX is handed over to s2 immediately
+    and s2 gains exclusive access to resourceX without waiting the whole TIMEOUT.
     """
     #targeted resource and client_address
     resource_name = 'resourceX'
@@ -281,12 +340,12 @@ def test_access_locked_resource_then_unlock_before_timeout():
 
         #make sure the access is granted and resourceX is busy
         assert data == 'You have an exclusive access to resource resourceX'
-        assert client_lock.check_status() == 'busy'
+        assert wait_for_status(client_lock, 'busy')
 
         # make sure this operation stored in the database
         #select operations
         # client_ip_address, operation_time, operation_type
-        operations = get_operations_by_resource_id(resource_id)
+        operations = wait_for_operations(resource_id, 1)
         assert len(operations) == 1
         assert operations[0][0] == client_address
         assert operations[0][2] == "lock"
@@ -295,40 +354,34 @@ def test_access_locked_resource_then_unlock_before_timeout():
     s2 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s2.connect((HOST,PORT))
     s2.sendall('lock resourceX')
-    assert client_lock.check_status() == 'busy'
+    assert wait_for_status(client_lock, 'busy')
+
+    # give the server a moment to receive the request of s2 before the release of s1
+    time.sleep(0.5)
 
     # before TIMEOUT ends, s1 release resourceX
+    start_time = time.time()
     s1.sendall('release resourceX')
     data = s1.recv(1024)
 
-    # make sure it released the resource successfully and resourceX is free
+    # make sure it released the resource successfully
     assert data == 'lock released from resource resourceX'
-    assert client_lock.check_status() == 'free'
-
-    # make sure this operation stored in the database
-    #select operations
-    # client_ip_address, operation_time, operation_type
-    operations = get_operations_by_resource_id(resource_id)
-    assert len(operations) == 2
-    assert operations[0][0] == client_address
-    assert operations[0][2] == "lock"
-    assert operations[1][0] == client_address
-    assert operations[1][2] == "release"
 
     # close socket connection
     s1.close()
 
-    # when s2 retries again, it locks resourceX and have an exclusive access
+    # s2 does not wait for the TIMEOUT, it locks resourceX as soon as s1 releases it
     data = s2.recv(1024)
+    assert time.time() - start_time < 1
 
     #make sure the access is granted and resourceX is busy
     assert data == 'You have an exclusive access to resource resourceX'
-    assert client_lock.check_status() == 'busy'
+    assert wait_for_status(client_lock, 'busy')
 
     # make sure this operation stored in the database
     #select operations
     # client_ip_address, operation_time, operation_type
-    operations = get_operations_by_resource_id(resource_id)
+    operations = wait_for_operations(resource_id, 3)
     assert len(operations) == 3
     assert operations[0][0] == client_address
     assert operations[0][2] == "lock"
@@ -343,12 +396,12 @@ def test_access_locked_resource_then_unlock_before_timeout():
 
     # make sure it released the resource successfully and resourceX is free
     assert data == 'lock released from resource resourceX'
-    assert client_lock.check_status() == 'free'
+    assert wait_for_status(client_lock, 'free')
 
     # make sure this operation stored in the database
     #select operations
     # client_ip_address, operation_time, operation_type
-    operations = get_operations_by_resource_id(resource_id)
+    operations = wait_for_operations(resource_id, 4)
     assert len(operations) == 4
     assert operations[0][0] == client_address
     assert operations[0][2] == "lock"
@@ -391,12 +444,12 @@ def test_operations():
 
         #make sure resourceZ is busy and you gain access
         assert data == 'You have an exclusive access to resource resourceZ'
-        assert client_lock.check_status() == 'busy'
+        assert wait_for_status(client_lock, 'busy')
 
         # make sure this operation stored into the db
         #select operations
         # client_ip_address, operation_time, operation_type
-        operations = get_operations_by_resource_id(resource_id)
+        operations = wait_for_operations(resource_id, 1 + initial_operations_length)
         assert len(operations) == 1 + initial_operations_length
         assert operations[initial_operations_length][0] == client_address
         assert operations[initial_operations_length][2] == "lock"
@@ -408,12 +461,12 @@ def test_operations():
 
         # make sure the lock released and the resourceZ is free now
         assert data == 'lock released from resource resourceZ'
-        assert client_lock.check_status() == 'free'
+        assert wait_for_status(client_lock, 'free')
 
         # make sure this operation stored into the db
         #select operations
         # client_ip_address, operation_time, operation_type
-        operations = get_operations_by_resource_id(resource_id)
+        operations = wait_for_operations(resource_id, 2 + initial_operations_length)
         assert len(operations) == 2 + initial_operations_length
         assert operations[initial_operations_length][0] == client_address
         assert operations[initial_operations_length][2] == "lock"
@@ -424,7 +477,7 @@ def test_operations():
         s.sendall('lock resourceZ')
         data = s.recv(1024)
         assert data == 'required resource is busy now, you have to wait a while'
-        assert client_lock.check_status() == 'busy'
+        assert wait_for_status(client_lock, 'busy')
 
     #close the socket client
     s.close()
@@ -452,19 +505,16 @@ def test_lock_resource_then_die():
 
         # make sure the access is granted
         assert data == 'You have an exclusive access to resource resourceX'
-        assert client_lock.check_status() == 'busy'
+        assert wait_for_status(client_lock, 'busy')
 
         # make sure this operation stored into the db
         #select operations
         # client_ip_address, operation_time, operation_type
-        operations = get_operations_by_resource_id(resource_id)
+        operations = wait_for_operations(resource_id, 1)
         assert len(operations) == 1
         assert operations[0][0] == client_address
         assert operations[0][2] == "lock"
 
-    #delete operations
-    delete_operation_by_resource_id(resource_id)
-
     # the client terminate the connection
     s.close()
 
@@ -472,7 +522,10 @@ def test_lock_resource_then_die():
     time.sleep(5)
 
     # make sure the server make resourceX free after the client die
-    assert client_lock.check_status() == 'free'
+    assert wait_for_status(client_lock, 'free')
+
+    #delete operations, including the release stored by the server cleaning up
+    delete_operation_by_resource_id(resource_id)
 
 def test_release_free_resource():
     """
@@ -496,7 +549,7 @@ def test_release_free_resource():
     assert data == 'resource is already free.'
 
     # the status of the resource was free and still free
-    assert client_lock.check_status() == 'free'
+    assert wait_for_status(client_lock, 'free')
 
     #close the socket client
     s.close()
@@ -558,17 +611,1227 @@ def test_access_unlisted_resource():
 def test_lock_multiple_resources():
     """
     TestCase Senario:
-    trying to acquire access to more that one resource in a single time which is not allowed
-    so the wrong message response is expected.
+    acquire access to resourceX and resourceY in a single message, then release both
+    of them in a single message
     """
+    #targeted resources and client_address
+    client_address = '127.0.0.1'
+    lock_x = Lock('resourceX', client_address)
+    lock_y = Lock('resourceY', client_address)
+
     #initiate socket s and lock resourceX and resourceY
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.connect((HOST,PORT))
     s.sendall('lock resourceX resourceY')
     data = s.recv(1024)
 
-    #expecting error message as a response
-    assert data == 'wrong message, you must send release or lock as the first word then space then the resource_name'
+    #make sure both of them are granted with a single reply
+    assert data == 'You have an exclusive access to resource resourceX resourceY'
+    assert wait_for_status(lock_x, 'busy')
+    assert wait_for_status(lock_y, 'busy')
+
+    #release both of them
+    s.sendall('release resourceX resourceY')
+    data = s.recv(1024)
+    assert data == 'lock released from resource resourceX resourceY'
+    assert wait_for_status(lock_x, 'free')
+    assert wait_for_status(lock_y, 'free')
 
     #close the socket client
     s.close()
+
+def test_lock_multiple_resources_all_or_nothing():
+    """
+    TestCase Senario:
+    s1 locks resourceY, then s2 tries to lock resourceX and resourceY in a single message,
+    s2 must not gain access to any of them
+    """
+    #targeted resources and client_address
+    client_address = '127.0.0.1'
+    lock_x = Lock('resourceX', client_address)
+    lock_y = Lock('resourceY', client_address)
+
+    #initiate socket s1 and lock resourceY
+    s1 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s1.connect((HOST,PORT))
+    s1.sendall('lock resourceY')
+    data = s1.recv(1024)
+    assert data == 'You have an exclusive access to resource resourceY'
+
+    #initiate socket s2 and lock resourceX and resourceY, it is refused immediately
+    s2 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s2.connect((HOST,PORT))
+    s2.sendall('lock resourceX resourceY')
+    data = s2.recv(1024)
+    assert data == 'required resource is busy now, you have to wait a while'
+
+    #make sure resourceX is not locked by s2
+    assert wait_for_status(lock_x, 'free')
+    assert wait_for_status(lock_y, 'busy')
+
+    #s2 can not release resources it does not hold
+    s2.sendall('release resourceX resourceY')
+    data = s2.recv(1024)
+    assert data == 'resource is already free.'
+
+    #an unlisted resource refuses the whole message
+    s2.sendall('lock resourceX UnknownResource')
+    data = s2.recv(1024)
+    assert data == 'required resource is not listed'
+    assert wait_for_status(lock_x, 'free')
+
+    #close the socket clients, s1 releases resourceY
+    s1.close()
+    s2.close()
+    assert wait_for_status(lock_y, 'free')
+
+def test_many_idle_connections():
+    """
+    TestCase Senario:
+    open a lot of idle connections to the server then make sure that
+    the server still answers a new client immediately
+    """
+    #initiate many idle sockets
+    idle_sockets = []
+    for i in range(200):
+        idle = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        idle.connect((HOST,PORT))
+        idle_sockets.append(idle)
+
+    #initiate socket s and send a message to the server
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.connect((HOST,PORT))
+    s.sendall('lock UnknownResource')
+    data = s.recv(1024)
+
+    #expecting the normal response
+    assert data == 'required resource is not listed'
+
+    #close all the socket clients
+    s.close()
+    for idle in idle_sockets:
+        idle.close()
+
+def test_connection_pool():
+    """
+    TestCase Senario:
+    make sure that the database functions reuse the pooled connections
+    instead of opening a new connection for every query
+    """
+    #nested checkouts in the same thread share the connection
+    with checkout() as conn1:
+        with checkout() as conn2:
+            assert conn1 is conn2
+
+    #the connection is given back to the pool and reused by the next checkout
+    with checkout() as conn3:
+        assert conn3 is conn1
+        assert conn3.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+
+    #a connection that fails to open gives its slot back to the pool
+    import database_functions
+    def fail():
+        raise sqlite3.OperationalError('unable to open database file')
+    real_connect = database_functions.connect
+    database_functions.connect = fail
+    small_pool = ConnectionPool(1)
+    try:
+        for attempt in range(2):
+            try:
+                small_pool.get()
+                assert False
+            except sqlite3.OperationalError:
+                pass
+        assert small_pool.opened == 0
+    finally:
+        database_functions.connect = real_connect
+    conn4 = small_pool.get()
+    assert small_pool.opened == 1
+    conn4.close()
+
+def test_lock_table():
+    """
+    TestCase Senario:
+    lock and release resourceZ using an in memory lock table then make sure
+    that the changes are written behind to the database
+    """
+    from lock_table import LockTable
+
+    #targeted resource and client_address
+    resource_name = 'resourceZ'
+    resource_id = get_resource_id_by_name(resource_name)[0]
+    initial_operations_length = len(get_operations_by_resource_id(resource_id))
+    client_address = '10.0.0.1'
+
+    #load the lock table from the database
+    table = LockTable()
+    table.load()
+    table.start()
+    assert table.check_status(resource_name) == 'free'
+    assert table.check_status('UnknownResource') is None
+
+    #lock resourceZ in memory, a second lock fails
+    assert table.acquire(resource_name, client_address, '2017-01-01 00:00:00')
+    assert not table.acquire(resource_name, '10.0.0.2', '2017-01-01 00:00:01')
+    assert table.check_status(resource_name) == 'busy'
+    assert table.get_client_address(resource_name) == (client_address,)
+
+    #make sure the database has the change after the flush
+    table.flush()
+    assert get_resource_status(resource_name)[0] == 'busy'
+
+    #only the owner can release resourceZ
+    assert not table.release(resource_name, '10.0.0.2', '2017-01-01 00:00:02')
+    assert table.release(resource_name, client_address, '2017-01-01 00:00:03')
+    table.flush()
+    assert get_resource_status(resource_name)[0] == 'free'
+
+    #make sure the operations are stored in the database
+    operations = get_operations_by_resource_id(resource_id)
+    assert len(operations) == 2 + initial_operations_length
+    assert operations[initial_operations_length][2] == "lock"
+    assert operations[1 + initial_operations_length][2] == "release"
+
+    #a loaded table applies the changes of a leader without a snapshot, a table that is not loaded knows no resource
+    assert LockTable().names == {}
+    token = table.entries[resource_name].token
+    table.apply([resource_id, 'busy', '10.0.0.3', None, ['10.0.0.3', '2017-01-01 00:00:04', 'lock', resource_id], token + 1])
+    assert table.get_client_address(resource_name) == ('10.0.0.3',)
+    table.apply([resource_id, 'free', None, None, ['10.0.0.3', '2017-01-01 00:00:05', 'release', resource_id], token + 1])
+    table.flush()
+    assert get_resource_status(resource_name)[0] == 'free'
+
+def test_concurrent_acquire():
+    """
+    TestCase Senario:
+    many threads try to lock resourceY at the same time as different clients,
+    only one of them must gain the exclusive access
+    """
+    import threading
+
+    #targeted resource
+    resource_name = 'resourceY'
+    resource_id = get_resource_id_by_name(resource_name)[0]
+    initial_operations_length = len(get_operations_by_resource_id(resource_id))
+    assert Lock(resource_name, '127.0.0.1').check_status() == 'free'
+
+    #every thread tries to lock resourceY as a different client address
+    winners = []
+    def try_lock(client_address):
+        if Lock(resource_name, client_address).acquire():
+            winners.append(client_address)
+    threads = [threading.Thread(target=try_lock, args=('10.0.0.%d' % i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    #make sure only one client gains access and only one lock operation stored
+    assert len(winners) == 1
+    operations = get_operations_by_resource_id(resource_id)
+    assert len(operations) == 1 + initial_operations_length
+    assert operations[initial_operations_length][0] == winners[0]
+    assert operations[initial_operations_length][2] == "lock"
+
+    #a different client can not release it, the winner can
+    assert not Lock(resource_name, '10.0.0.100').release()
+    assert Lock(resource_name, winners[0]).release()
+    assert Lock(resource_name, winners[0]).check_status() == 'free'
+    assert len(get_operations_by_resource_id(resource_id)) == 2 + initial_operations_length
+
+def test_group_commit():
+    """
+    TestCase Senario:
+    many threads insert operations for resourceZ at the same time, the group commit
+    writer must store all of them
+    """
+    import threading
+
+    #targeted resource
+    resource_name = 'resourceZ'
+    resource_id = get_resource_id_by_name(resource_name)[0]
+    initial_operations_length = len(get_operations_by_resource_id(resource_id))
+
+    #every thread inserts 10 operations
+    def insert_operations(client_address):
+        for i in range(10):
+            insert_operation(resource_id, '2017-01-01 00:00:%02d' % i, "lock", client_address)
+    threads = [threading.Thread(target=insert_operations, args=('10.0.1.%d' % i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    operations_writer.wait(operations_writer.append(('10.0.1.100', '2017-01-01 00:01:00', "release", resource_id)))
+
+    #make sure all the operations are stored
+    operations = get_operations_by_resource_id(resource_id)
+    assert len(operations) == 81 + initial_operations_length
+    assert operations[-1][0] == '10.0.1.100'
+
+    #a writer whose database can not be opened yet keeps retrying, its waiter is woken up once the batch is committed
+    import shutil
+    import sqlite3
+    from settings import WRITE_BEHIND_RETRY
+    writer = OperationsWriter(10, 0.001, os.path.join('resources_writer', 'resources_writer.sqlite'))
+    batch = writer.append(('10.0.1.101', '2017-01-01 00:02:00', "lock", resource_id))
+    committed = threading.Event()
+    waiter = threading.Thread(target=lambda: (writer.wait(batch), committed.set()))
+    waiter.daemon = True
+    waiter.start()
+    try:
+        time.sleep(0.2)
+        assert writer.thread.is_alive() and not committed.is_set()
+        os.mkdir('resources_writer')
+        assert committed.wait(WRITE_BEHIND_RETRY + 5)
+        con = sqlite3.connect(os.path.join('resources_writer', 'resources_writer.sqlite'))
+        assert con.execute("select client_ip_address from operations").fetchall() == [('10.0.1.101',)]
+        con.close()
+    finally:
+        shutil.rmtree('resources_writer', ignore_errors=True)
+
+def test_framed_pipelining():
+    """
+    TestCase Senario:
+    switch to the framed protocol then pipeline many commands in a single message,
+    with a frame split across two messages, and make sure that the replies come back
+    in order tagged with their request ids
+    """
+    #initiate socket s and switch to the framed protocol
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.connect((HOST,PORT))
+    s.sendall('framed\n1 lock resourceZ\n2 lock UnknownResource\n3 Hi Socket\n4 release resourceZ\n5 lock reso')
+    time.sleep(0.5)
+    s.sendall('urceZ\n6 release resourceZ\n')
+
+    #read until all the replies are received
+    data = ''
+    while data.count('\n') < 7:
+        data += s.recv(1024)
+
+    #expecting the replies in order
+    assert data.split('\n')[:7] == [
+        'framed protocol on',
+        '1 You have an exclusive access to resource resourceZ',
+        '2 required resource is not listed',
+        '3 wrong message, you must send release or lock as the first word then space then the resource_name',
+        '4 lock released from resource resourceZ',
+        '5 You have an exclusive access to resource resourceZ',
+        '6 lock released from resource resourceZ',
+    ]
+
+    #close the socket client
+    s.close()
+
+def test_client_library():
+    """
+    TestCase Senario:
+    lock resourceZ inside a with block of the client library, another client must wait for it. then the client,
+    with a pool of a single connection, acquires resourceZ while its pooled connection is checked out and keeps it
+    until it releases it, and many threads acquire and release resourceZ through the same client one at a time.
+    finally pipeline a batch of commands on the pooled connection
+    """
+    import threading
+    from client import LockClient, LockError
+
+    client = LockClient(HOST, PORT, pool_size=1)
+
+    with client.lock('resourceZ'):
+        assert wait_for_status(Lock('resourceZ', '127.0.0.1'), "busy")
+        #the other client gets resourceZ after the with block releases it
+        start = time.time()
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('127.0.0.2', 0))
+        s.connect(('127.0.0.2', PORT))
+        s.sendall('lock resourceZ')
+        time.sleep(0.5)
+    assert s.recv(1024) == 'You have an exclusive access to resource resourceZ'
+    assert time.time() - start < 2
+    s.sendall('release resourceZ')
+    assert s.recv(1024) == 'lock released from resource resourceZ'
+    s.close()
+
+    #the lock is held by its own connection, which does not go back to the full pool
+    with client.connection():
+        token = client.acquire('resourceZ')
+    assert len(client.idle) == 1
+    time.sleep(0.2)
+    assert Lock('resourceZ', '127.0.0.1').check_status() == "busy"
+    client.release('resourceZ')
+    assert wait_for_status(Lock('resourceZ', '127.0.0.1'), "free")
+
+    #the release goes to the connection holding the lock while the pooled connection is checked out
+    token = client.acquire('resourceZ')
+    with client.connection():
+        client.release('resourceZ')
+    assert wait_for_status(Lock('resourceZ', '127.0.0.1'), "free")
+    assert len(client.idle) == 1
+
+    #concurrent callers hold resourceZ one at a time and get increasing tokens
+    tokens = []
+    errors = []
+    inside = []
+    def worker():
+        try:
+            for i in range(5):
+                tokens.append(client.acquire('resourceZ'))
+                inside.append(1)
+                assert len(inside) == 1
+                time.sleep(0.01)
+                inside.pop()
+                client.release('resourceZ')
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=worker) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(set(tokens)) == 40 and min(tokens) > token
+    assert client.pinned == {} and client.held == {}
+
+    #pipelined batch on the pooled connection
+    assert client.batch(['lock resourceZ', 'lock UnknownResource', 'release resourceZ']) == [
+        'You have an exclusive access to resource resourceZ',
+        'required resource is not listed',
+        'lock released from resource resourceZ',
+    ]
+    assert len(client.idle) == 1
+
+    #unlisted resources raise an error
+    try:
+        client.acquire('UnknownResource')
+        assert False
+    except LockError as e:
+        assert str(e) == 'required resource is not listed'
+    client.close()
+
+def test_timer_wheel():
+    """
+    TestCase Senario:
+    schedule timers on a small wheel so most of them cascade through its levels or wait in
+    its last slot, cancel some of them, and make sure the others fire once, not before their delay
+    """
+    import threading
+    from timer_wheel import TimerWheel
+
+    wheel = TimerWheel(tick=0.005, slots=4, levels=2)
+    fired = {}
+    done = threading.Event()
+    start = time.time()
+    def fire(i):
+        fired[i] = time.time() - start
+        if len(fired) == 15:
+            done.set()
+
+    timers = [wheel.schedule(i * 0.02, fire, i) for i in range(20)]
+    for i in range(15, 20):
+        assert wheel.cancel(timers[i])
+    done.wait(2)
+    time.sleep(0.1)
+
+    #the cancelled timers never fire
+    assert sorted(fired) == range(15)
+    for i in range(15):
+        assert fired[i] >= i * 0.02 - 0.005
+        assert fired[i] < i * 0.02 + 0.2
+    assert not wheel.cancel(timers[0])
+
+def test_lease_expiry():
+    """
+    TestCase Senario:
+    s1 locks resourceZ with a lease and renews it once, s2 waits for resourceZ.
+    s1 does not release it, so after the lease ends resourceZ is handed over to s2
+    """
+    #initiate socket s1 and lock resourceZ with a 300 ms lease
+    s1 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s1.connect((HOST,PORT))
+    s1.sendall('lock resourceZ ttl=300')
+    assert s1.recv(1024) == 'You have an exclusive access to resource resourceZ'
+    start = time.time()
+
+    #a ttl has to be a positive number of milliseconds
+    s1.sendall('renew resourceZ ttl=-5')
+    assert s1.recv(1024).startswith('wrong message')
+
+    #renew the lease for 600 ms
+    time.sleep(0.2)
+    s1.sendall('renew resourceZ ttl=600')
+    assert s1.recv(1024) == 'lease renewed for resource resourceZ'
+
+    #s2 gets resourceZ after the renewed lease ends
+    s2 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s2.bind(('127.0.0.2', 0))
+    s2.connect(('127.0.0.2', PORT))
+    s2.sendall('lock resourceZ')
+    assert s2.recv(1024) == 'You have an exclusive access to resource resourceZ'
+    assert 0.75 < time.time() - start < 2
+
+    #the lease of s1 is over
+    s1.sendall('renew resourceZ ttl=600')
+    assert s1.recv(1024) == 'it is not allowed to release someone else resource'
+    s2.sendall('release resourceZ')
+    assert s2.recv(1024) == 'lock released from resource resourceZ'
+    s1.close()
+    s2.close()
+
+def test_shared_lock():
+    """
+    TestCase Senario:
+    two readers share resourceZ at the same time, then a writer waits for them. a third reader
+    that comes after the writer waits behind it, so it gets resourceZ after the writer releases it
+    """
+    #targeted resource
+    resource_name = 'resourceZ'
+    resource_id = get_resource_id_by_name(resource_name)[0]
+
+    #connect a client from every address
+    clients = []
+    for i in range(1, 5):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('127.0.0.%d' % i, 0))
+        s.connect(('127.0.0.%d' % i, PORT))
+        clients.append(s)
+    reader1, reader2, writer, reader3 = clients
+
+    #both readers share resourceZ
+    reader1.sendall('lock_shared resourceZ')
+    assert reader1.recv(1024) == 'You have a shared access to resource resourceZ'
+    reader2.sendall('lock_shared resourceZ')
+    assert reader2.recv(1024) == 'You have a shared access to resource resourceZ'
+    assert wait_for_status(Lock(resource_name, '127.0.0.1'), "shared")
+
+    #the writer waits for the readers, the third reader waits behind the writer
+    writer.sendall('lock resourceZ')
+    time.sleep(0.5)
+    reader3.sendall('lock_shared resourceZ')
+    time.sleep(0.5)
+
+    #the writer still waits for the second reader after the first one releases resourceZ
+    reader1.sendall('release resourceZ')
+    assert reader1.recv(1024) == 'lock released from resource resourceZ'
+    writer.settimeout(0.3)
+    try:
+        writer.recv(1024)
+        assert False
+    except socket.timeout:
+        pass
+    writer.settimeout(None)
+    reader2.sendall('release resourceZ')
+    assert reader2.recv(1024) == 'lock released from resource resourceZ'
+    assert writer.recv(1024) == 'You have an exclusive access to resource resourceZ'
+    writer.sendall('release resourceZ')
+    assert writer.recv(1024) == 'lock released from resource resourceZ'
+    assert reader3.recv(1024) == 'You have a shared access to resource resourceZ'
+    reader3.sendall('release resourceZ')
+    assert reader3.recv(1024) == 'lock released from resource resourceZ'
+
+    #the shared locks are stored in the operations table, after the operations of the previous tests
+    expected = ["lock_shared", "lock_shared", "release", "release", "lock", "release", "lock_shared", "release"]
+    for i in range(100):
+        operations = get_operations_by_resource_id(resource_id)
+        if [operation[2] for operation in operations[-8:]] == expected:
+            break
+        time.sleep(0.01)
+    assert [operation[2] for operation in operations[-8:]] == expected
+    assert wait_for_status(Lock(resource_name, '127.0.0.1'), "free")
+
+    for s in clients:
+        s.close()
+
+def test_sharded_server():
+    """
+    TestCase Senario:
+    start a router with 4 shards on another port. resourceX and resourceZ are owned by shard 2
+    and resourceY by shard 0, every lock is stored in the database file of its shard.
+    a command can not mix resources of different shards, and the shards release the resources
+    of a client after it disconnects from the router
+    """
+    import sqlite3
+    import subprocess
+    import sys
+    from shard_router import shard_of
+
+    assert [shard_of(name, 4) for name in ('resourceX', 'resourceY', 'resourceZ')] == [2, 0, 2]
+    for shard in range(4):
+        if os.path.exists('resources_testing_shard%d.sqlite' % shard):
+            os.remove('resources_testing_shard%d.sqlite' % shard)
+
+    env = dict(os.environ, lock_shards="4", lock_server_port="8899", lock_shard_base_port="9100", lock_recovery_grace="0")
+    router = subprocess.Popen([sys.executable, 'socket_server.py'], env=env)
+    try:
+        for i in range(100):
+            try:
+                s = socket.create_connection((HOST, 8899))
+                break
+            except socket.error:
+                time.sleep(0.1)
+
+        s.sendall('framed\n1 lock resourceX resourceZ\n2 lock resourceY\n3 lock resourceX resourceY\n4 lock UnknownResource\n')
+        data = ''
+        while data.count('\n') < 5:
+            data += s.recv(1024)
+        assert data.split('\n')[:5] == [
+            'framed protocol on',
+            '1 You have an exclusive access to resource resourceX resourceZ',
+            '2 You have an exclusive access to resource resourceY',
+            '3 the resources are owned by different shards, lock or release them separately',
+            '4 required resource is not listed',
+        ]
+
+        #every shard keeps only its own resources
+        def states(shard):
+            con = sqlite3.connect('resources_testing_shard%d.sqlite' % shard)
+            rows = con.execute("select resource_name, current_state from resources_names").fetchall()
+            con.close()
+            return dict(rows)
+        for i in range(100):
+            if states(2) == {'resourceX': 'busy', 'resourceZ': 'busy'} and states(0) == {'resourceY': 'busy'}:
+                break
+            time.sleep(0.01)
+        assert states(2) == {'resourceX': 'busy', 'resourceZ': 'busy'}
+        assert states(0) == {'resourceY': 'busy'}
+        assert states(1) == {}
+
+        #only the router can send the proxy message to a shard
+        for message in ('proxy 10.9.9.9\n', 'proxy 10.9.9.9 secret\n'):
+            shard = socket.create_connection((HOST, 9102))
+            shard.sendall(message)
+            assert shard.recv(1024) == 'wrong message, you must send release or lock as the first word then space then the resource_name'
+            shard.close()
+
+        #the resources are released after the client disconnects
+        s.close()
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('127.0.0.2', 0))
+        s.connect(('127.0.0.2', 8899))
+        s.sendall('lock resourceY')
+        assert s.recv(1024) == 'You have an exclusive access to resource resourceY'
+        s.close()
+    finally:
+        router.terminate()
+        router.wait()
+        for shard in range(4):
+            os.remove('resources_testing_shard%d.sqlite' % shard)
+
+def test_replication():
+    """
+    TestCase Senario:
+    start a leader on another port, a client locks resourceX on it. then start a follower on a new database, it
+    gets the lock state without the operations of resourceX. the client locks resourceY with a ttl and the follower
+    refuses the commands. after the leader dies the follower is promoted, it keeps the lock of resourceX so the client
+    releases it on the follower, and the lease of resourceY ends on the follower
+    """
+    import signal
+    import sqlite3
+    import subprocess
+    import sys
+
+    copyfile('resources_testing.sqlite', 'resources_leader.sqlite')
+    if os.path.exists('resources_follower.sqlite'):
+        os.remove('resources_follower.sqlite')
+    subprocess.check_call([sys.executable, 'schema.py', 'resourceX', 'resourceY', 'resourceZ'],
+                          env=dict(os.environ, lock_database_name="resources_follower.sqlite"))
+    leader = subprocess.Popen([sys.executable, 'socket_server.py'], env=dict(
+        os.environ, lock_server_port="8898", lock_replication_port="9300", lock_database_name="resources_leader.sqlite",
+        lock_recovery_grace="0"))
+    follower = None
+
+    def connect(port):
+        for i in range(100):
+            try:
+                return socket.create_connection((HOST, port))
+            except socket.error:
+                time.sleep(0.1)
+
+    def follower_state():
+        con = sqlite3.connect('resources_follower.sqlite')
+        state = con.execute("select current_state, client_address from resources_names where resource_name = 'resourceX'").fetchone()
+        con.close()
+        return state
+
+    try:
+        s1 = connect(8898)
+        s1.sendall('lock resourceX')
+        assert s1.recv(1024) == 'You have an exclusive access to resource resourceX'
+
+        #the follower connects after resourceX is locked, the follower does not accept the commands
+        follower = subprocess.Popen([sys.executable, 'socket_server.py'], env=dict(
+            os.environ, lock_server_port="8897", lock_replica_of="127.0.0.1:9300", lock_database_name="resources_follower.sqlite",
+            lock_recovery_grace="5000"))
+        s2 = connect(8897)
+        s1.sendall('lock resourceY ttl=1500')
+        assert s1.recv(1024) == 'You have an exclusive access to resource resourceY'
+        leased = time.time()
+        s2.sendall('release resourceX')
+        assert s2.recv(1024) == 'this server is a follower, send the commands to the leader'
+
+        #the follower writes the replicated state to its own database
+        for i in range(100):
+            if follower_state() == ('busy', '127.0.0.1'):
+                break
+            time.sleep(0.01)
+        assert follower_state() == ('busy', '127.0.0.1')
+
+        #the leader dies, the follower is promoted and already knows that resourceX is locked
+        leader.kill()
+        leader.wait()
+        follower.send_signal(signal.SIGUSR1)
+        time.sleep(0.5)
+        s2.sendall('status resourceX')
+        assert s2.recv(1024) == 'locked resourceX 127.0.0.1'
+        s2.sendall('release resourceX')
+        assert s2.recv(1024) == 'lock released from resource resourceX'
+
+        #the follower expires resourceY when the leader would have expired it
+        s2.sendall('status resourceY')
+        assert s2.recv(1024) == 'locked resourceY 127.0.0.1'
+        time.sleep(max(0, leased + 2 - time.time()))
+        s2.sendall('status resourceY')
+        assert s2.recv(1024) == 'released resourceY'
+        s1.close()
+        s2.close()
+    finally:
+        if leader.poll() is None:
+            leader.kill()
+        leader.wait()
+        if follower is not None:
+            follower.terminate()
+            follower.wait()
+        for name in ('resources_leader.sqlite', 'resources_follower.sqlite'):
+            if os.path.exists(name):
+                os.remove(name)
+
+def test_benchmark():
+    #nearest rank percentiles of the latencies
+    latencies = [i / 1000.0 for i in range(1, 1001)]
+    assert percentile(latencies, 0.5) == 0.5
+    assert percentile(latencies, 0.99) == 0.99
+    assert percentile(latencies, 0.999) == 0.999
+    assert percentile([], 0.5) is None
+    result = summarize(latencies, 2.0, 0)
+    assert result["operations"] == 1000
+    assert result["throughput"] == 500
+    assert result["latency_ms"]["p99"] == 990
+
+    #a short run against the running server
+    result = uncontended(HOST, PORT, ['resourceX'], 1, 10)
+    assert result["operations"] == 20
+    assert result["errors"] == 0
+
+def test_stats():
+    """
+    TestCase Senario:
+    lock and release resourceX, send a wrong message then check the metrics sent by the stats command
+    """
+    import json
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.connect((HOST, PORT))
+    s.sendall('lock resourceX')
+    assert s.recv(1024) == 'You have an exclusive access to resource resourceX'
+    s.sendall('release resourceX')
+    assert s.recv(1024) == 'lock released from resource resourceX'
+    s.sendall('unlock resourceX')
+    s.recv(1024)
+
+    s.sendall('stats')
+    stats = json.loads(s.recv(65536))
+    s.close()
+    assert stats["counters"]["grants"] >= 1
+    assert stats["counters"]["releases"] >= 1
+    assert stats["counters"]["denials"] >= 1
+    assert stats["gauges"]["connections"] >= 1
+    assert stats["gauges"]["waiters"] == 0
+    assert stats["histograms"]["lock"]["count"] >= 1
+    assert stats["histograms"]["lock"]["p99_ms"] is not None
+
+def test_schema():
+    """
+    TestCase Senario:
+    create a database from scratch, migrate it again then check that the lookups use the indexes
+    """
+    import sqlite3
+    from schema import migrate, add_resources, get_version, SCHEMA_VERSION
+
+    if os.path.exists('resources_schema.sqlite'):
+        os.remove('resources_schema.sqlite')
+    con = sqlite3.connect('resources_schema.sqlite')
+    try:
+        assert migrate(con) == range(1, SCHEMA_VERSION + 1)
+        assert get_version(con) == SCHEMA_VERSION
+        #the migrations run once, the resources already listed are skipped
+        assert migrate(con) == []
+        add_resources(con, ['resourceA', 'resourceB', 'resourceA'])
+        assert con.execute("select resource_name, current_state from resources_names").fetchall() == \
+            [('resourceA', 'free'), ('resourceB', 'free')]
+
+        for sql_query in ("select resource_id from resources_names where client_address = ?",
+                          "select resource_id from resources_names where resource_name = ?",
+                          "select operation_time from operations where resource_id = ?"):
+            plan = " ".join(str(row[-1]) for row in con.execute("explain query plan " + sql_query, ('x',)))
+            assert "INDEX" in plan
+    finally:
+        con.close()
+        os.remove('resources_schema.sqlite')
+
+def test_retention():
+    """
+    TestCase Senario:
+    write some old operations of resourceY then move them to an archive database in chunks,
+    the recent operations stay in the database
+    """
+    import sqlite3
+    from retention import run_retention
+
+    if os.path.exists('resources_test_archive.sqlite'):
+        os.remove('resources_test_archive.sqlite')
+    resource_id = get_resource_id_by_name('resourceY')[0]
+    recent = len(get_operations_by_resource_id(resource_id))
+    for day in range(1, 6):
+        insert_operation(resource_id, '2000-01-0%d 00:00:00.000000' % day, "lock", '10.0.0.1')
+
+    try:
+        #about 10 years, only the operations written in 2000 are older
+        assert run_retention(315360000, chunk=2, pause=0, archive_name='resources_test_archive.sqlite') == 5
+        assert len(get_operations_by_resource_id(resource_id)) == recent
+        assert run_retention(315360000, chunk=2, pause=0, archive_name='resources_test_archive.sqlite') == 0
+
+        con = sqlite3.connect('resources_test_archive.sqlite')
+        archived = con.execute("select resource_name, operation_time, client_ip_address from operations_archive order by operation_id").fetchall()
+        con.close()
+        assert archived == [('resourceY', '2000-01-0%d 00:00:00.000000' % day, '10.0.0.1') for day in range(1, 6)]
+    finally:
+        os.remove('resources_test_archive.sqlite')
+
+def test_history():
+    """
+    TestCase Senario:
+    write some operations of resourceZ then read them back a page at a time,
+    using the history command and the client library with the since, client and type filters
+    """
+    import json
+    from client import LockClient
+
+    resource_id = get_resource_id_by_name('resourceZ')[0]
+    for day in range(1, 8):
+        insert_operation(resource_id, '2001-01-0%d 00:00:00.000000' % day, "lock" if day % 2 else "release",
+                         '10.0.2.%d' % (day % 3))
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.connect((HOST, PORT))
+    s.sendall('history resourceZ since=2001-01-02T00:00:00 limit=2')
+    page = json.loads(s.recv(65536))
+    assert [operation[1] for operation in page["operations"]] == ['2001-01-02 00:00:00.000000', '2001-01-03 00:00:00.000000']
+    s.sendall('history resourceZ since=2001-01-02T00:00:00 limit=2 after=%d' % page["next"])
+    page = json.loads(s.recv(65536))
+    assert [operation[1] for operation in page["operations"]] == ['2001-01-04 00:00:00.000000', '2001-01-05 00:00:00.000000']
+    #an unknown after is refused instead of starting over
+    s.sendall('history resourceZ since=2001-01-02T00:00:00 limit=2 after=999999999')
+    assert s.recv(1024) == 'unknown after, the operation is not in the history of the resource'
+    s.sendall('history resourceZ limit=2 ttl=5')
+    assert s.recv(1024) == 'wrong message, you must send release or lock as the first word then space then the resource_name'
+    s.sendall('history resourceW')
+    assert s.recv(1024) == 'required resource is not listed'
+    s.close()
+
+    client = LockClient(HOST, PORT)
+    operations = list(client.history('resourceZ', type='lock', client='10.0.2.1', limit=1))
+    client.close()
+    assert [operation[1] for operation in operations] == ['2001-01-01 00:00:00.000000', '2001-01-07 00:00:00.000000']
+
+def test_sessions():
+    """
+    TestCase Senario:
+    two connections of the same client address, the first one locks resourceY and shares resourceZ twice.
+    the second one can not release them and its disconnect keeps them locked,
+    the disconnect of the first one releases all of them. then two clients of the client library:
+    the locks of one of them can not be released by the other one and are released when it is closed
+    """
+    from client import LockClient, LockError
+
+    s1 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s1.connect((HOST, PORT))
+    s2 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s2.connect((HOST, PORT))
+    s1.sendall('lock resourceY')
+    assert s1.recv(1024) == 'You have an exclusive access to resource resourceY'
+    for i in range(2):
+        s1.sendall('lock_shared resourceZ')
+        assert s1.recv(1024) == 'You have a shared access to resource resourceZ'
+    #the locks belong to the session of the first connection
+    s2.sendall('release resourceY')
+    assert s2.recv(1024) == 'it is not allowed to release someone else resource'
+    s2.close()
+    time.sleep(0.2)
+    assert Lock('resourceY', '127.0.0.1').check_status() == "busy"
+    assert Lock('resourceZ', '127.0.0.1').check_status() == "shared"
+
+    s1.close()
+    assert wait_for_status(Lock('resourceY', '127.0.0.1'), "free")
+    assert wait_for_status(Lock('resourceZ', '127.0.0.1'), "free")
+
+    first = LockClient(HOST, PORT, cache_size=0)
+    second = LockClient(HOST, PORT, cache_size=0)
+    first.acquire('resourceY')
+    first.acquire('resourceZ', shared=True)
+    #the locks belong to the session of the connection of the first client
+    try:
+        second.release('resourceY')
+        assert False
+    except LockError as e:
+        assert str(e) == 'it is not allowed to release someone else resource'
+    second.close()
+    time.sleep(0.2)
+    assert Lock('resourceY', '127.0.0.1').check_status() == "busy"
+    #the first client releases resourceY over the connection that locked it, closing it releases resourceZ
+    first.release('resourceY')
+    assert wait_for_status(Lock('resourceY', '127.0.0.1'), "free")
+    assert Lock('resourceZ', '127.0.0.1').check_status() == "shared"
+    first.close()
+    assert wait_for_status(Lock('resourceZ', '127.0.0.1'), "free")
+
+def test_fencing_tokens():
+    """
+    TestCase Senario:
+    lock resourceX with the fence option, a second client waits for it and gets a higher token
+    after the release, then the client library locks resourceX and resourceY and gets a token for each
+    """
+    from client import LockClient
+
+    s1 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s1.connect((HOST, PORT))
+    s1.sendall('lock resourceX fence=1')
+    reply = s1.recv(1024)
+    assert reply.startswith('You have an exclusive access to resource resourceX token=')
+    first_token = int(reply.rsplit('=', 1)[1])
+
+    s2 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s2.connect((HOST, PORT))
+    s2.sendall('lock resourceX fence=1')
+    time.sleep(0.2)
+    s1.sendall('release resourceX')
+    assert s1.recv(1024) == 'lock released from resource resourceX'
+    reply = s2.recv(1024)
+    assert reply.startswith('You have an exclusive access to resource resourceX token=')
+    second_token = int(reply.rsplit('=', 1)[1])
+    assert second_token > first_token
+    s2.sendall('release resourceX')
+    assert s2.recv(1024) == 'lock released from resource resourceX'
+    s1.close()
+    s2.close()
+
+    client = LockClient(HOST, PORT, pool_size=1)
+    with client.lock('resourceY', 'resourceX') as tokens:
+        assert len(tokens) == 2
+        assert tokens[1] > second_token
+    assert client.acquire('resourceX') > tokens[1]
+    client.release('resourceX')
+    client.close()
+
+def test_watch():
+    """
+    TestCase Senario:
+    watch resourceX over a framed connection, another client locks and releases it and the watcher
+    gets an event for every change, then it stops watching and gets no more events
+    """
+    def read_lines(s, count):
+        data = ''
+        while data.count('\n') < count:
+            data += s.recv(1024)
+        return data.split('\n')[:count]
+
+    #the events are sent only over framed connections
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.connect((HOST, PORT))
+    s.sendall('watch resourceX')
+    assert s.recv(1024) == 'watch needs the framed protocol, send framed first'
+    s.close()
+
+    watcher = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    watcher.connect((HOST, PORT))
+    watcher.sendall('framed\n1 watch resourceX\n2 watch UnknownResource\n')
+    lines = read_lines(watcher, 4)
+    assert lines[0] == 'framed protocol on'
+    #the current state may be sent before the replies
+    assert sorted(lines[1:]) == sorted([
+        '1 watching resource resourceX',
+        '2 required resource is not listed',
+        '* released resourceX',
+    ])
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.connect((HOST, PORT))
+    s.sendall('lock resourceX')
+    assert s.recv(1024) == 'You have an exclusive access to resource resourceX'
+    assert read_lines(watcher, 1) == ['* locked resourceX 127.0.0.1']
+    s.sendall('release resourceX')
+    assert s.recv(1024) == 'lock released from resource resourceX'
+    assert read_lines(watcher, 1) == ['* released resourceX']
+
+    watcher.sendall('3 unwatch resourceX\n4 unwatch resourceX\n')
+    assert read_lines(watcher, 2) == ['3 stopped watching resource resourceX', '4 resource is not watched']
+    s.sendall('lock resourceX')
+    assert s.recv(1024) == 'You have an exclusive access to resource resourceX'
+    s.sendall('release resourceX')
+    assert s.recv(1024) == 'lock released from resource resourceX'
+    watcher.settimeout(0.5)
+    try:
+        assert watcher.recv(1024) == ''
+        assert False
+    except socket.timeout:
+        pass
+    watcher.close()
+    s.close()
+
+def test_status_cache():
+    """
+    TestCase Senario:
+    ask the status of resourceY, it is cached and the cache follows the locks of another client
+    pushed by the server. the least recently asked resource is evicted from a full cache
+    """
+    from client import LockClient, LockError
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.connect((HOST, PORT))
+    s.sendall('status resourceY')
+    assert s.recv(1024) == 'released resourceY'
+
+    client = LockClient(HOST, PORT, cache_size=1)
+    uncached = LockClient(HOST, PORT, cache_size=0)
+    assert client.status('resourceY') == ('free', ())
+    s.sendall('lock resourceY')
+    assert s.recv(1024) == 'You have an exclusive access to resource resourceY'
+    assert uncached.status('resourceY') == ('busy', ('127.0.0.1',))
+    #the lock is pushed to the cache
+    for i in range(50):
+        if client.status('resourceY') != ('free', ()):
+            break
+        time.sleep(0.01)
+    assert client.status('resourceY') == ('busy', ('127.0.0.1',))
+    s.sendall('release resourceY')
+    assert s.recv(1024) == 'lock released from resource resourceY'
+    s.close()
+
+    #resourceY is evicted by resourceZ
+    assert client.status('resourceZ') == ('free', ())
+    assert client.cache.entries.keys() == ['resourceZ']
+    assert client.cache.watching == set(['resourceZ'])
+    try:
+        client.status('UnknownResource')
+        assert False
+    except LockError as e:
+        assert str(e) == 'required resource is not listed'
+    client.close()
+    uncached.close()
+
+def test_log_storage():
+    """
+    TestCase Senario:
+    start a server with the log storage on another port and lock resourceX, the server crashes right after the
+    grant, before the log is compacted, and the next one recovers the lock from the log. after it stops the log is compacted into
+    the database and the snapshot
+    """
+    import json
+    import signal
+    import sqlite3
+    import subprocess
+    import sys
+
+    copyfile('resources_testing.sqlite', 'resources_log.sqlite')
+    env = dict(os.environ, lock_server_port="8896", lock_backend="log", lock_database_name="resources_log.sqlite",
+               lock_recovery_grace="5000")
+
+    def start():
+        server = subprocess.Popen([sys.executable, 'socket_server.py'], env=env)
+        for i in range(100):
+            try:
+                return server, socket.create_connection((HOST, 8896))
+            except socket.error:
+                time.sleep(0.1)
+
+    server, s = start()
+    try:
+        s.sendall('lock resourceX')
+        assert s.recv(1024) == 'You have an exclusive access to resource resourceX'
+        #the change is in the log before the grant is sent, crash right away
+        server.kill()
+        server.wait()
+        s.close()
+
+        server, s = start()
+        s.sendall('status resourceX')
+        assert s.recv(1024) == 'locked resourceX 127.0.0.1'
+        s.close()
+        server.send_signal(signal.SIGINT)
+        server.wait()
+
+        con = sqlite3.connect('resources_log.sqlite')
+        assert con.execute("select current_state, client_address from resources_names where resource_name = 'resourceX'").fetchone() == ('busy', '127.0.0.1')
+        assert con.execute("select count(*) from operations join resources_names on resources_names.resource_id = operations.resource_id where resource_name = 'resourceX' and operation_type = 'lock'").fetchone()[0] > 0
+        con.close()
+        with open('resources_log.snapshot') as snapshot:
+            assert [resource[2] for resource in json.load(snapshot)["resources"] if resource[1] == 'resourceX'] == ['busy']
+    finally:
+        if server.poll() is None:
+            server.kill()
+            server.wait()
+        for name in ('resources_log.sqlite', 'resources_log.log', 'resources_log.snapshot'):
+            if os.path.exists(name):
+                os.remove(name)
+
+def test_backends():
+    """
+    TestCase Senario:
+    run the same locking scenario on resourceY against every backend, the sqlite and memory backends and the
+    lock table with and without the log storage. the locks, the fencing tokens, the shared locks, the sessions
+    that own the locks, the releases and the history must behave the same, then time the lock and release of
+    resourceY on every backend
+    """
+    from backends import SqliteBackend, MemoryBackend
+    from lock_table import LockTable
+    from log_storage import LogStorage
+
+    resource_name = 'resourceY'
+    first, second, third = '10.1.0.1', '10.1.0.2', '10.1.0.3'
+    log_names = ('resources_backend.log', 'resources_backend.snapshot')
+    log_table = LockTable(LogStorage(log_names[0], log_names[1], size=1024 * 1024, compact_interval=3600))
+    backends = [SqliteBackend(), MemoryBackend(), LockTable(), log_table]
+    try:
+        for day, backend in enumerate(backends, 1):
+            backend.load()
+            if isinstance(backend, LockTable) and not isinstance(backend, MemoryBackend):
+                backend.start()
+            #the operations of every backend happen on their own later day, they are all kept in the same database
+            since = '2099-01-%02d' % day
+            times = ('%s 00:00:%02d' % (since, i) for i in range(60))
+            #the operations left in the database by an earlier run are skipped
+            resource_id = backend.get_resource_id(resource_name)
+            earlier = set(operation[0] for operation in backend.iter_operations(resource_id, since))
+            assert backend.check_status(resource_name) == 'free'
+            assert backend.check_status('UnknownResource') is None
+
+            #only one client locks resourceY and only the session of the owner releases it
+            token = backend.acquire(resource_name, first, next(times), 1)
+            assert token
+            assert not backend.acquire(resource_name, second, next(times), 3)
+            assert backend.check_status(resource_name) == 'busy'
+            assert tuple(backend.get_client_address(resource_name)) == (first,)
+            assert backend.holds(resource_name, first) and backend.holds(resource_name, first, 1)
+            assert not backend.holds(resource_name, first, 2) and not backend.holds(resource_name, second)
+            assert not backend.release(resource_name, second, next(times), 3)
+            assert not backend.release(resource_name, first, next(times), 2)
+            assert backend.release(resource_name, first, next(times), 1)
+
+            #two readers share resourceY, a writer must wait for both of them
+            shared_token = backend.acquire_shared(resource_name, first, next(times), 1)
+            assert shared_token > token
+            assert backend.acquire_shared(resource_name, second, next(times), 3) > shared_token
+            assert backend.acquire_shared(resource_name, first, next(times), 2)
+            assert backend.check_status(resource_name) == 'shared'
+            assert sorted(set(backend.get_client_address(resource_name))) == [first, second]
+            assert not backend.acquire(resource_name, third, next(times), 5)
+            #a closed session releases its own shared lock only
+            assert backend.release_session({resource_name: 1}, first, 4, next(times)) == []
+            assert backend.release_session({resource_name: 1}, first, 1, next(times)) == [resource_name]
+            assert not backend.holds(resource_name, first, 1) and backend.holds(resource_name, first, 2)
+            assert backend.release_by_client_address(first, next(times)) == [resource_name]
+            assert backend.release_by_client_address(second, next(times)) == [resource_name]
+            assert backend.check_status(resource_name) == 'free'
+
+            #all or nothing
+            tokens = backend.acquire_many([resource_name], third, next(times), 5)
+            assert len(tokens) == 1 and tokens[0] > shared_token
+            assert not backend.release_many([resource_name], third, next(times), 6)
+            assert backend.release_many([resource_name], third, next(times), 5)
+
+            #every change appended its operation
+            def history(*args):
+                return [operation for operation in backend.iter_operations(resource_id, since, *args)
+                        if operation[1].startswith(since) and operation[0] not in earlier]
+            operations = history()
+            assert [operation[2] for operation in operations] == ['lock', 'release', 'lock_shared', 'lock_shared', 'lock_shared',
+                                                                  'release', 'release', 'release', 'lock', 'release']
+            assert history(operations[3][0]) == operations[4:]
+            try:
+                history(999999999)
+                assert False
+            except UnknownOperation:
+                pass
+            assert [operation[3] for operation in history(None, third)] == [third, third]
+
+        #time the lock and release of resourceY on every backend
+        for backend in backends:
+            started = time.time()
+            for i in range(200):
+                assert backend.acquire(resource_name, first, '2000-01-01 00:00:00', 1)
+                assert backend.release(resource_name, first, '2000-01-01 00:00:00', 1)
+            print '%s%s: %.1f microseconds per lock and release' % (type(backend).__name__, " with the log" if backend is log_table else "",
+                                                                    (time.time() - started) / 200 * 1e6)
+        backends[2].flush()
+    finally:
+        if log_table.storage.log is not None:
+            log_table.storage.log.close()
+        for name in log_names:
+            if os.path.exists(name):
+                os.remove(name)
+
+def test_recovery():
+    """
+    TestCase Senario:
+    leave resourceX and resourceZ locked with their lock operations and resourceY locked without one, like after
+    a crash, then start a server on another port. resourceY is a phantom lock and is released when the server starts,
+    resourceX is kept for the grace lease then released. the client of resourceZ releases and locks it again inside
+    the grace lease, its new lock outlives the grace lease
+    """
+    import json
+    import sqlite3
+    import subprocess
+    import sys
+
+    copyfile('resources_testing.sqlite', 'resources_recovery.sqlite')
+    con = sqlite3.connect('resources_recovery.sqlite')
+    con.execute("update resources_names set current_state = 'busy', client_address = '10.2.0.1' where resource_name = 'resourceX'")
+    con.execute("update resources_names set current_state = 'busy', client_address = '10.2.0.2' where resource_name = 'resourceY'")
+    con.execute("insert into operations(resource_id, operation_time, operation_type, client_ip_address) select resource_id, '2017-01-01 00:00:00', 'lock', '10.2.0.1' from resources_names where resource_name = 'resourceX'")
+    con.execute("update resources_names set current_state = 'busy', client_address = '127.0.0.1' where resource_name = 'resourceZ'")
+    con.execute("insert into operations(resource_id, operation_time, operation_type, client_ip_address) select resource_id, '2017-01-01 00:00:00', 'lock', '127.0.0.1' from resources_names where resource_name = 'resourceZ'")
+    con.commit()
+    con.close()
+    env = dict(os.environ, lock_server_port="8895", lock_recovery_grace="1000", lock_database_name="resources_recovery.sqlite")
+    server = subprocess.Popen([sys.executable, 'socket_server.py'], env=env)
+    try:
+        for i in range(100):
+            try:
+                s = socket.create_connection((HOST, 8895))
+                break
+            except socket.error:
+                time.sleep(0.1)
+        s.sendall('status resourceY')
+        assert s.recv(1024) == 'released resourceY'
+        s.sendall('status resourceX')
+        assert s.recv(1024) == 'locked resourceX 10.2.0.1'
+        s.sendall('stats')
+        stats = json.loads(s.recv(65536))
+        assert stats["counters"]["recovered_locks_released"] == 1
+        assert stats["counters"]["recovered_locks_kept"] == 2
+        assert stats["histograms"]["startup"]["count"] == 1
+
+        #the recovered lock of resourceZ is released by its client, which locks it again
+        s.sendall('release resourceZ')
+        assert s.recv(1024) == 'lock released from resource resourceZ'
+        s.sendall('lock resourceZ')
+        assert s.recv(1024) == 'You have an exclusive access to resource resourceZ'
+
+        #the grace leases end, only the recovered lock of resourceX is released
+        time.sleep(1.5)
+        s.sendall('status resourceX')
+        assert s.recv(1024) == 'released resourceX'
+        s.sendall('status resourceZ')
+        assert s.recv(1024) == 'locked resourceZ 127.0.0.1'
+        s.close()
+    finally:
+        server.kill()
+        server.wait()
+        if os.path.exists('resources_recovery.sqlite'):
+            os.remove('resources_recovery.sqlite')
@@ -0,0 +1,175 @@
+"""
+this file contains a hierarchical timer wheel used to expire the lock leases.
+scheduling and cancelling a timer are O(1) and a single thread runs all of them,
+instead of a thread or a database scan per lease.
+
+the first level has a slot per tick, every next level has a slot per full turn of the
+level below it. a timer is put in the lowest level that can hold its delay and moved
+down one level every time the slot it waits in comes up, until it fires from the first level.
+"""
+import threading
+import time
+from settings import TIMER_WHEEL_TICK, TIMER_WHEEL_SLOTS, TIMER_WHEEL_LEVELS
+
+class Timer(object):
+    """
+    a function scheduled to run once after a delay
+    """
+    def __init__(self, expires, func, args):
+        """
+        the constructor of the class Timer
+
+        :param int expires: the tick number at which the timer fires
+        :param function func: the function to be called
+        :param tuple args: the arguments of the function
+        """
+        self.expires = expires
+        self.func = func
+        self.args = args
+        # the slot that holds the timer, None after it fired or got cancelled
+        self.slot = None
+
+class TimerWheel(object):
+    """
+    a hierarchical timer wheel driven by a single background thread
+    """
+    def __init__(self, tick=TIMER_WHEEL_TICK, slots=TIMER_WHEEL_SLOTS, levels=TIMER_WHEEL_LEVELS):
+        """
+        the constructor of the class TimerWheel
+
+        :param float tick: number of seconds between two ticks
+        :param int slots: number of slots in every level
+        :param int levels: number of levels
+        """
+        self.tick = tick
+        self.slots = slots
+        self.levels = [[set() for i in range(slots)] for level in range(levels)]
+        # the number of ticks done since the wheel started
+        self.current = 0
+        self.count = 0
+        self.started_at = None
+        self.condition = threading.Condition()
+
+    def schedule(self, delay, func, *args):
+        """
+        run func(*args) in the thread of the wheel after delay secs, it must not block
+
+        :param float delay: number of seconds to wait
+        :param function func: the function to be called
+
+        :rtype: Timer
+        """
+        with self.condition:
+            if self.started_at is None:
+                self.start()
+            if self.count == 0:
+                # nothing is scheduled, skip the ticks passed while the wheel was idle
+                self.current = self.now()
+            timer = Timer(self.current + max(int(delay / self.tick + 0.5), 1), func, args)
+            self.place(timer)
+            self.count += 1
+            self.condition.notify()
+        return timer
+
+    def cancel(self, timer):
+        """
+        cancel a timer that did not fire yet
+
+        :param Timer timer: the timer to be cancelled
+
+        :rtype: bool, True if the timer is cancelled by this call
+        """
+        with self.condition:
+            if timer.slot is None:
+                return False
+            timer.slot.discard(timer)
+            timer.slot = None
+            self.count -= 1
+            return True
+
+    def start(self):
+        """
+        start the thread of the wheel, must be called holding the condition
+
+        :rtype: None
+        """
+        self.started_at = time.time()
+        runner = threading.Thread(target=self.run_forever)
+        runner.daemon = True
+        runner.start()
+
+    def now(self):
+        """
+        the number of ticks passed since the wheel started
+
+        :rtype: int
+        """
+        return int((time.time() - self.started_at) / self.tick)
+
+    def place(self, timer):
+        """
+        put a timer in the lowest level that can hold it, must be called holding the condition
+
+        :param Timer timer: the timer to be placed
+
+        :rtype: None
+        """
+        # the timers later than the last level can hold wait in its farthest slot and are placed again
+        expires = min(timer.expires, self.current + self.slots ** len(self.levels) - 1)
+        delta = expires - self.current
+        level = 0
+        span = 1
+        while delta >= span * self.slots:
+            level += 1
+            span *= self.slots
+        timer.slot = self.levels[level][(expires // span) % self.slots]
+        timer.slot.add(timer)
+
+    def advance(self):
+        """
+        do a single tick and return the timers that fire, must be called holding the condition
+
+        :rtype: list of Timer
+        """
+        self.current += 1
+        # move the timers of the higher levels whose slot comes up one level down
+        span = 1
+        for level in range(1, len(self.levels)):
+            span *= self.slots
+            if self.current % span:
+                break
+            slot = self.levels[level][(self.current // span) % self.slots]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self.place(timer)
+
+        slot = self.levels[0][self.current % self.slots]
+        expired = list(slot)
+        slot.clear()
+        for timer in expired:
+            timer.slot = None
+        self.count -= len(expired)
+        return expired
+
+    def run_forever(self):
+        """
+        the body of the thread of the wheel, it ticks while there are timers and sleeps otherwise
+
+        :rtype: None
+        """
+        while True:
+            with self.condition:
+                while self.count == 0:
+                    self.condition.wait()
+                expired = []
+                now = self.now()
+                while self.current < now:
+                    expired.extend(self.advance())
+            for timer in expired:
+                try:
+                    timer.func(*timer.args)
+                except Exception as e:
+                    print 'Timer failed: ' + repr(e)
+            if not expired:
+                time.sleep(self.tick)
@@ -0,0 +1,144 @@
+"""
+this file contains the FIFO queues of the clients waiting for busy resources.
+a release hands the resource over to the first waiter of its queue immediately.
+"""
+import threading
+from collections import deque
+
+# the states of a waiter
+WAITING = "waiting"
+GRANTED = "granted"
+CANCELLED = "cancelled"
+
+class Waiter(object):
+    """
+    a client waiting for a busy resource
+    """
+    def __init__(self, resource_name, client_address, on_grant=None, ttl=None, shared=False, session=None):
+        """
+        the constructor of the class Waiter
+
+        :param str resource_name: a unique identifier for a resource
+        :param str client_address: the ip address of the client
+        :param function on_grant: called without arguments by the releasing thread once the
+            resource is handed over to the waiter, it must not block
+        :param int ttl: number of milliseconds the lock lasts after it is granted, None to keep it until released
+        :param bool shared: True if the client waits to share the resource with other readers
+        :param int session: the session of the client, the lock is granted to it
+        """
+        self.resource_name = resource_name
+        self.client_address = client_address
+        self.on_grant = on_grant
+        self.ttl = ttl
+        self.shared = shared
+        self.session = session
+        self.state = WAITING
+        # the fencing token of the lock, set when the resource is handed over to the waiter
+        self.token = 0
+
+    def grant(self):
+        """
+        the resource is handed over to the waiter, must be called holding the mutex of the queues
+
+        :rtype: None
+        """
+        self.state = GRANTED
+        if self.on_grant is not None:
+            self.on_grant()
+
+class WaitQueues(object):
+    """
+    resource name -> FIFO queue of waiters, all of them guarded by a single mutex
+    """
+    def __init__(self):
+        """
+        the constructor of the class WaitQueues
+        """
+        self.queues = {}
+        self.mutex = threading.RLock()
+
+    def has_waiters(self, resource_name):
+        """
+        check if there are clients waiting for a resource, must be called holding the mutex
+
+        :param str resource_name: a unique identifier for a resource
+
+        :rtype: bool
+        """
+        return resource_name in self.queues
+
+    def append(self, waiter):
+        """
+        put the waiter at the end of the queue of its resource, must be called holding the mutex
+
+        :param Waiter waiter: the waiting client
+
+        :rtype: None
+        """
+        self.queues.setdefault(waiter.resource_name, deque()).append(waiter)
+
+    def appendleft(self, waiter):
+        """
+        put the waiter back at the head of the queue of its resource, must be called holding the mutex
+
+        :param Waiter waiter: the waiting client
+
+        :rtype: None
+        """
+        self.queues.setdefault(waiter.resource_name, deque()).appendleft(waiter)
+
+    def count(self):
+        """
+        get the number of waiting clients of all the resources
+
+        :rtype: int
+        """
+        with self.mutex:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def peek(self, resource_name):
+        """
+        get the first waiter of a resource without taking it, must be called holding the mutex
+
+        :param str resource_name: a unique identifier for a resource
+
+        :rtype: Waiter or None
+        """
+        queue = self.queues.get(resource_name)
+        if queue is None:
+            return None
+        return queue[0]
+
+    def popleft(self, resource_name):
+        """
+        take the first waiter of a resource, must be called holding the mutex
+
+        :param str resource_name: a unique identifier for a resource
+
+        :rtype: Waiter or None
+        """
+        queue = self.queues.get(resource_name)
+        if queue is None:
+            return None
+        waiter = queue.popleft()
+        if not queue:
+            del self.queues[resource_name]
+        return waiter
+
+    def cancel(self, waiter):
+        """
+        remove a waiter from its queue after it gave up waiting
+
+        :param Waiter waiter: the waiting client
+
+        :rtype: bool, False if the resource was already handed over to the waiter
+        """
+        with self.mutex:
+            if waiter.state != WAITING:
+                return waiter.state == CANCELLED
+            waiter.state = CANCELLED
+            queue = self.queues[waiter.resource_name]
+            queue.remove(waiter)
+            if not queue:
+                del self.queues[waiter.resource_name]
+            return True
@@ -0,0 +1,120 @@
+"""
+this file contains the subscriptions of the clients watching the state of resources.
+every change of the lock state of a watched resource is formatted once as an event and handed
+over to all its watchers, a resource nobody watches costs a single dictionary lookup.
+"""
+import threading
+
+# the event sent for every lock state
+EVENTS = {
+    "busy": "locked",
+    "shared": "shared",
+    "free": "released",
+}
+
+# the state of every event
+STATES = dict((event, state) for state, event in EVENTS.items())
+
+def format_event(resource_name, state, client_addresses):
+    """
+    build the event of a lock state change, like "locked resourceX 127.0.0.1", "shared resourceX 127.0.0.1,127.0.0.2"
+    or "released resourceX"
+
+    :param str resource_name: a unique identifier for a resource
+    :param str state: the new state, free, busy or shared
+    :param tuple client_addresses: the ip addresses of the clients holding the resource
+
+    :rtype: str
+    """
+    event = EVENTS[state] + " " + resource_name
+    if state != "free" and client_addresses:
+        event += " " + ",".join(client_address for client_address in client_addresses if client_address)
+    return event
+
+def parse_event(event):
+    """
+    read an event built by format_event
+
+    :param str event: the event, like "locked resourceX 127.0.0.1"
+
+    :rtype: tuple (resource_name, state, client_addresses)
+    """
+    words = event.split()
+    client_addresses = ()
+    if len(words) > 2:
+        client_addresses = tuple(words[2].split(","))
+    return words[1], STATES[words[0]], client_addresses
+
+class Watchers(object):
+    """
+    resource name -> the functions that send the events of the resource to its watchers
+    """
+    def __init__(self):
+        """
+        the constructor of the class Watchers
+        """
+        self.subscribers = {}
+        self.mutex = threading.Lock()
+
+    def watch(self, resource_name, send):
+        """
+        send the events of a resource to a watcher
+
+        :param str resource_name: a unique identifier for a resource
+        :param function send: called with every event of the resource, it must not block
+
+        :rtype: None
+        """
+        with self.mutex:
+            self.subscribers.setdefault(resource_name, set()).add(send)
+
+    def unwatch(self, resource_name, send):
+        """
+        stop sending the events of a resource to a watcher
+
+        :param str resource_name: a unique identifier for a resource
+        :param function send: the function given to watch
+
+        :rtype: bool, False if the watcher was not watching the resource
+        """
+        with self.mutex:
+            subscribers = self.subscribers.get(resource_name)
+            if subscribers is None or send not in subscribers:
+                return False
+            subscribers.remove(send)
+            if not subscribers:
+                del self.subscribers[resource_name]
+            return True
+
+    def has_watchers(self, resource_name):
+        """
+        check if somebody watches a resource
+
+        :param str resource_name: a unique identifier for a resource
+
+        :rtype: bool
+        """
+        return resource_name in self.subscribers
+
+    def notify(self, resource_name, event):
+        """
+        send the new lock state of a resource to all its watchers
+
+        :param str resource_name: a unique identifier for a resource
+        :param str event: the event built by format_event
+
+        :rtype: None
+        """
+        with self.mutex:
+            subscribers = list(self.subscribers.get(resource_name, ()))
+        for send in subscribers:
+            send(event)
+
+    def count(self):
+        """
+        get the number of watches of all the resources
+
+        :rtype: int
+        """
+        with self.mutex:
+            return sum(len(subscribers) for subscribers in self.subscribers.values())